@@ -1,14 +1,67 @@
+import hashlib
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 
-from apps.patient.models import Patient
+from apps.patient.cache import patient_counts
+from apps.patient.campaign import dispatch_batches
+from apps.patient.models import Campaign, EngagementStat, Patient, PatientTransition
 
 def send_email_button(modeladmin, request, queryset):
-    for patient in queryset:
-        patient.send_email()
+    dispatch_batches(queryset)
+
+
+class CachedCountPaginator(Paginator):
+
+    """
+    Caches the changelist's COUNT(*) per filtered query; patient writes retire it
+    """
+    @cached_property
+    def count(self):
+        key = hashlib.sha1(str(self.object_list.query).encode()).hexdigest()
+        return patient_counts.get_or_set(f"admin:{key}", self.object_list.count)
 
 @admin.register(Patient)
 class PatientAdmin(admin.ModelAdmin):
 
     list_display = ("id", "user_id", "study", "status", "cancelled")
+    list_select_related = ("study",)
     list_filter = ("status", "cancelled")
+    paginator = CachedCountPaginator
     actions = [send_email_button]
+
+
+@admin.register(Campaign)
+class CampaignAdmin(admin.ModelAdmin):
+
+    list_display = ("id", "created", "run_key", "window_start", "window_end", "status", "recipients", "sent", "failed", "deferred", "suppressed")
+    list_filter = ("status",)
+
+
+@admin.register(PatientTransition)
+class PatientTransitionAdmin(admin.ModelAdmin):
+
+    list_display = ("id", "patient_id", "study_id", "field", "old", "new", "source", "at")
+    list_filter = ("field", "source", "month")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(EngagementStat)
+class EngagementStatAdmin(admin.ModelAdmin):
+
+    list_display = ("patient_id", "opens", "clicks", "first_opened", "first_clicked", "last_seen")
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class PatientConfig(AppConfig):
+    name = 'apps.patient'
+    label = 'patient'
+
+    def ready(self):
+        from apps.patient import signals  # noqa: F401
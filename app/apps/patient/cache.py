@@ -0,0 +1,15 @@
+from libs.cache import tiered
+
+# Per-patient lookups, keyed by patient id
+patients = tiered("patient")
+# Aggregates over many patients (per-study counts, admin changelist counts)
+patient_counts = tiered("patient_counts")
+
+
+def invalidate_patients():
+    '''
+    Retire every cached patient lookup, for writes that do not say which
+    patients they touched
+    '''
+    patients.invalidate_all()
+    patient_counts.invalidate_all()
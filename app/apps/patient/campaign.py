@@ -0,0 +1,206 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+from datetime import timedelta
+from itertools import groupby
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from apps.patient import eligibility, tracking
+from apps.patient.models import Campaign, CampaignShard
+from apps.patient.pacing import plan
+from apps.study.cache import study_context
+from tasks.payloads import chunks, make_batch, send_options
+from tasks.suppression import index as suppression_index
+
+
+def plan_shards(queryset, shard_size):
+    '''
+    Split the patients in ``queryset`` into shards of at most ``shard_size``
+    patients. A shard never spans two studies and is described by an
+    inclusive patient-id range, so the shard task can re-select its
+    recipients with a single indexed query instead of receiving a list of ids.
+
+    Only the ids are streamed from the database; the shard boundaries are the
+    only thing kept in memory.
+    '''
+    if shard_size < 1:
+        raise ValueError("shard_size must be a positive integer")
+
+    rows = queryset.order_by("study_id", "id").values_list("study_id", "id").iterator()
+    shards = []
+    for study_id, group in groupby(rows, key=lambda row: row[0]):
+        lower = upper = None
+        size = 0
+        for _, patient_id in group:
+            if size == 0:
+                lower = patient_id
+            upper = patient_id
+            size += 1
+            if size == shard_size:
+                shards.append(_shard(study_id, lower, upper, size))
+                size = 0
+        if size:
+            shards.append(_shard(study_id, lower, upper, size))
+    return shards
+
+
+def _shard(study_id, lower, upper, size):
+    return {
+        "study_id": study_id,
+        "lower": lower,
+        "upper": upper,
+        "size": size,
+    }
+
+
+def create_campaign(shards, window_start, window_end, run_key=None) -> Campaign:
+    '''
+    Record a campaign and its shards, with the shards planned evenly across
+    the delivery window. Both or neither are written, so a run_key is never
+    taken by a campaign without shards.
+    '''
+    with transaction.atomic():
+        campaign = Campaign.objects.create(
+            run_key=run_key,
+            window_start=window_start,
+            window_end=window_end,
+            recipients=sum(shard["size"] for shard in shards),
+        )
+        CampaignShard.objects.bulk_create(plan(
+            [CampaignShard(campaign=campaign, **shard) for shard in shards],
+            window_start,
+            window_end,
+        ))
+    return campaign
+
+
+def claim_shard(shard_id, fence) -> bool:
+    '''
+    Record ``fence`` as the shard's latest fencing token. False when the
+    shard is complete or a newer lease holder has claimed it already.
+    '''
+    return bool(CampaignShard.objects.filter(id=shard_id, completed_at__isnull=True, fence__lt=fence).update(
+        fence=fence, heartbeat_at=timezone.now(),
+    ))
+
+
+def touch_shard(shard_id, fence):
+    '''
+    Record that the holder of ``fence`` is still working on the shard
+    '''
+    CampaignShard.objects.filter(id=shard_id, fence=fence).update(heartbeat_at=timezone.now())
+
+
+def stalled_shards(campaign, now, timeout=None) -> list:
+    '''
+    The campaign's dispatched, unfinished shards whose task has not reported
+    for CAMPAIGN_SHARD_TIMEOUT seconds (or has not started within it): the
+    task may have been lost with a worker or the broker
+    '''
+    timeout = settings.CAMPAIGN_SHARD_TIMEOUT if timeout is None else timeout
+    cutoff = now - timedelta(seconds=timeout)
+    return list(campaign.shards.filter(
+        Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, dispatched_at__lt=cutoff),
+        dispatched_at__isnull=False, completed_at__isnull=True,
+    ))
+
+
+def requeue_shards(shard_ids) -> int:
+    '''
+    Return unfinished shards to pending, for the pacer to dispatch again.
+    Should their first task still run, the shard lease and fencing token
+    stop it from sending twice.
+    '''
+    return CampaignShard.objects.filter(id__in=shard_ids, completed_at__isnull=True).update(
+        dispatched_at=None, heartbeat_at=None,
+    )
+
+
+def record_shard_result(shard_id, result, fence=None):
+    '''
+    Store the outcome of a finished shard, add it to its campaign's totals
+    and mark the campaign complete once every shard has finished. With a
+    ``fence`` the result is only stored if no newer holder claimed the shard.
+    '''
+    counters = {counter: result.get(counter, 0) for counter in ("sent", "failed", "deferred", "suppressed")}
+    shard = CampaignShard.objects.filter(id=shard_id, completed_at__isnull=True)
+    if fence is not None:
+        shard = shard.filter(fence=fence)
+    updated = shard.update(completed_at=timezone.now(), **counters)
+    if not updated:
+        # Already recorded (e.g. the task ran twice), or fenced off
+        return False
+
+    campaign = Campaign.objects.filter(shards__id=shard_id)
+    campaign.update(**{counter: F(counter) + value for counter, value in counters.items()})
+    if not CampaignShard.objects.filter(campaign__in=campaign, completed_at__isnull=True).exists():
+        campaign.update(status=20)
+    return True
+
+
+def summarise(results):
+    '''
+    Fold the per-shard results of a campaign into one summary
+    '''
+    counters = ("sent", "failed", "deferred", "suppressed")
+    render_counters = ("render_hits", "render_shared_hits", "render_misses", "render_fallbacks", "render_saved_seconds")
+    summary = {"shards": 0, **dict.fromkeys(counters + render_counters, 0), "studies": {}}
+    for result in results:
+        summary["shards"] += 1
+        study = summary["studies"].setdefault(result["study_id"], dict.fromkeys(counters, 0))
+        for counter in counters:
+            summary[counter] += result.get(counter, 0)
+            study[counter] += result.get(counter, 0)
+        for counter in render_counters:
+            summary[counter] += result.get(counter, 0)
+    return summary
+
+
+def dispatch_batches(queryset, batch_size=None):
+    '''
+    Queue the patient email for every eligible patient in ``queryset`` as
+    compact batch payloads (one send_email_batch task per study and batch)
+    instead of one create_email task per patient. Returns the number of
+    batches queued.
+    '''
+    # Imported here so the admin can import this module without Celery
+    from tasks.tasks import send_email_batch
+
+    batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+    eligible = queryset.filter(eligibility.q())
+    rows = (
+        eligible.order_by("study_id")
+        .values_list("study_id", "user__email", "user__username", "id")
+        .iterator()
+    )
+    tracked = bool(settings.TRACKING_BASE_URL)
+    keys = ("patient_username", "tracking_open_url", "tracking_click_url") if tracked else ("patient_username",)
+    dispatched = 0
+    for study_id, group in groupby(rows, key=lambda row: row[0]):
+        context = study_context(study_id)
+        if tracked:
+            context = {**context, "tracking_url": settings.TRACKING_BASE_URL}
+        suppressed = []
+        for batch in chunks(group, batch_size):
+            # Suppressed addresses are neither sent to nor counted
+            blocked = suppression_index.suppressed(email for _, email, _, _ in batch)
+            suppressed.extend(patient_id for _, email, _, patient_id in batch if email in blocked)
+            if tracked:
+                recipients = [
+                    (email, username, *tracking.tracking_urls(tracking.token(patient_id)).values())
+                    for _, email, username, patient_id in batch if email not in blocked
+                ]
+            else:
+                recipients = [(email, username) for _, email, username, _ in batch if email not in blocked]
+            if recipients:
+                send_email_batch.apply_async(args=(make_batch(recipients, context, keys=keys),), **send_options())
+                dispatched += 1
+        # Counts towards the study's send cap, one UPDATE per study
+        eligible.filter(study_id=study_id).exclude(id__in=suppressed).update(emails_sent=F("emails_sent") + 1)
+    return dispatched
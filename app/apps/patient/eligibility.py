@@ -0,0 +1,136 @@
+"""
+Eligibility rules: which patients may be emailed.
+
+Each study's EligibilityRule (or DEFAULT, for studies without one) is
+compiled twice: into a Q for selecting eligible patients in SQL, and into a
+plain function of (status, cancelled, emails_sent) for rows already in
+memory. Both compile from the same Rule and must always agree; the
+property tests in apps/patient/tests/test_eligibility.py check they do.
+
+q() ORs the per-study predicates into one WHERE clause, grouping studies
+that share a rule, so a fan-out over every study stays a single query.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.db.models import Q
+from apps.study.cache import studies
+from apps.study.models import EligibilityRule, default_excluded_cancellations, default_statuses
+
+
+class Rule(namedtuple("Rule", "statuses excluded_cancellations send_cap")):
+
+    """
+    A hashable, normalised eligibility rule
+    """
+    @classmethod
+    def of(cls, statuses, excluded_cancellations, send_cap=None):
+        return cls(
+            tuple(sorted({int(s) for s in statuses})),
+            tuple(sorted({int(c) for c in excluded_cancellations})),
+            send_cap,
+        )
+
+
+DEFAULT = Rule.of(default_statuses(), default_excluded_cancellations())
+
+RULES_KEY = "eligibility-rules"
+
+
+def load_rules() -> dict:
+    '''
+    {study_id (str): Rule} for every study with a rule, through the two-tier
+    cache; saving or deleting a rule invalidates it
+    '''
+    return studies.get_or_set(RULES_KEY, lambda: {
+        str(study_id): Rule.of(statuses, excluded, cap)
+        for study_id, statuses, excluded, cap in EligibilityRule.objects.values_list(
+            "study_id", "statuses", "excluded_cancellations", "send_cap"
+        )
+    })
+
+
+def rule_for(study_id, rules=None) -> Rule:
+    rules = load_rules() if rules is None else rules
+    return rules.get(str(study_id), DEFAULT)
+
+
+# --------------------------------------------------------------
+# SQL
+# --------------------------------------------------------------
+def compile_q(rule) -> Q:
+    q = Q(status__in=rule.statuses)
+    if rule.excluded_cancellations:
+        q &= ~Q(cancelled__in=rule.excluded_cancellations)
+    if rule.send_cap is not None:
+        q &= Q(emails_sent__lt=rule.send_cap)
+    return q
+
+
+def q(rules=None) -> Q:
+    '''
+    One predicate selecting the eligible patients of every study
+    '''
+    rules = load_rules() if rules is None else rules
+    by_rule = defaultdict(list)
+    for study_id, rule in rules.items():
+        by_rule[rule].append(study_id)
+
+    predicate = compile_q(DEFAULT)
+    if rules:
+        predicate = ~Q(study_id__in=list(rules)) & predicate
+    for rule, study_ids in by_rule.items():
+        predicate |= Q(study_id__in=study_ids) & compile_q(rule)
+    return predicate
+
+
+# --------------------------------------------------------------
+# In memory
+# --------------------------------------------------------------
+@lru_cache(maxsize=256)
+def compile_predicate(rule):
+    '''
+    A function (status, cancelled, emails_sent) -> bool equivalent to
+    compile_q(rule)
+    '''
+    statuses, excluded, cap = frozenset(rule.statuses), frozenset(rule.excluded_cancellations), rule.send_cap
+    if cap is None:
+        return lambda status, cancelled, emails_sent: status in statuses and cancelled not in excluded
+    return lambda status, cancelled, emails_sent: (
+        status in statuses and cancelled not in excluded and emails_sent < cap
+    )
+
+
+def is_eligible(study_id, status, cancelled, emails_sent, rules=None) -> bool:
+    return compile_predicate(rule_for(study_id, rules))(status, cancelled, emails_sent)
+
+
+def evaluate(rows, rules=None) -> list:
+    '''
+    Eligibility of a batch of (study_id, status, cancelled, emails_sent)
+    rows, one bool per row, with one predicate lookup per study
+    '''
+    rules = load_rules() if rules is None else rules
+    predicates = {}
+    results = []
+    for study_id, status, cancelled, emails_sent in rows:
+        predicate = predicates.get(study_id)
+        if predicate is None:
+            predicate = predicates[study_id] = compile_predicate(rule_for(study_id, rules))
+        results.append(predicate(status, cancelled, emails_sent))
+    return results
+
+
+def select(patients, rules=None) -> list:
+    '''
+    The eligible patients among already fetched Patient instances
+    '''
+    patients = list(patients)
+    flags = evaluate(((p.study_id, p.status, p.cancelled, p.emails_sent) for p in patients), rules)
+    return [patient for patient, eligible in zip(patients, flags) if eligible]
@@ -0,0 +1,34 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.core.management.base import BaseCommand
+
+from apps.patient.models import PatientTransition
+from apps.patient.transitions import funnel
+
+
+class Command(BaseCommand):
+    help = "Report the mean time patients take to move between statuses, from the transition history."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--study", help="Only this study's patients.")
+        parser.add_argument("--month", type=int, action="append", help="Only transitions in this month (yyyymm); repeatable.")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        transitions = PatientTransition.objects.all()
+        if options["study"]:
+            transitions = transitions.filter(study_id=options["study"])
+        if options["month"]:
+            transitions = transitions.filter(month__in=options["month"])
+        report = funnel(transitions)
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for stage, row in report.items():
+            self.stdout.write(f"{stage:<28}{row['patients']:>10} patients{row['mean_seconds'] / 3600:>12.1f}h")
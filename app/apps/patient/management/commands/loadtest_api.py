@@ -0,0 +1,107 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from apps.patient import tracking
+from apps.patient.models import Campaign, Patient
+from libs.benchmark import percentile
+
+
+async def poll(host, port, paths, deadline, latencies, errors):
+    '''
+    One keep-alive client cycling through ``paths`` until ``deadline``.
+    '''
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError as exc:
+        errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+        return
+    i = 0
+    try:
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+            await writer.drain()
+            status = int((await reader.readline()).split()[1])
+            length = 0
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode().partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            if status >= 400:
+                errors[status] = errors.get(status, 0) + 1
+    except (ConnectionError, asyncio.IncompleteReadError) as exc:
+        errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+    finally:
+        writer.close()
+
+
+async def run(host, port, paths, clients, duration):
+    latencies, errors = [], {}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(poll(host, port, paths, deadline, latencies, errors) for _ in range(clients)))
+    return latencies, errors, time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = (
+        "Hold many concurrent keep-alive clients against a running ASGI server "
+        "(see the api service) polling the patient API, and report throughput and latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://localhost:8001", help="Base URL of the ASGI server.")
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--duration", type=float, default=30.0, help="Seconds to poll for.")
+        parser.add_argument("--sample", type=int, default=100, help="Patients to spread the polls across.")
+        parser.add_argument(
+            "--tracking", action="store_true", help="Hit the email open pixel and click redirect instead of the API."
+        )
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        url = urlsplit(options["url"])
+        patients = list(Patient.objects.values_list("id", "study_id")[:options["sample"]])
+        if not patients:
+            raise CommandError("No patients to poll; load fixtures or seed data first.")
+        if options["tracking"]:
+            tokens = [tracking.token(p) for p, _ in patients]
+            paths = [reverse("patient:track-open", args=[t]) for t in tokens]
+            paths += [reverse("patient:track-click", args=[t]) for t in tokens]
+        else:
+            paths = [reverse("patient:eligibility", args=[p]) for p, _ in patients]
+            paths += [reverse("patient:study-status-counts", args=[s]) for s in {s for _, s in patients}]
+            paths += [reverse("patient:campaign-progress", args=[c]) for c in Campaign.objects.values_list("id", flat=True)[:10]]
+        paths = [url.path.rstrip("/") + p for p in paths]
+
+        latencies, errors, elapsed = asyncio.run(
+            run(url.hostname, url.port or 80, paths, options["clients"], options["duration"])
+        )
+        result = {
+            "clients": options["clients"],
+            "requests": len(latencies),
+            "requests_per_second": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            "errors": errors,
+        }
+        if options["json"]:
+            self.stdout.write(json.dumps(result, indent=2))
+            return
+        for key, value in result.items():
+            self.stdout.write(f"{key:>20}: {value}")
@@ -0,0 +1,62 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study', '0002_alter_study_options'),
+        ('patient', '0002_alter_patient_options_alter_patient_cancelled_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('window_start', models.DateTimeField(help_text='Sending starts no earlier than this.')),
+                ('window_end', models.DateTimeField(help_text='Every shard is dispatched by this time.')),
+                ('status', models.IntegerField(choices=[(0, 'Planned'), (10, 'Sending'), (20, 'Complete')], default=0)),
+                ('recipients', models.PositiveIntegerField(default=0)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('deferred', models.PositiveIntegerField(default=0)),
+                ('suppressed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Campaign',
+                'verbose_name_plural': 'Campaigns',
+            },
+        ),
+        migrations.CreateModel(
+            name='CampaignShard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lower', models.UUIDField()),
+                ('upper', models.UUIDField()),
+                ('size', models.PositiveIntegerField()),
+                ('planned_at', models.DateTimeField(help_text='When the pacing plan expects the shard to be dispatched.')),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('sent', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('deferred', models.PositiveIntegerField(default=0)),
+                ('suppressed', models.PositiveIntegerField(default=0)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='patient.campaign')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='study.study')),
+            ],
+            options={
+                'verbose_name': 'Campaign Shard',
+                'verbose_name_plural': 'Campaign Shards',
+                'ordering': ('planned_at',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='campaignshard',
+            index=models.Index(fields=['campaign', 'dispatched_at'], name='patient_cam_campaig_bc58dd_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study', '0002_alter_study_options'),
+        ('patient', '0003_campaign'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientTransition',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('field', models.PositiveSmallIntegerField(choices=[(0, 'Status'), (1, 'Cancelled')])),
+                ('old', models.PositiveSmallIntegerField(blank=True, help_text='Empty when the patient was created.', null=True)),
+                ('new', models.PositiveSmallIntegerField()),
+                ('source', models.PositiveSmallIntegerField(choices=[(0, 'Create'), (1, 'Save'), (2, 'Bulk update')])),
+                ('at', models.DateTimeField()),
+                ('month', models.PositiveIntegerField(help_text='yyyymm of the change, in UTC.')),
+                ('patient', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='transitions', to='patient.patient')),
+                ('study', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='study.study')),
+            ],
+            options={
+                'verbose_name': 'Patient Transition',
+                'verbose_name_plural': 'Patient Transitions',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='patienttransition',
+            index=models.Index(fields=['month', 'study', 'field'], name='patient_pat_month_1e0a86_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patienttransition',
+            index=models.Index(fields=['patient', 'at'], name='patient_pat_patient_a8c02b_idx'),
+        ),
+    ]
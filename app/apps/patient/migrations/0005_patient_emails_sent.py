@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient', '0004_patienttransition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='emails_sent',
+            field=models.PositiveIntegerField(default=0, help_text='Emails queued or sent to the patient.'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.4 on 2026-10-19 17:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient', '0005_patient_emails_sent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaign',
+            name='run_key',
+            field=models.CharField(blank=True, help_text='The scheduled run this campaign was planned for; at most one campaign per run.', max_length=32, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='campaignshard',
+            name='fence',
+            field=models.PositiveBigIntegerField(default=0, help_text='Fencing token of the latest task to claim the shard; older ones may not write.'),
+        ),
+    ]
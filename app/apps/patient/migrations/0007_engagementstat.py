@@ -0,0 +1,29 @@
+# Generated by Django 4.1.4 on 2026-10-19 17:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient', '0006_campaign_leases'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EngagementStat',
+            fields=[
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='engagement', serialize=False, to='patient.patient')),
+                ('opens', models.PositiveIntegerField(default=0)),
+                ('clicks', models.PositiveIntegerField(default=0)),
+                ('first_opened', models.DateTimeField(blank=True, null=True)),
+                ('first_clicked', models.DateTimeField(blank=True, null=True)),
+                ('last_seen', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Engagement Stat',
+                'verbose_name_plural': 'Engagement Stats',
+            },
+        ),
+    ]
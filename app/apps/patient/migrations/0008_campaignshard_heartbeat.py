@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-19 17:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patient', '0007_engagementstat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaignshard',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, help_text="When the shard's task last reported progress.", null=True),
+        ),
+    ]
@@ -1,14 +1,77 @@
 import logging
 from uuid import uuid4
-from django.db import models
-from tasks.tasks import create_email
+from django.db import NotSupportedError, models, transaction
+from apps.patient import eligibility, tracking, transitions
+from apps.patient.cache import invalidate_patients
+from apps.study.cache import study_context
+from tasks.suppression import index as suppression_index
 
 logger = logging.getLogger(__name__)
 
+# Fields that only count; updates of nothing else (one per campaign batch)
+# leave the cached lookups alone, so eligibility under a study's send cap
+# may lag by up to CACHE_TIMEOUT
+COUNTER_FIELDS = frozenset({"emails_sent"})
+
+class PatientQuerySet(models.QuerySet):
+    """
+    Bulk writes send no model signals, so they retire the cached patient
+    lookups and record status transitions themselves
+    """
+    def update(self, **kwargs):
+        fields = [name for name in transitions.TRACKED if name in kwargs]
+        if not fields:
+            rows = super().update(**kwargs)
+        else:
+            # Read the rows' old values in the same transaction as the write
+            with transaction.atomic(using=self.db):
+                before = list(self.values_list("id", "study_id", *fields))
+                rows = super().update(**kwargs)
+                if all(isinstance(kwargs[name], int) for name in fields):
+                    new = tuple(kwargs[name] for name in fields)
+                    after = {row[0]: new for row in before}
+                else:
+                    # Expressions (F() etc.): read back what they wrote
+                    after = self._values_by_id([row[0] for row in before], fields)
+                transitions.record_bulk(before, after, fields)
+        if not COUNTER_FIELDS.issuperset(kwargs):
+            invalidate_patients()
+        return rows
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        # Runs through update() above, which records the transitions
+        rows = super().bulk_update(objs, fields, batch_size=batch_size)
+        for obj in objs:
+            obj._loaded = transitions.loaded(obj)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        created = objs
+        if kwargs.get("ignore_conflicts"):
+            # The objects are all returned, inserted or not; only record the
+            # ones whose (client-side) id made it into the table
+            inserted = set(self.model._base_manager.filter(pk__in=[obj.pk for obj in objs]).values_list("pk", flat=True))
+            created = [obj for obj in objs if obj.pk in inserted]
+        transitions.record_created(created)
+        invalidate_patients()
+        return objs
+
+    def _values_by_id(self, ids, fields, chunk_size=500):
+        values = {}
+        for i in range(0, len(ids), chunk_size):
+            rows = self.model._base_manager.filter(pk__in=ids[i:i + chunk_size]).values_list("id", *fields)
+            values.update((row[0], row[1:]) for row in rows)
+        return values
+
+
 class PatientManager(models.Manager):
     """
     A Manager for Patient objects
     """
+    def get_queryset(self):
+        return PatientQuerySet(self.model, using=self._db)
+
     def get_query_set(self):
         return self.get_queryset()
 
@@ -19,11 +82,26 @@ class PatientManager(models.Manager):
         return qs
 
     def in_study(self):
+        # Each study's eligibility rule, as one SQL predicate
         qs = self.get_query_set().filter(
-            cancelled=0, status =0
+            eligibility.q()
         )
         return qs
 
+    def send_emails(self, patients):
+        '''
+        Patient.send_email() for each of ``patients``, counting the sends
+        with one UPDATE for all of them; returns the number queued
+        '''
+        queued = [patient for patient in patients if patient.queue_email()]
+        if queued:
+            self.get_query_set().filter(id__in=[patient.id for patient in queued]).update(
+                emails_sent=models.F("emails_sent") + 1
+            )
+            for patient in queued:
+                patient.emails_sent += 1
+        return len(queued)
+
 
 
 class Patient(models.Model):
@@ -48,6 +126,7 @@ class Patient(models.Model):
         (30, "Opted out"),
         (40, "Not contactable"),
     ), default=0)
+    emails_sent = models.PositiveIntegerField(default=0, help_text="Emails queued or sent to the patient.")
 
     objects = PatientManager()
 
@@ -64,26 +143,207 @@ class Patient(models.Model):
     def __str__(self):
         return str(self.id)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Kept so save() can record what changed
+        instance._loaded = transitions.loaded(instance)
+        return instance
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        transitions.record_save(self, adding, kwargs.get("update_fields"))
+
     
     def in_study(self) -> bool:
         #Used to check a patient is in the linked study
-        if self.cancelled == 0 and self.status == 0:
-            return True
-        return False
+        return eligibility.is_eligible(self.study_id, self.status, self.cancelled, self.emails_sent)
+
+
+    def email_context(self) -> dict:
+        #Template context for the patient email
+        study = self.study if Patient.study.is_cached(self) else None
+        return {
+            'patient_username': self.user.username,
+            **study_context(self.study_id, study),
+            **tracking.tracking_context(self.id),
+        }
 
 
     def send_email(self):
+        #Sending to several patients? Patient.objects.send_emails() counts them in one query
+        Patient.objects.send_emails([self])
+
+
+    def queue_email(self) -> bool:
+        #Queue the email without counting it; False if the patient may not be emailed
         #Double check that the patient is in a study
-        if not self.in_study:
-            logging.DEBUG(f'Patient ID: {self.id}, is not participating in Study ID: {self.study.id}')
-        else:
+        if not self.in_study():
+            logger.debug(f'Patient ID: {self.id}, is not participating in Study ID: {self.study_id}')
+            return False
+        if suppression_index.is_suppressed(self.user.email):
+            logger.debug(f'Patient ID: {self.id}, email address is suppressed')
+            return False
+        # Imported here so loading the models does not pull in Celery
+        from tasks.tasks import create_email
+
+        create_email.delay(
+            email = self.user.email,
+            cc = [],
+            context = self.email_context(),
+            )
+        return True
 
-            create_email.delay(
-                email = self.user.email,
-                cc = [],
-                context = {
-                    'patient_username': self.user.username,
-                    'care_provider_contact': 'XXX',
-                    'care_provider_name': 'XXX',
-                }
-                )
+
+class Campaign(models.Model):
+
+    """
+    One run of the patient email campaign, paced across a delivery window.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    run_key = models.CharField(
+        max_length=32, unique=True, null=True, blank=True,
+        help_text="The scheduled run this campaign was planned for; at most one campaign per run.",
+    )
+    window_start = models.DateTimeField(help_text="Sending starts no earlier than this.")
+    window_end = models.DateTimeField(help_text="Every shard is dispatched by this time.")
+    status = models.IntegerField(choices=(
+        (0, "Planned"),
+        (10, "Sending"),
+        (20, "Complete"),
+    ), default=0)
+    recipients = models.PositiveIntegerField(default=0)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    deferred = models.PositiveIntegerField(default=0)
+    suppressed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Campaign"
+        verbose_name_plural = "Campaigns"
+
+    def __str__(self):
+        return str(self.id)
+
+
+class CampaignShard(models.Model):
+
+    """
+    The eligible patients of one study within an inclusive patient-id range,
+    sent by one send_email_shard task.
+    """
+
+    campaign = models.ForeignKey(Campaign, on_delete=models.CASCADE, related_name="shards")
+    study = models.ForeignKey('study.Study', on_delete=models.PROTECT)
+    lower = models.UUIDField()
+    upper = models.UUIDField()
+    size = models.PositiveIntegerField()
+    planned_at = models.DateTimeField(help_text="When the pacing plan expects the shard to be dispatched.")
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(
+        null=True, blank=True, help_text="When the shard's task last reported progress.",
+    )
+    fence = models.PositiveBigIntegerField(
+        default=0, help_text="Fencing token of the latest task to claim the shard; older ones may not write.",
+    )
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    deferred = models.PositiveIntegerField(default=0)
+    suppressed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ("planned_at",)
+        indexes = (
+            models.Index(fields=["campaign", "dispatched_at"]),
+        )
+        verbose_name = "Campaign Shard"
+        verbose_name_plural = "Campaign Shards"
+
+    def __str__(self):
+        return f"{self.campaign_id} [{self.lower}, {self.upper}]"
+
+
+class PatientTransitionQuerySet(models.QuerySet):
+    """
+    History is append-only
+    """
+    def update(self, **kwargs):
+        raise NotSupportedError("Patient transitions are append-only")
+
+    def delete(self):
+        raise NotSupportedError("Patient transitions are append-only")
+
+
+class PatientTransition(models.Model):
+
+    """
+    One change of a patient's status or cancelled code. Append-only, written
+    in batches by apps.patient.transitions and keyed by month (yyyymm) so
+    reports and archiving work a month at a time.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+    # No constraints: history outlives the rows it describes, and batch
+    # inserts skip the per-row foreign key checks
+    patient = models.ForeignKey(Patient, on_delete=models.DO_NOTHING, db_constraint=False, related_name="transitions")
+    study = models.ForeignKey('study.Study', on_delete=models.DO_NOTHING, db_constraint=False, related_name="+")
+    field = models.PositiveSmallIntegerField(choices=(
+        (0, "Status"),
+        (1, "Cancelled"),
+    ))
+    old = models.PositiveSmallIntegerField(null=True, blank=True, help_text="Empty when the patient was created.")
+    new = models.PositiveSmallIntegerField()
+    source = models.PositiveSmallIntegerField(choices=(
+        (0, "Create"),
+        (1, "Save"),
+        (2, "Bulk update"),
+    ))
+    at = models.DateTimeField()
+    month = models.PositiveIntegerField(help_text="yyyymm of the change, in UTC.")
+
+    objects = PatientTransitionQuerySet.as_manager()
+
+    class Meta:
+        indexes = (
+            models.Index(fields=["month", "study", "field"]),
+            models.Index(fields=["patient", "at"]),
+        )
+        verbose_name = "Patient Transition"
+        verbose_name_plural = "Patient Transitions"
+
+    def __str__(self):
+        return f"{self.patient_id} {self.get_field_display()} {self.old} → {self.new}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise NotSupportedError("Patient transitions are append-only")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise NotSupportedError("Patient transitions are append-only")
+
+
+class EngagementStat(models.Model):
+
+    """
+    A patient's email opens and clicks, kept up to date in batches by
+    apps.patient.tracking.
+    """
+
+    patient = models.OneToOneField(Patient, on_delete=models.CASCADE, primary_key=True, related_name="engagement")
+    opens = models.PositiveIntegerField(default=0)
+    clicks = models.PositiveIntegerField(default=0)
+    first_opened = models.DateTimeField(null=True, blank=True)
+    first_clicked = models.DateTimeField(null=True, blank=True)
+    last_seen = models.DateTimeField()
+
+    class Meta:
+        verbose_name = "Engagement Stat"
+        verbose_name_plural = "Engagement Stats"
+
+    def __str__(self):
+        return f"{self.patient_id}: {self.opens} opens, {self.clicks} clicks"
@@ -0,0 +1,75 @@
+"""
+Pacing of a campaign across its delivery window.
+
+plan() spreads the shards over the window in proportion to their size, so
+each stretch of the window carries the same number of recipients.
+
+next_dispatch() is called on every pacing tick and decides which shards to
+send now. It does not follow the plan blindly. The recipients still to
+dispatch are spread evenly over the time left in the window, so a campaign
+that has fallen behind speeds up. When more than CAMPAIGN_MAX_IN_FLIGHT
+shards are still running, nothing new is dispatched; slow shards hold back
+the rest instead of piling work onto a struggling database or SMTP
+provider. Once the window has ended, what is left is dispatched as fast as
+that limit allows, not all at once.
+
+A shard whose task was lost would count as running forever, so the pacer
+returns shards it has not heard from for CAMPAIGN_SHARD_TIMEOUT seconds to
+pending first (apps.patient.campaign.stalled_shards()).
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import math
+from datetime import timedelta
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+
+
+def plan(shards, window_start, window_end):
+    '''
+    Set ``planned_at`` on each shard (in order) so that recipients are
+    spread evenly between window_start and window_end
+    '''
+    total = sum(shard.size for shard in shards)
+    duration = (window_end - window_start).total_seconds()
+    done = 0
+    for shard in shards:
+        offset = duration * done / total if total else 0
+        shard.planned_at = window_start + timedelta(seconds=offset)
+        done += shard.size
+    return shards
+
+
+def next_dispatch(pending, in_flight, window_start, window_end, now, tick=None, max_in_flight=None):
+    '''
+    Choose which of the ``pending`` shards (in planned order) to dispatch on
+    this tick, given the number of shards still running
+    '''
+    tick = tick or settings.CAMPAIGN_PACING_TICK
+    max_in_flight = settings.CAMPAIGN_MAX_IN_FLIGHT if max_in_flight is None else max_in_flight
+    if not pending or now < window_start:
+        return []
+
+    if in_flight >= max_in_flight:
+        return []
+
+    remaining = (window_end - now).total_seconds()
+    if remaining <= tick:
+        # Past the window: catch up, but no faster than the in-flight limit
+        return list(pending[:max_in_flight - in_flight])
+
+    # Recipients to dispatch per tick if the rest were spread over the time left
+    budget = math.ceil(sum(shard.size for shard in pending) * tick / remaining)
+    chosen, recipients = [], 0
+    for shard in pending:
+        if len(chosen) + in_flight >= max_in_flight:
+            break
+        if chosen and recipients + shard.size > budget:
+            break
+        chosen.append(shard)
+        recipients += shard.size
+    return chosen
@@ -0,0 +1,43 @@
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.patient.cache import patient_counts, patients
+from apps.patient.models import Patient
+from tasks.models import Suppression
+from tasks.signals import email_dead_lettered
+from tasks.suppression import index
+
+
+@receiver(email_dead_lettered)
+def suppress_dead_lettered_address(sender, email, suppress, **kwargs):
+    '''
+    A hard bounce means the address is bad for every study, so mark all the
+    active patients using it as "Not contactable"; in_study() then leaves them
+    out of future fan-outs.
+    '''
+    if suppress:
+        Patient.objects.filter(user__email__iexact=email, cancelled=0).update(cancelled=40)
+
+
+@receiver(post_save, sender=Patient)
+def suppress_opted_out_address(sender, instance, created, update_fields=None, **kwargs):
+    '''
+    Opting out of one study opts the address out of all of them. Only a save
+    that changes cancelled to "Opted out" does it; Patient.save() refreshes
+    _loaded after this signal, so it still holds the value before the save.
+    '''
+    if instance.cancelled != 30 or (update_fields is not None and "cancelled" not in update_fields):
+        return
+    if created or getattr(instance, "_loaded", {}).get("cancelled") != 30:
+        Suppression.objects.suppress(instance.user.email, "opted_out")
+        index.add(instance.user.email)
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def invalidate_patient(sender, instance, **kwargs):
+    patients.invalidate(instance.id)
+    patient_counts.invalidate_all()
@@ -1,29 +1,271 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+from datetime import timedelta
+
 # --------------------------------------------------------------
 # Django imports
 # --------------------------------------------------------------
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
-from django.core.mail import get_connection 
-from apps.patient.models import Patient
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+from apps.patient import tracking, transitions
+from apps.patient.campaign import (
+    claim_shard, create_campaign, plan_shards, record_shard_result, requeue_shards, stalled_shards, summarise,
+    touch_shard,
+)
+from apps.patient.models import Campaign, CampaignShard, Patient
+from apps.patient.pacing import next_dispatch
+from tasks.failures import PERMANENT, SystemicFailure, backoff, classify
+from tasks.payloads import chunks
+from tasks.rendering import hit_rate, render_cache
+from tasks.suppression import index as suppression_index
+from tasks.tasks import connection_pool, deliver
+from libs.locks import LeaseLock, LeaseLost, LockHeld, is_held
 
 
 # --------------------------------------------------------------
 # 3rd party imports
 # --------------------------------------------------------------
-from celery import shared_task
+from celery import chord, shared_task
+from celery.signals import worker_process_shutdown
 from celery.utils.log import get_task_logger
+from redis.exceptions import RedisError
  
 logger = get_task_logger(__name__)
 
+# Recipients checked against the suppression index at a time
+SUPPRESSION_BATCH_SIZE = 200
+
+# Leases: one coordinator and one pacer at a time, one task per shard
+COORDINATOR_LEASE = "campaign-coordinator"
+PACER_LEASE = "campaign-pacer"
+SHARD_LEASE = "campaign-shard:{}"
+
 @shared_task(bind=True)
 def bulk_email(self,**kwargs):
     '''
-    Used to bulk send email
+    Campaign coordinator (run daily by beat).
+
+    Splits every eligible patient into per-study, per-id-range shards and
+    records them as a Campaign. With a delivery window (CAMPAIGN_WINDOW_HOURS)
+    the shards are left for pace_campaigns to drip out across the window;
+    without one they are fanned out at once as a chord, and
+    summarise_campaign aggregates their results once they have all finished.
+
+    Only the holder of the coordinator lease plans, and a run_key (today's
+    date unless given; None for an ad hoc run) is planned once, so beat and
+    workers may run on several hosts without sending a campaign twice. If
+    the lease's Redis cannot be reached the run is retried later.
+    '''
+    shard_size = kwargs.get("shard_size", settings.CAMPAIGN_SHARD_SIZE)
+    window = timedelta(hours=kwargs.get("window_hours", settings.CAMPAIGN_WINDOW_HOURS))
+    run_key = kwargs.get("run_key", timezone.localdate().isoformat())
+    try:
+        with LeaseLock(COORDINATOR_LEASE) as lease:
+            if run_key and Campaign.objects.filter(run_key=run_key).exists():
+                logger.info(f"Campaign: run {run_key} already planned, skipping")
+                return {"skipped": run_key}
+            shards = plan_shards(Patient.objects.in_study(), shard_size)
+            if not shards:
+                logger.info("Campaign: no eligible patients, nothing to send")
+                return summarise([])
+
+            now = timezone.now()
+            # Planning may outlast a stalled lease; don't record a campaign without it
+            lease.check()
+            campaign = create_campaign(shards, now, now + window, run_key=run_key)
+            if window:
+                logger.info(f"Campaign {campaign.id}: {len(shards)} shards paced over {window}")
+                return {"campaign": str(campaign.id), "shards": len(shards)}
+
+            logger.info(f"Campaign {campaign.id}: dispatching {len(shards)} shards")
+            campaign.shards.update(dispatched_at=now)
+            Campaign.objects.filter(id=campaign.id).update(status=10)
+            result = chord(
+                send_email_shard.s(str(shard.study_id), str(shard.lower), str(shard.upper), shard_id=shard.id)
+                for shard in campaign.shards.all()
+            )(summarise_campaign.s())
+            return {"campaign": str(campaign.id), "shards": len(shards), "chord_id": result.id}
+    except (LockHeld, LeaseLost, IntegrityError) as exc:
+        # Another coordinator is running, or planned this run first
+        logger.info(f"Campaign: skipping run {run_key}: {exc}")
+        return {"skipped": run_key}
+    except RedisError as exc:
+        countdown = backoff(self.request.retries)
+        logger.warning(f"Campaign: lease unavailable for run {run_key}, retrying in {countdown:.0f}s: {exc!r}")
+        raise self.retry(exc=exc, countdown=countdown, max_retries=settings.EMAIL_RETRY_MAX)
+
+
+@shared_task(bind=True)
+def pace_campaigns(self):
+    '''
+    Pacing tick (run by beat every CAMPAIGN_PACING_TICK seconds): dispatch
+    the next shards of every unfinished campaign whose window has opened.
+    Ticks overlapping one that holds the pacer lease are skipped; a tick
+    that cannot reach the lease's Redis is retried.
+    '''
+    try:
+        with LeaseLock(PACER_LEASE) as lease:
+            now = timezone.now()
+            for campaign in Campaign.objects.filter(status__lt=20, window_start__lte=now):
+                lease.check()
+                # A shard whose lease is held is still running, however quiet
+                stalled = [shard.id for shard in stalled_shards(campaign, now) if not is_held(SHARD_LEASE.format(shard.id))]
+                if stalled:
+                    requeued = requeue_shards(stalled)
+                    logger.warning(f"Campaign {campaign.id}: {requeued} shards stalled, dispatching them again")
+                pending = list(campaign.shards.filter(dispatched_at__isnull=True).order_by("planned_at"))
+                in_flight = campaign.shards.filter(dispatched_at__isnull=False, completed_at__isnull=True).count()
+                chosen = next_dispatch(pending, in_flight, campaign.window_start, campaign.window_end, now)
+                if not chosen:
+                    continue
+
+                CampaignShard.objects.filter(id__in=[shard.id for shard in chosen]).update(dispatched_at=now)
+                Campaign.objects.filter(id=campaign.id, status=0).update(status=10)
+                for shard in chosen:
+                    send_email_shard.delay(str(shard.study_id), str(shard.lower), str(shard.upper), shard_id=shard.id)
+                lag = (now - chosen[0].planned_at).total_seconds()
+                logger.info(f"Campaign {campaign.id}: dispatched {len(chosen)} of {len(pending)} pending shards, {lag:.0f}s behind plan")
+    except (LockHeld, LeaseLost) as exc:
+        logger.info(f"Pacing: skipping tick: {exc}")
+    except RedisError as exc:
+        countdown = backoff(self.request.retries)
+        logger.warning(f"Pacing: lease unavailable, retrying in {countdown:.0f}s: {exc!r}")
+        raise self.retry(exc=exc, countdown=countdown, max_retries=settings.EMAIL_RETRY_MAX)
+
+
+@shared_task(bind=True)
+def send_email_shard(self, study_id, lower, upper, shard_id=None, counts=None):
+    '''
+    Send the campaign email to the eligible patients of one study whose ids
+    fall within [lower, upper], reusing a single connection for the shard.
+
+    A campaign shard (``shard_id``) is sent under its own lease, so a
+    redelivered or duplicated task skips it while other shards still run in
+    parallel. The lease's fencing token is recorded on the shard before
+    sending and required to store the result, so a holder that lost its
+    lease cannot overwrite a newer one's.
+
+    ``counts`` carries the outcomes so far into a retry that resumes part
+    way through the shard.
+    '''
+    if shard_id is None:
+        return _send_shard(self, study_id, lower, upper, counts=counts)
+
+    lease = LeaseLock(SHARD_LEASE.format(shard_id))
+    try:
+        acquired = lease.acquire()
+    except RedisError as exc:
+        raise self.retry(exc=exc, countdown=backoff(self.request.retries), max_retries=settings.EMAIL_RETRY_MAX)
+    if not acquired:
+        logger.info(f"Shard {shard_id}: running elsewhere, skipping")
+        return {"study_id": study_id, "skipped": shard_id}
+    try:
+        if not claim_shard(shard_id, lease.token):
+            logger.info(f"Shard {shard_id}: complete or claimed by a newer task, skipping")
+            return {"study_id": study_id, "skipped": shard_id}
+        result = _send_shard(self, study_id, lower, upper, lease, shard_id, counts)
+        if not record_shard_result(shard_id, result, fence=lease.token):
+            logger.warning(f"Shard {shard_id}: result of fencing token {lease.token} refused, a newer task claimed it")
+        return result
+    except LeaseLost as exc:
+        # Whoever holds the shard now finishes it; otherwise the retry does
+        raise self.retry(exc=exc, countdown=backoff(self.request.retries), max_retries=settings.EMAIL_RETRY_MAX)
+    finally:
+        lease.release()
+
+
+def _send_shard(task, study_id, lower, upper, lease=None, shard_id=None, counts=None):
+    # In id order, so a retry can resume from the patient it stopped at
+    patients = Patient.objects.in_study().filter(
+        study_id=study_id, id__gte=lower, id__lte=upper
+    ).select_related("user").order_by("id")
+
+    try:
+        # Opened up front: deliver() reuses it
+        connection_pool.get()
+    except Exception as exc:
+        connection_pool.reset()
+        # Nothing has been sent yet, so the whole shard can be retried later
+        if classify(exc).kind != PERMANENT and task.request.retries < settings.EMAIL_RETRY_MAX:
+            raise task.retry(exc=exc, countdown=backoff(task.request.retries), max_retries=settings.EMAIL_RETRY_MAX)
+        raise
+
+    counts = {"sent": 0, "failed": 0, "deferred": 0, "suppressed": 0, **(counts or {})}
+    render_stats = render_cache.stats()
+    for batch in chunks(patients.iterator(), SUPPRESSION_BATCH_SIZE):
+        if lease is not None:
+            lease.check()
+            # So the pacer knows the task is alive
+            touch_shard(shard_id, lease.token)
+        # One suppression lookup per batch, not per recipient
+        blocked = suppression_index.suppressed(patient.user.email for patient in batch)
+        emailed = []
+        try:
+            for patient in batch:
+                if patient.user.email in blocked:
+                    counts["suppressed"] += 1
+                    continue
+                outcome = deliver(patient.user.email, patient.email_context())
+                counts[outcome] += 1
+                if outcome != "failed":
+                    emailed.append(patient.id)
+        except SystemicFailure as exc:
+            connection_pool.reset()
+            Patient.objects.filter(id__in=emailed).update(emails_sent=F("emails_sent") + 1)
+            if task.request.retries >= settings.EMAIL_RETRY_MAX:
+                logger.error(f"Shard of study {study_id}: systemic failure, giving up from patient {patient.id}: {exc}")
+                raise
+            # Resume from the patient that failed; the ones before it were sent to
+            raise task.retry(
+                args=(study_id, str(patient.id), upper), kwargs={**task.request.kwargs, "counts": counts}, exc=exc,
+                countdown=backoff(task.request.retries), max_retries=settings.EMAIL_RETRY_MAX,
+            )
+        # Counts towards the studies' send caps
+        Patient.objects.filter(id__in=emailed).update(emails_sent=F("emails_sent") + 1)
+    return {"study_id": study_id, **counts, **render_cache.stats_since(render_stats)}
+
+
+@shared_task
+def summarise_campaign(results):
     '''
-    patients = Patient.objects.in_study()
+    Chord callback: aggregate the shard results of a campaign run
+    '''
+    summary = summarise(results)
+    summary["render_hit_rate"] = hit_rate(summary)
+    logger.info(f"Campaign: finished, {summary['sent']} sent, {summary['deferred']} deferred, {summary['suppressed']} suppressed, {summary['failed']} failed across {summary['shards']} shards")
+    logger.info(f"Campaign: render cache hit rate {summary['render_hit_rate']:.1%}, ~{summary['render_saved_seconds']:.1f}s of rendering saved")
+    return summary
+
+
+@shared_task
+def flush_transitions():
+    '''
+    Write the patient transitions buffered in Redis (or in this worker)
+    '''
+    written = transitions.flush()
+    if written:
+        logger.info(f"Transitions: wrote {written} patient transitions")
+    return written
+
+
+@shared_task
+def flush_engagement():
+    '''
+    Apply the email opens and clicks buffered in Redis (or in this worker)
+    '''
+    applied = tracking.flush()
+    if applied:
+        logger.info(f"Engagement: applied {applied} open/click events")
+    return applied
+
 
-    #I would use Django bulk_send as it uses a single connection
-    pass
-    
\ No newline at end of file
+@worker_process_shutdown.connect
+def flush_worker_transitions(**kwargs):
+    # Pool processes exit without running atexit handlers
+    try:
+        transitions.flush_local()
+    except Exception:
+        logger.exception(f"Lost {len(transitions.buffer)} patient transitions at shutdown")
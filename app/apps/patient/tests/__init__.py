@@ -10,14 +10,16 @@ class ContactTestCase(TestCase):
     """
     Test suite for Patient
     """
-    def setUp(self):
-
+    @classmethod
+    def setUpTestData(cls):
+        # Created once for the class; every test rolls back to this state
+        password = make_password("Password8080")
         user_one_kwargs = {
             "username": "UserOne",
             "first_name": "User",
             "last_name": "One",
             "email": 'user.one@umed.io',
-            "password": make_password("Password8080"),
+            "password": password,
             "is_active": True,
         }
         user_two_kwargs = {
@@ -25,7 +27,7 @@ class ContactTestCase(TestCase):
             "first_name": "User",
             "last_name": "Two",
             "email": 'user.two@umed.io',
-            "password": make_password("Password8080"),
+            "password": password,
             "is_active": True,
         }
         user_three_kwargs = {
@@ -33,7 +35,7 @@ class ContactTestCase(TestCase):
             "first_name": "User",
             "last_name": "Three",
             "email": 'user.three@umed.io',
-            "password": make_password("Password8080"),
+            "password": password,
             "is_active": True,
         }
         user_one = User.objects.create(**user_one_kwargs)
@@ -42,15 +44,14 @@ class ContactTestCase(TestCase):
         study_a = Study.objects.create(name="Study A")
         study_b = Study.objects.create(name="Study B")
         study_c = Study.objects.create(name="Study C")
-        self.patient_one = Patient.objects.create(user = user_one, study = study_a, status=0, cancelled=0)
-        self.patient_two = Patient.objects.create(user = user_two, study = study_b, status=0, cancelled=0)
-        self.patient_three = Patient.objects.create(user = user_three, study = study_c, status=0, cancelled=0)
-        self.patients = [self.patient_one, self.patient_two, self.patient_three]
+        cls.patient_one = Patient.objects.create(user = user_one, study = study_a, status=0, cancelled=0)
+        cls.patient_two = Patient.objects.create(user = user_two, study = study_b, status=0, cancelled=0)
+        cls.patient_three = Patient.objects.create(user = user_three, study = study_c, status=0, cancelled=0)
+        cls.patients = [cls.patient_one, cls.patient_two, cls.patient_three]
 
     def test_in_study(self):
         '''
         test Managers
         '''
         for patient in self.patients:
-            self.assertEqual(patient.in_study, True)
-
+            self.assertEqual(patient.in_study(), True)
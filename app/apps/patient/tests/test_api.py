@@ -0,0 +1,80 @@
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.patient.cache import patients
+from apps.patient.models import Campaign, CampaignShard, Patient
+from apps.study.models import Study
+
+
+class PatientAPITestCase(TestCase):
+
+    """
+    Test suite for the async patient API
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.study = Study.objects.create(name="Study A")
+        cls.patient = Patient.objects.create(
+            user=User.objects.create(username="user0", email="user0@umed.io"), study=cls.study
+        )
+        Patient.objects.create(
+            user=User.objects.create(username="user1", email="user1@umed.io"), study=cls.study, status=10, cancelled=30
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_eligibility(self):
+        response = await self.async_client.get(reverse("patient:eligibility", args=[self.patient.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["eligible"], True)
+        self.assertEqual(response.json()["status"], "New")
+
+    async def test_eligibility_not_found(self):
+        response = await self.async_client.get(reverse("patient:eligibility", args=[uuid.uuid4()]))
+        self.assertEqual(response.status_code, 404)
+
+    async def test_eligibility_is_cached(self):
+        '''
+        Repeat polls are answered from the cache, and bulk updates retire it
+        '''
+        url = reverse("patient:eligibility", args=[self.patient.id])
+        await self.async_client.get(url)
+        hits = patients.stats()["local_hits"]
+        self.assertEqual((await self.async_client.get(url)).json()["eligible"], True)
+        self.assertEqual(patients.stats()["local_hits"], hits + 1)
+        await Patient.objects.filter(id=self.patient.id).aupdate(cancelled=30)
+        self.assertEqual((await self.async_client.get(url)).json()["eligible"], False)
+
+    async def test_study_status_counts(self):
+        response = await self.async_client.get(reverse("patient:study-status-counts", args=[self.study.id]))
+        data = response.json()
+        self.assertEqual(data["patients"], 2)
+        self.assertEqual(data["status"], {"New": 1, "Engaged": 1, "Consented": 0, "Complete": 0})
+        self.assertEqual(data["cancelled"]["Opted out"], 1)
+
+    async def test_campaign_progress(self):
+        now = timezone.now()
+        campaign = await Campaign.objects.acreate(
+            window_start=now, window_end=now + timedelta(hours=1), recipients=4, sent=1, suppressed=1
+        )
+        await CampaignShard.objects.acreate(
+            campaign=campaign, study=self.study, lower=uuid.uuid4(), upper=uuid.uuid4(), size=2,
+            planned_at=now, dispatched_at=now, completed_at=now,
+        )
+        await CampaignShard.objects.acreate(
+            campaign=campaign, study=self.study, lower=uuid.uuid4(), upper=uuid.uuid4(), size=2, planned_at=now,
+        )
+        data = (await self.async_client.get(reverse("patient:campaign-progress", args=[campaign.id]))).json()
+        self.assertEqual(data["progress"], 0.5)
+        self.assertEqual(data["shards"], {"total": 2, "dispatched": 1, "completed": 1})
+
+    async def test_read_only(self):
+        response = await self.async_client.post(reverse("patient:eligibility", args=[self.patient.id]))
+        self.assertEqual(response.status_code, 405)
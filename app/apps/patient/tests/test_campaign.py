@@ -0,0 +1,168 @@
+import smtplib
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase, override_settings
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from apps.patient.campaign import claim_shard, plan_shards, record_shard_result
+from apps.patient.models import Campaign, CampaignShard, Patient
+from apps.patient.tasks import COORDINATOR_LEASE, SHARD_LEASE, bulk_email, send_email_shard
+from apps.study.models import Study
+from core.celery import app
+from libs.locks import LeaseLock
+from tasks.models import Suppression
+from tasks.suppression import index as suppression_index
+
+
+class CampaignTestCase(TestCase):
+
+    """
+    Test suite for the sharded campaign fan-out
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.study_a = Study.objects.create(name="Study A")
+        cls.study_b = Study.objects.create(name="Study B")
+        for i in range(7):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@umed.io")
+            Patient.objects.create(user=user, study=cls.study_a if i < 5 else cls.study_b)
+        # Not eligible, must never be emailed
+        user = User.objects.create(username="cancelled", email="cancelled@umed.io")
+        Patient.objects.create(user=user, study=cls.study_a, cancelled=30)
+
+    def setUp(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+
+    def test_plan_shards(self):
+        '''
+        Shards respect the size limit, never span studies and cover everyone
+        '''
+        shards = plan_shards(Patient.objects.in_study(), shard_size=2)
+        self.assertEqual(sum(shard["size"] for shard in shards), 7)
+        self.assertTrue(all(shard["size"] <= 2 for shard in shards))
+        for shard in shards:
+            ids = Patient.objects.in_study().filter(
+                study_id=shard["study_id"], id__gte=shard["lower"], id__lte=shard["upper"]
+            )
+            self.assertEqual(ids.count(), shard["size"])
+
+    def test_bulk_email(self):
+        '''
+        The coordinator sends exactly one email per eligible patient
+        '''
+        result = bulk_email.delay(shard_size=2, window_hours=0)
+        self.assertEqual(result.get()["shards"], 4)
+        recipients = sorted(message.to[0] for message in mail.outbox)
+        self.assertEqual(recipients, sorted(f"user{i}@umed.io" for i in range(7)))
+
+    def test_run_planned_once(self):
+        '''
+        A second coordinator for the same run (e.g. beat on two hosts) sends
+        nothing
+        '''
+        bulk_email.delay(shard_size=2, window_hours=0, run_key="2026-01-01")
+        result = bulk_email.delay(shard_size=2, window_hours=0, run_key="2026-01-01")
+        self.assertEqual(result.get(), {"skipped": "2026-01-01"})
+        self.assertEqual(Campaign.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 7)
+
+    def test_run_key_is_not_taken_without_shards(self):
+        '''
+        A coordinator that dies while recording a campaign leaves the run to
+        the next one
+        '''
+        with mock.patch.object(CampaignShard.objects, "bulk_create", side_effect=RuntimeError("killed")), \
+                mock.patch("celery.app.trace.logger"):
+            with self.assertRaises(RuntimeError):
+                bulk_email.delay(shard_size=2, window_hours=1, run_key="2026-01-01").get()
+        self.assertFalse(Campaign.objects.exists())
+        result = bulk_email.delay(shard_size=2, window_hours=1, run_key="2026-01-01")
+        self.assertEqual(result.get()["shards"], 4)
+
+    def test_coordinator_lease_held(self):
+        with LeaseLock(COORDINATOR_LEASE):
+            result = bulk_email.delay(shard_size=2, window_hours=0)
+        self.assertIn("skipped", result.get())
+        self.assertFalse(Campaign.objects.exists())
+
+    def test_lease_outage_is_retried(self):
+        '''
+        A coordinator that cannot reach the lease's Redis runs again later
+        '''
+        acquire = LeaseLock.acquire
+        calls = []
+
+        def flaky(lease, *args, **kwargs):
+            calls.append(lease.name)
+            if len(calls) == 1:
+                raise RedisConnectionError("Connection refused")
+            return acquire(lease, *args, **kwargs)
+
+        with mock.patch.object(LeaseLock, "acquire", flaky):
+            result = bulk_email.delay(shard_size=2, window_hours=0)
+        self.assertEqual(result.get()["shards"], 4)
+        self.assertEqual(calls[:2], [COORDINATOR_LEASE, COORDINATOR_LEASE])
+        self.assertEqual(len(mail.outbox), 7)
+
+    def test_shard_lease(self):
+        '''
+        A duplicate shard task skips the shard while the lease is held, and
+        once it has completed
+        '''
+        bulk_email.delay(shard_size=2, window_hours=1)
+        shard = Campaign.objects.get().shards.first()
+        args = (str(shard.study_id), str(shard.lower), str(shard.upper))
+        with LeaseLock(SHARD_LEASE.format(shard.id)):
+            result = send_email_shard.delay(*args, shard_id=shard.id).get()
+        self.assertIn("skipped", result)
+        self.assertEqual(len(mail.outbox), 0)
+
+        send_email_shard.delay(*args, shard_id=shard.id)
+        send_email_shard.delay(*args, shard_id=shard.id)
+        self.assertEqual(len(mail.outbox), shard.size)
+
+    @override_settings(EMAIL_RETRY_MAX=2)
+    def test_resumed_shard_keeps_its_counts(self):
+        '''
+        A shard retried part way through records the outcomes of both runs
+        '''
+        bulk_email.delay(shard_size=5, window_hours=1)
+        shard = Campaign.objects.get().shards.get(study=self.study_a)
+        Suppression.objects.suppress("user0@umed.io", "bounced")
+        suppression_index.load()
+        self.addCleanup(suppression_index.load)
+        failed = []
+
+        def send_messages(messages):
+            if messages[0].to[0] == "user3@umed.io" and not failed:
+                failed.append(None)
+                raise smtplib.SMTPSenderRefused(550, b"Not ours", "x@umed.io")
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        args = (str(shard.study_id), str(shard.lower), str(shard.upper))
+        with mock.patch("django.core.mail.backends.locmem.EmailBackend.send_messages", side_effect=send_messages):
+            result = send_email_shard.delay(*args, shard_id=shard.id).get()
+        self.assertEqual((result["sent"], result["suppressed"]), (4, 1))
+        shard.refresh_from_db()
+        self.assertEqual((shard.sent, shard.suppressed), (4, 1))
+        self.assertEqual(len(mail.outbox), 4)
+
+    def test_fencing(self):
+        '''
+        A holder whose lease was taken over cannot claim the shard or store
+        its result
+        '''
+        bulk_email.delay(shard_size=2, window_hours=1)
+        shard = Campaign.objects.get().shards.first()
+        self.assertTrue(claim_shard(shard.id, 1))
+        self.assertTrue(claim_shard(shard.id, 2))
+        self.assertFalse(claim_shard(shard.id, 1))
+        self.assertFalse(record_shard_result(shard.id, {"sent": 2}, fence=1))
+        self.assertTrue(record_shard_result(shard.id, {"sent": 2}, fence=2))
+        shard.refresh_from_db()
+        self.assertEqual((shard.sent, shard.fence), (2, 2))
+        self.assertFalse(claim_shard(shard.id, 3))
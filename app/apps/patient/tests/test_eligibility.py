@@ -0,0 +1,124 @@
+import random
+from itertools import product
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+
+from apps.patient import eligibility
+from apps.patient.eligibility import DEFAULT, Rule
+from apps.patient.models import Patient
+from apps.study.models import EligibilityRule, Study
+from tasks.tasks import create_email
+
+STATUSES = [0, 10, 20, 30]
+CANCELLATIONS = [0, 10, 20, 30, 40]
+
+
+def random_rule(rng):
+    return Rule.of(
+        rng.sample(STATUSES, rng.randint(0, len(STATUSES))),
+        rng.sample(CANCELLATIONS, rng.randint(0, len(CANCELLATIONS))),
+        rng.choice([None, 0, 1, 2, 3]),
+    )
+
+
+class EligibilityTestCase(TestCase):
+
+    """
+    Test suite for the eligibility rule engine
+    """
+    @classmethod
+    def setUpTestData(cls):
+        # Every combination of status, cancellation and send count in each study
+        cls.studies = Study.objects.bulk_create([Study(name=f"Study {i}") for i in range(4)])
+        combinations = list(product(STATUSES, CANCELLATIONS, range(4)))
+        User.objects.bulk_create([
+            User(username=f"user{i}", email=f"user{i}@umed.io") for i in range(len(combinations) * len(cls.studies))
+        ])
+        users = iter(User.objects.order_by("id").values_list("id", flat=True))
+        Patient.objects.bulk_create([
+            Patient(user_id=next(users), study=study, status=status, cancelled=cancelled, emails_sent=sent)
+            for study in cls.studies
+            for status, cancelled, sent in combinations
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.patients = list(Patient.objects.all())
+
+    def sql(self, rules):
+        return set(Patient.objects.filter(eligibility.q(rules)).values_list("id", flat=True))
+
+    def test_default_rule(self):
+        '''
+        Studies without a rule keep the original behaviour: new and not cancelled
+        '''
+        expected = {p.id for p in self.patients if p.status == 0 and p.cancelled == 0}
+        self.assertEqual(set(Patient.objects.in_study().values_list("id", flat=True)), expected)
+        self.assertEqual({p.id for p in self.patients if p.in_study()}, expected)
+        self.assertEqual(eligibility.rule_for(self.studies[0].id), DEFAULT)
+
+    def test_sql_and_memory_agree(self):
+        '''
+        Property: for random rule sets, the SQL predicate, the batch evaluator
+        and the per-instance check select exactly the same patients
+        '''
+        for seed in range(50):
+            rng = random.Random(seed)
+            ruled = rng.sample(self.studies, rng.randint(0, len(self.studies)))
+            rules = {str(study.id): random_rule(rng) for study in ruled}
+            in_memory = {p.id for p in eligibility.select(self.patients, rules)}
+            one_by_one = {
+                p.id for p in self.patients
+                if eligibility.is_eligible(p.study_id, p.status, p.cancelled, p.emails_sent, rules)
+            }
+            self.assertEqual(self.sql(rules), in_memory, f"seed {seed}: {rules}")
+            self.assertEqual(in_memory, one_by_one, f"seed {seed}: {rules}")
+
+    def test_stored_rules(self):
+        '''
+        Saved rules take effect straight away in both forms
+        '''
+        study = self.studies[0]
+        EligibilityRule.objects.create(study=study, statuses=[0, 10], excluded_cancellations=[30], send_cap=2)
+        expected = {
+            p.id for p in self.patients
+            if (p.study_id == study.id and p.status in (0, 10) and p.cancelled != 30 and p.emails_sent < 2)
+            or (p.study_id != study.id and p.status == 0 and p.cancelled == 0)
+        }
+        self.assertEqual(set(Patient.objects.in_study().values_list("id", flat=True)), expected)
+        self.assertEqual({p.id for p in self.patients if p.in_study()}, expected)
+
+        study.eligibility_rule.delete()
+        self.assertEqual(eligibility.rule_for(study.id), DEFAULT)
+
+    def test_one_query(self):
+        '''
+        However many studies have rules, selection is one query
+        '''
+        for study in self.studies:
+            EligibilityRule.objects.create(study=study, send_cap=study.name.endswith("0") and 1 or None)
+        eligibility.load_rules()
+        with self.assertNumQueries(1):
+            list(Patient.objects.in_study())
+
+    def test_send_email_guard(self):
+        '''
+        send_email skips ineligible patients and counts the emails it queues
+        '''
+        EligibilityRule.objects.create(study=self.studies[0], send_cap=1)
+        eligible = Patient.objects.select_related("user").get(
+            study=self.studies[0], status=0, cancelled=0, emails_sent=0
+        )
+        opted_out = Patient.objects.select_related("user").get(
+            study=self.studies[0], status=0, cancelled=30, emails_sent=0
+        )
+        with mock.patch.object(create_email, "delay") as delay:
+            opted_out.send_email()
+            eligible.send_email()
+            # The send cap is reached
+            eligible.send_email()
+        self.assertEqual(delay.call_count, 1)
+        self.assertEqual(Patient.objects.get(id=eligible.id).emails_sent, 1)
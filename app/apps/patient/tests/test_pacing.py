@@ -0,0 +1,111 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from apps.patient.models import Campaign, CampaignShard, Patient
+from apps.patient.pacing import next_dispatch, plan
+from apps.patient.tasks import bulk_email, pace_campaigns
+from apps.study.models import Study
+from core.celery import app
+
+
+def shards(*sizes):
+    return [SimpleNamespace(size=size, planned_at=None) for size in sizes]
+
+
+@override_settings(CAMPAIGN_PACING_TICK=60, CAMPAIGN_MAX_IN_FLIGHT=100)
+class PacingTestCase(TestCase):
+
+    """
+    Test suite for spreading campaigns across their delivery window
+    """
+    def setUp(self):
+        self.start = timezone.now()
+        self.end = self.start + timedelta(hours=1)
+
+    def test_plan_spreads_recipients_evenly(self):
+        planned = plan(shards(10, 10, 20, 10), self.start, self.end)
+        offsets = [(shard.planned_at - self.start).total_seconds() for shard in planned]
+        self.assertEqual(offsets, [0, 720, 1440, 2880])
+
+    def test_one_tick_share_of_the_remaining_recipients(self):
+        # 60 shards of 10 over an hour: one shard a minute
+        pending = shards(*[10] * 60)
+        self.assertEqual(len(next_dispatch(pending, 0, self.start, self.end, self.start)), 1)
+
+    def test_catches_up_when_behind(self):
+        # Half the window gone and nothing sent: two shards a minute
+        pending = shards(*[10] * 60)
+        halfway = self.start + timedelta(minutes=30)
+        self.assertEqual(len(next_dispatch(pending, 0, self.start, self.end, halfway)), 2)
+
+    def test_holds_back_while_shards_run_slow(self):
+        pending = shards(*[10] * 60)
+        self.assertEqual(next_dispatch(pending, 3, self.start, self.end, self.start, max_in_flight=3), [])
+
+    def test_window_edges(self):
+        pending = shards(10, 10)
+        self.assertEqual(next_dispatch(pending, 0, self.start, self.end, self.start - timedelta(seconds=1)), [])
+        self.assertEqual(len(next_dispatch(pending, 50, self.start, self.end, self.end)), 2)
+
+    def test_overrun_is_spread_by_the_in_flight_limit(self):
+        pending = shards(*[10] * 20)
+        late = self.end + timedelta(minutes=5)
+        self.assertEqual(len(next_dispatch(pending, 1, self.start, self.end, late, max_in_flight=4)), 3)
+        self.assertEqual(next_dispatch(pending, 4, self.start, self.end, late, max_in_flight=4), [])
+
+
+class PacedCampaignTestCase(TestCase):
+
+    """
+    Test suite for the beat-driven campaign drip
+    """
+    @classmethod
+    def setUpTestData(cls):
+        study = Study.objects.create(name="Study A")
+        for i in range(6):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@umed.io")
+            Patient.objects.create(user=user, study=study)
+
+    def setUp(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+
+    def test_paced_campaign(self):
+        bulk_email.delay(shard_size=2, window_hours=1)
+        campaign = Campaign.objects.get()
+        self.assertEqual((campaign.recipients, campaign.shards.count()), (6, 3))
+        self.assertEqual(len(mail.outbox), 0)
+
+        pace_campaigns.delay()
+        self.assertEqual(len(mail.outbox), 2)
+
+        # The window has run out: everything left goes now
+        Campaign.objects.update(window_end=timezone.now())
+        pace_campaigns.delay()
+        self.assertEqual(len(mail.outbox), 6)
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.status, campaign.sent), (20, 6))
+
+    @override_settings(CAMPAIGN_SHARD_TIMEOUT=600)
+    def test_lost_shard_is_dispatched_again(self):
+        bulk_email.delay(shard_size=2, window_hours=1)
+        campaign = Campaign.objects.get()
+        # Dispatched long ago and never started: its task was lost
+        lost = campaign.shards.first()
+        CampaignShard.objects.filter(id=lost.id).update(dispatched_at=timezone.now() - timedelta(hours=1))
+        # A quiet shard that still reported recently is left alone
+        quiet = campaign.shards.last()
+        CampaignShard.objects.filter(id=quiet.id).update(
+            dispatched_at=timezone.now() - timedelta(hours=1), heartbeat_at=timezone.now(),
+        )
+
+        pace_campaigns.delay()
+        lost.refresh_from_db()
+        self.assertIsNotNone(lost.completed_at)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertIsNone(CampaignShard.objects.get(id=quiet.id).completed_at)
@@ -0,0 +1,80 @@
+from unittest import mock
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+
+from apps.patient.models import Patient
+from apps.study.models import Study
+from libs.testing import PerformanceTestMixin
+from tasks.suppression import index as suppression_index
+from tasks.tasks import create_email, send_email_batch
+
+
+class PatientHotPathsMixin(PerformanceTestMixin):
+
+    """
+    Query-count and wall-time budgets for the Patient hot paths. Budgets do
+    not depend on the number of rows, so a per-row query fails the test.
+    Subclasses set ``rows``.
+    """
+    rows = None
+    studies = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        password = make_password(None)
+        studies = Study.objects.bulk_create([Study(name=f"Study {i}") for i in range(cls.studies)])
+        User.objects.bulk_create(
+            [User(username=f"user{i}", email=f"user{i}@umed.io", password=password) for i in range(cls.rows)]
+        )
+        Patient.objects.bulk_create([
+            Patient(user_id=user_id, study=studies[i % cls.studies])
+            for i, user_id in enumerate(User.objects.order_by("id").values_list("id", flat=True))
+        ])
+        cls.admin = User.objects.create_superuser("admin", "admin@umed.io", None)
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+        suppression_index.load()
+
+    def test_changelist(self):
+        with self.assertMaxQueries(8), self.assertMaxDuration(1):
+            response = self.client.get(reverse("admin:patient_patient_changelist"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_send_email_button(self):
+        # "Select all N patients" in the changelist
+        data = {
+            "action": "send_email_button",
+            "select_across": 1,
+            "index": 0,
+            "_selected_action": [Patient.objects.values_list("id", flat=True).first()],
+        }
+        with mock.patch.object(send_email_batch, "apply_async") as apply_async:
+            # session, user, per-study header and send count, then one query to read the recipients
+            with self.assertMaxQueries(5 + 2 * self.studies), self.assertMaxDuration(2):
+                self.client.post(reverse("admin:patient_patient_changelist"), data)
+        batched = sum(len(call.kwargs["args"][0]["r"]) for call in apply_async.call_args_list)
+        self.assertEqual(batched, self.rows)
+
+    def test_send_email(self):
+        patients = Patient.objects.select_related("user", "study")[:10]
+        with mock.patch.object(create_email, "delay") as delay:
+            # The patients, then one UPDATE of their send counts
+            with self.assertMaxQueries(2), self.assertMaxDuration(0.1):
+                Patient.objects.send_emails(patients)
+        self.assertEqual(delay.call_count, len(patients))
+
+
+class PatientHotPaths10TestCase(PatientHotPathsMixin, TestCase):
+    rows = 10
+
+
+class PatientHotPaths1kTestCase(PatientHotPathsMixin, TestCase):
+    rows = 1000
+
+
+class PatientHotPaths10kTestCase(PatientHotPathsMixin, TestCase):
+    rows = 10000
@@ -0,0 +1,186 @@
+import asyncio
+import threading
+import time
+import uuid
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from apps.patient import tracking, views
+from apps.patient.models import EngagementStat, Patient
+from apps.patient.views import tracking_shortcut
+from libs.buffers import MemoryBuffer
+from libs.locks import LeaseLock
+from apps.study.models import Study
+from tasks.rendering import render_cache
+
+
+@override_settings(TRACKING_BATCH_SIZE=1000, TRACKING_FLUSH_SECONDS=3600, TRACKING_ENGAGE_ON="click")
+class TrackingTestCase(TestCase):
+
+    """
+    Test suite for email open/click tracking
+    """
+    def setUp(self):
+        tracking.buffer.drain(10 ** 6)
+        self.study = Study.objects.create(name="Study A")
+        self.patient = Patient.objects.create(
+            user=User.objects.create(username="user0", email="user0@umed.io"), study=self.study
+        )
+        self.token = tracking.token(self.patient.id)
+
+    def test_token(self):
+        self.assertEqual(tracking.patient_for(self.token), self.patient.id.hex)
+        self.assertIsNone(tracking.patient_for(self.token[:-1] + ("A" if self.token[-1] != "A" else "B")))
+        self.assertIsNone(tracking.patient_for("not-a-token"))
+
+    def test_email_links(self):
+        html, _ = render_cache.render(
+            "tasks/patient_email.html", self.patient.email_context(), settings.EMAIL_RENDER_SLOTS
+        )
+        base = settings.TRACKING_BASE_URL
+        self.assertIn(base + reverse("patient:track-open", args=[self.token]), html)
+        self.assertIn(base + reverse("patient:track-click", args=[self.token]), html)
+
+    @override_settings(TRACKING_BASE_URL="")
+    def test_untracked_email(self):
+        html, _ = render_cache.render(
+            "tasks/patient_email.html", self.patient.email_context(), settings.EMAIL_RENDER_SLOTS
+        )
+        self.assertIn('href="https://umed.io"', html)
+        self.assertNotIn("<img", html)
+
+    async def test_endpoints_only_buffer(self):
+        response = await self.async_client.get(reverse("patient:track-open", args=[self.token]))
+        self.assertEqual((response.status_code, response["Content-Type"]), (200, "image/gif"))
+        response = await self.async_client.get(reverse("patient:track-click", args=[self.token]))
+        self.assertEqual((response.status_code, response["Location"]), (302, settings.TRACKING_CLICK_URL))
+        # A forged token is answered, not recorded
+        response = await self.async_client.get(reverse("patient:track-click", args=["forged.token"]))
+        self.assertEqual(response.status_code, 302)
+
+        events = tracking.buffer.drain(10)
+        self.assertEqual([event[:2] for event in events], [
+            [tracking.OPEN, self.patient.id.hex], [tracking.CLICK, self.patient.id.hex],
+        ])
+
+    async def test_head_is_answered_not_recorded(self):
+        '''
+        Link scanners and prefetchers probe with HEAD, which is no open or
+        click
+        '''
+        response = await self.async_client.head(reverse("patient:track-open", args=[self.token]))
+        self.assertEqual(response.status_code, 200)
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "HEAD", "path": reverse("patient:track-click", args=[self.token])}
+        await tracking_shortcut(None)(scope, None, send)
+        self.assertEqual(sent[0]["status"], 302)
+        self.assertEqual(tracking.buffer.drain(10), [])
+
+    async def test_shared_buffer_is_appended_to_off_the_event_loop(self):
+        threads = []
+
+        class SharedBuffer:
+            def append(self, events):
+                threads.append(threading.current_thread())
+                return 1
+
+            def age(self):
+                return 0
+
+        with mock.patch.object(tracking, "buffer", SharedBuffer()):
+            await self.async_client.get(reverse("patient:track-open", args=[self.token]))
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    async def test_memory_buffer_is_flushed_on_a_timer(self):
+        self.assertIsInstance(tracking.buffer, MemoryBuffer)
+        await self.async_client.get(reverse("patient:track-open", args=[self.token]))
+        loop, timer = views._timer
+        self.addCleanup(timer.cancel)
+        self.assertIs(loop, asyncio.get_running_loop())
+        self.assertAlmostEqual(timer.when() - loop.time(), 3600, delta=5)
+
+    @override_settings(TRACKING_BATCH_SIZE=1)
+    async def test_flush_that_loses_the_race_is_retried_on_the_timer(self):
+        with LeaseLock(tracking.FLUSH_LEASE):
+            await self.async_client.get(reverse("patient:track-open", args=[self.token]))
+            await views._flush
+            # Let the flush's done callback run
+            await asyncio.sleep(0)
+        self.assertEqual(len(tracking.buffer), 1)
+        loop, timer = views._timer
+        self.addCleanup(timer.cancel)
+        self.assertIs(loop, asyncio.get_running_loop())
+        self.assertFalse(timer.cancelled())
+
+    async def test_asgi_shortcut(self):
+        '''
+        Tracking hits are answered without reaching Django, anything else
+        passes through
+        '''
+        passed, sent = [], []
+
+        async def django(scope, receive, send):
+            passed.append(scope["path"])
+
+        async def send(message):
+            sent.append(message)
+
+        application = tracking_shortcut(django)
+        for path in (
+            reverse("patient:track-open", args=[self.token]),
+            reverse("patient:track-click", args=[self.token]),
+            reverse("patient:eligibility", args=[self.patient.id]),
+        ):
+            await application({"type": "http", "method": "GET", "path": path}, None, send)
+        self.assertEqual(passed, [reverse("patient:eligibility", args=[self.patient.id])])
+        self.assertEqual([m["status"] for m in sent if m["type"] == "http.response.start"], [200, 302])
+        self.assertEqual(len(tracking.buffer.drain(10)), 2)
+
+    def test_flush(self):
+        '''
+        Events fold into one row per patient, added to on later flushes, and
+        a click moves a New patient to Engaged
+        '''
+        patient_id = self.patient.id.hex
+        tracking.record(tracking.OPEN, patient_id)
+        tracking.record(tracking.OPEN, patient_id)
+        tracking.record(tracking.OPEN, uuid.uuid4().hex)
+        with self.assertNumQueries(3):
+            self.assertEqual(tracking.flush(), 3)
+        stat = EngagementStat.objects.get()
+        self.assertEqual((stat.opens, stat.clicks, stat.first_clicked), (2, 0, None))
+        self.assertEqual(Patient.objects.get().status, 0)
+
+        tracking.record(tracking.CLICK, patient_id)
+        tracking.flush()
+        stat.refresh_from_db()
+        self.assertEqual((stat.opens, stat.clicks), (2, 1))
+        self.assertLess(stat.first_opened, stat.first_clicked)
+        self.assertEqual(Patient.objects.get().status, 10)
+
+    @override_settings(TRACKING_ENGAGE_ON="")
+    def test_engagement_off(self):
+        tracking.record(tracking.CLICK, self.patient.id.hex)
+        tracking.flush()
+        self.assertEqual(Patient.objects.get().status, 0)
+
+    def test_aggregate(self):
+        now = float(int(time.time()))
+        totals = tracking.aggregate([
+            [tracking.OPEN, self.patient.id.hex, now],
+            [tracking.CLICK, self.patient.id.hex, now + 2],
+            [tracking.OPEN, self.patient.id.hex, now - 1],
+        ])
+        total = totals[self.patient.id]
+        self.assertEqual((total["opens"], total["clicks"]), (2, 1))
+        self.assertEqual(total["first_opened"].timestamp(), now - 1)
+        self.assertEqual(total["last_seen"].timestamp(), now + 2)
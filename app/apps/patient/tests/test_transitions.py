@@ -0,0 +1,144 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import NotSupportedError, connection
+from django.db.models import F
+from django.test import TestCase, override_settings
+
+from apps.patient import transitions
+from apps.patient.models import Patient, PatientTransition
+from apps.study.models import Study
+
+
+class TransitionTestCase(TestCase):
+
+    """
+    Test suite for the batched patient transition history
+    """
+    def setUp(self):
+        self.addCleanup(transitions.buffer.drain, 10 ** 6)
+        self.study = Study.objects.create(name="Study A")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patients = [
+                Patient.objects.create(
+                    user=User.objects.create(username=f"user{i}", email=f"user{i}@umed.io"), study=self.study
+                )
+                for i in range(3)
+            ]
+        transitions.flush()
+
+    def rows(self, **filters):
+        return list(
+            PatientTransition.objects.filter(**filters).order_by("id").values_list("field", "old", "new", "source")
+        )
+
+    def test_create(self):
+        self.assertEqual(self.rows(), [(0, None, 0, 0)] * 3)
+        transition = PatientTransition.objects.first()
+        self.assertEqual(transition.month, transition.at.year * 100 + transition.at.month)
+
+    def test_bulk_create_ignoring_conflicts(self):
+        '''
+        Only the rows bulk_create actually inserted get a CREATE transition
+        '''
+        user = User.objects.create(username="user3", email="user3@umed.io")
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.bulk_create(
+                [Patient(user=self.patients[0].user, study=self.study), Patient(user=user, study=self.study)],
+                ignore_conflicts=True,
+            )
+        transitions.flush()
+        self.assertEqual(Patient.objects.count(), 4)
+        self.assertEqual(self.rows(), [(0, None, 0, 0)] * 4)
+        self.assertFalse(PatientTransition.objects.exclude(patient_id__in=Patient.objects.values("id")).exists())
+
+    def test_save(self):
+        patient = Patient.objects.get(id=self.patients[0].id)
+        with self.captureOnCommitCallbacks(execute=True):
+            patient.status = 10
+            patient.save()
+            # Unchanged fields and repeat saves record nothing
+            patient.save()
+        transitions.flush()
+        self.assertEqual(self.rows(patient=patient, source=1), [(0, 0, 10, 1)])
+
+    def test_bulk_update(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.filter(id__in=[p.id for p in self.patients[:2]]).update(cancelled=30)
+            Patient.objects.update(status=F("status") + 10)
+        transitions.flush()
+        self.assertEqual(self.rows(source=2, field=1), [(1, 0, 30, 2)] * 2)
+        self.assertEqual(self.rows(source=2, field=0), [(0, 0, 10, 2)] * 3)
+
+    def test_bulk_update_objects(self):
+        patients = list(Patient.objects.all())
+        for patient in patients:
+            patient.status = 20
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.bulk_update(patients, ["status"])
+        transitions.flush()
+        self.assertEqual(self.rows(source=2), [(0, 0, 20, 2)] * 3)
+
+    def test_rollback_records_nothing(self):
+        with self.captureOnCommitCallbacks(execute=False):
+            Patient.objects.update(status=10)
+        self.assertEqual(len(transitions.buffer), 0)
+
+    @override_settings(TRANSITION_BATCH_SIZE=2)
+    def test_batches(self):
+        '''
+        Events wait in the buffer until a batch is full, then are written one
+        INSERT per batch
+        '''
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.filter(id=self.patients[0].id).update(status=10)
+        self.assertEqual(len(transitions.buffer), 1)
+        self.assertFalse(PatientTransition.objects.filter(source=2).exists())
+        with self.assertNumQueries(2), self.captureOnCommitCallbacks(execute=True):
+            transitions.record(transitions.buffer.drain(1) * 3)
+        self.assertEqual(len(transitions.buffer), 0)
+        self.assertEqual(PatientTransition.objects.filter(source=2).count(), 3)
+
+    @override_settings(TRANSITION_BATCH_SIZE=100)
+    def test_exit_flush_needs_an_open_connection(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.update(status=10)
+        # After a test database is torn down: the events must not go anywhere else
+        with mock.patch.object(connection, "connection", None), \
+                mock.patch.object(transitions, "flush") as flush, \
+                self.assertLogs("apps.patient.transitions", "WARNING"):
+            transitions.flush_at_exit()
+        flush.assert_not_called()
+        transitions.flush_at_exit()
+        self.assertEqual(len(transitions.buffer), 0)
+        self.assertEqual(PatientTransition.objects.filter(source=2).count(), 3)
+
+    def test_append_only(self):
+        transition = PatientTransition.objects.first()
+        with self.assertRaises(NotSupportedError):
+            transition.save()
+        with self.assertRaises(NotSupportedError):
+            PatientTransition.objects.all().delete()
+        with self.assertRaises(NotSupportedError):
+            PatientTransition.objects.update(new=20)
+
+    def test_patient_delete_keeps_history(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.filter(id=self.patients[0].id).delete()
+        self.assertEqual(PatientTransition.objects.filter(patient_id=self.patients[0].id).count(), 1)
+
+    def test_funnel(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.update(status=10)
+        transitions.flush()
+        PatientTransition.objects.bulk_create([
+            PatientTransition(
+                patient=transition.patient, study=self.study, field=0, old=0, new=20, source=1,
+                at=transition.at + timedelta(hours=1), month=transition.month,
+            )
+            for transition in PatientTransition.objects.filter(new=10)[:2]
+        ])
+        funnel = transitions.funnel(PatientTransition.objects.all())
+        self.assertEqual(funnel["New → Engaged"]["patients"], 3)
+        self.assertEqual(funnel["Engaged → Consented"], {"patients": 2, "mean_seconds": 3600.0})
@@ -0,0 +1,224 @@
+"""
+Email open and click tracking.
+
+Every campaign email carries a signed token for its patient in a 1x1 pixel
+and in its link (tracking_context()). The tracking endpoints only check the
+signature and append [kind, patient_id, timestamp] to a buffer, in this
+process or in Redis when TRACKING_BUFFER_URL is set, so a hit costs no
+database work.
+
+flush() drains the buffer in batches of TRACKING_BATCH_SIZE, folds each
+batch into per-patient totals and upserts them into EngagementStat with one
+bulk_create; patients who reached TRACKING_ENGAGE_ON are moved from New to
+Engaged with one bulk update, which records their transitions. It runs from
+the process that appends, once a batch is full or TRACKING_FLUSH_SECONDS old,
+and from the flush_engagement beat task. Flushes hold a lease so two never
+add to the same totals at once.
+
+The beat task runs in a worker, so it only sees events buffered in Redis:
+with more than one process, set TRACKING_BUFFER_URL. Without it each web
+process flushes its own buffer on a timer (see apps.patient.views).
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import atexit
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from uuid import UUID
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.signing import BadSignature, Signer
+from django.db import connection
+from django.urls import reverse
+from libs.buffers import MemoryBuffer, make_buffer
+from libs.locks import LeaseLock, LockHeld
+
+# --------------------------------------------------------------
+# 3rd party imports
+# --------------------------------------------------------------
+from asgiref.sync import sync_to_async
+
+# Event kinds
+OPEN = 0
+CLICK = 1
+KINDS = {"open": OPEN, "click": CLICK}
+
+FLUSH_LEASE = "engagement-flush"
+
+logger = logging.getLogger(__name__)
+
+signer = Signer(salt="umed.patient.tracking", sep=".")
+
+buffer = make_buffer(settings.TRACKING_BUFFER_URL, "umed:engagement-events")
+
+
+def token(patient_id) -> str:
+    return signer.sign(UUID(str(patient_id)).hex)
+
+
+def patient_for(value):
+    '''
+    The patient id a token was signed for, or None if it was tampered with
+    '''
+    try:
+        return signer.unsign(value)
+    except BadSignature:
+        return None
+
+
+def tracking_context(patient_id) -> dict:
+    '''
+    The email context for tracking a patient's email; empty when tracking
+    is off (no TRACKING_BASE_URL). tracking_url is the same for every
+    recipient, the pixel and link URLs are render slots.
+    '''
+    if not settings.TRACKING_BASE_URL:
+        return {}
+    return {"tracking_url": settings.TRACKING_BASE_URL, **tracking_urls(token(patient_id))}
+
+
+def tracking_urls(value) -> dict:
+    return {
+        "tracking_open_url": settings.TRACKING_BASE_URL + reverse("patient:track-open", args=[value]),
+        "tracking_click_url": settings.TRACKING_BASE_URL + reverse("patient:track-click", args=[value]),
+    }
+
+
+def record(kind, patient_id) -> bool:
+    '''
+    Buffer one event; returns whether the buffer is due a flush
+    '''
+    size = buffer.append([[kind, patient_id, time.time()]])
+    return size >= settings.TRACKING_BATCH_SIZE or buffer.age() >= settings.TRACKING_FLUSH_SECONDS
+
+
+async def arecord(kind, patient_id) -> bool:
+    '''
+    record() from the event loop; appending to Redis blocks, so it runs on
+    a thread
+    '''
+    if isinstance(buffer, MemoryBuffer):
+        return record(kind, patient_id)
+    return await sync_to_async(record, thread_sensitive=False)(kind, patient_id)
+
+
+def flush():
+    '''
+    Apply the buffered events; returns how many. Leaves them buffered while
+    another process is flushing.
+    '''
+    try:
+        with LeaseLock(FLUSH_LEASE) as lease:
+            applied = 0
+            while True:
+                lease.check()
+                events = buffer.drain(settings.TRACKING_BATCH_SIZE)
+                if not events:
+                    return applied
+                try:
+                    apply(events)
+                except Exception:
+                    # Keep them for the next flush rather than losing engagement
+                    buffer.append(events)
+                    raise
+                applied += len(events)
+                if len(events) < settings.TRACKING_BATCH_SIZE:
+                    return applied
+    except LockHeld:
+        return 0
+
+
+def flush_local():
+    '''
+    Apply the events in this process's memory buffer, e.g. before the
+    database they belong to is torn down
+    '''
+    if isinstance(buffer, MemoryBuffer) and len(buffer):
+        flush()
+
+
+@atexit.register
+def flush_at_exit():
+    '''
+    Events in a memory buffer die with the process, so apply them first,
+    over the database connection if it is still open (see
+    transitions.flush_at_exit())
+    '''
+    if not isinstance(buffer, MemoryBuffer) or not len(buffer):
+        return
+    if connection.connection is None:
+        logger.warning(f"Lost {len(buffer)} engagement events at exit: no open database connection")
+        return
+    try:
+        flush()
+    except Exception:
+        logger.exception(f"Lost {len(buffer)} engagement events at exit")
+
+
+def aggregate(events) -> dict:
+    '''
+    {patient_id: {"opens", "clicks", "first_opened", "first_clicked",
+    "last_seen"}} for a batch of events
+    '''
+    totals = defaultdict(lambda: {"opens": 0, "clicks": 0, "first_opened": None, "first_clicked": None, "last_seen": None})
+    for kind, patient_id, timestamp in events:
+        at = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+        total = totals[UUID(patient_id)]
+        counter, first = ("opens", "first_opened") if kind == OPEN else ("clicks", "first_clicked")
+        total[counter] += 1
+        total[first] = _earliest(total[first], at)
+        total["last_seen"] = at if total["last_seen"] is None else max(total["last_seen"], at)
+    return totals
+
+
+def apply(events):
+    '''
+    Add a batch of events to the patients' EngagementStat rows, one read and
+    one upsert, and advance newly engaged patients
+    '''
+    # Imported here as the models module imports this one
+    from apps.patient.models import EngagementStat, Patient
+
+    totals = aggregate(events)
+    # Tokens can outlive their patient
+    known = set(Patient.objects.filter(id__in=list(totals)).values_list("id", flat=True))
+    existing = EngagementStat.objects.in_bulk([patient_id for patient_id in totals if patient_id in known])
+    rows = []
+    for patient_id in known:
+        total, stat = totals[patient_id], existing.get(patient_id)
+        if stat is not None:
+            total["opens"] += stat.opens
+            total["clicks"] += stat.clicks
+            total["first_opened"] = _earliest(total["first_opened"], stat.first_opened)
+            total["first_clicked"] = _earliest(total["first_clicked"], stat.first_clicked)
+            total["last_seen"] = max(total["last_seen"], stat.last_seen)
+        rows.append(EngagementStat(patient_id=patient_id, **total))
+    EngagementStat.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["patient"],
+        update_fields=["opens", "clicks", "first_opened", "first_clicked", "last_seen"],
+    )
+
+    engaged = [row.patient_id for row in rows if _engaged(row)]
+    if engaged:
+        # Through PatientQuerySet.update, so the transitions are recorded
+        Patient.objects.filter(id__in=engaged, status=0).update(status=10)
+
+
+def _engaged(stat):
+    if settings.TRACKING_ENGAGE_ON == "click":
+        return stat.clicks > 0
+    if settings.TRACKING_ENGAGE_ON == "open":
+        return stat.opens > 0 or stat.clicks > 0
+    return False
+
+
+def _earliest(a, b):
+    return b if a is None else a if b is None else min(a, b)
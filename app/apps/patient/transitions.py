@@ -0,0 +1,207 @@
+"""
+History of patient status and cancelled changes.
+
+Saves, update(), bulk_update() and bulk_create() of patients append one
+compact event per changed field to a buffer once their transaction commits
+(in this process, or in Redis when TRANSITION_BUFFER_URL is set). flush()
+drains the buffer into PatientTransition rows with bulk_create, in batches
+of TRANSITION_BATCH_SIZE: from the process that appends, once a batch is
+full or TRANSITION_FLUSH_SECONDS old, and from the flush_transitions beat
+task for events other processes left in Redis.
+
+An event is [patient_id, study_id, field, old, new, source, timestamp];
+old is None when the patient was just created.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import atexit
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone as dt_timezone
+from itertools import groupby
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from libs.buffers import MemoryBuffer, make_buffer
+
+# Tracked fields and their codes
+STATUS = 0
+CANCELLED = 1
+TRACKED = {"status": STATUS, "cancelled": CANCELLED}
+
+# Where a change came from
+CREATE = 0
+SAVE = 1
+BULK = 2
+
+logger = logging.getLogger(__name__)
+
+buffer = make_buffer(settings.TRANSITION_BUFFER_URL, "umed:patient-transitions")
+
+
+def _event(patient_id, study_id, field, old, new, source, at):
+    return [str(patient_id), str(study_id), TRACKED[field], old, new, source, at.timestamp()]
+
+
+def record(events):
+    '''
+    Buffer ``events`` once the current transaction commits, so a rolled back
+    change leaves no history
+    '''
+    if not events:
+        return
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _append(events))
+    else:
+        _append(events)
+
+
+def _append(events):
+    size = buffer.append(events)
+    if size >= settings.TRANSITION_BATCH_SIZE or buffer.age() >= settings.TRANSITION_FLUSH_SECONDS:
+        flush()
+
+
+def loaded(patient):
+    '''
+    The tracked values a patient had when read from the database
+    '''
+    return {name: patient.__dict__[name] for name in TRACKED if name in patient.__dict__}
+
+
+def record_save(patient, adding, update_fields=None):
+    now = timezone.now()
+    before = getattr(patient, "_loaded", {})
+    events = []
+    for name in TRACKED:
+        if update_fields is not None and name not in update_fields:
+            continue
+        new = getattr(patient, name)
+        if adding:
+            if name == "cancelled" and new == 0:
+                continue
+            events.append(_event(patient.id, patient.study_id, name, None, new, CREATE, now))
+        elif before.get(name) != new:
+            events.append(_event(patient.id, patient.study_id, name, before.get(name), new, SAVE, now))
+        before[name] = new
+    patient._loaded = before
+    record(events)
+
+
+def record_created(patients):
+    now = timezone.now()
+    events = []
+    for patient in patients:
+        events.append(_event(patient.id, patient.study_id, "status", None, patient.status, CREATE, now))
+        if patient.cancelled:
+            events.append(_event(patient.id, patient.study_id, "cancelled", None, patient.cancelled, CREATE, now))
+        patient._loaded = loaded(patient)
+    record(events)
+
+
+def record_bulk(before, after, fields):
+    '''
+    Events for the rows of a bulk write. ``before`` holds (id, study_id,
+    *fields) rows read before the write, ``after`` maps id to the written
+    values of ``fields``.
+    '''
+    now = timezone.now()
+    events = []
+    for patient_id, study_id, *old in before:
+        new = after.get(patient_id)
+        if new is None:
+            continue
+        for name, old_value, new_value in zip(fields, old, new):
+            if old_value != new_value:
+                events.append(_event(patient_id, study_id, name, old_value, new_value, BULK, now))
+    record(events)
+
+
+def flush():
+    '''
+    Write the buffered events as PatientTransition rows; returns how many
+    '''
+    # Imported here as the models module imports this one
+    from apps.patient.models import PatientTransition
+
+    written = 0
+    while True:
+        events = buffer.drain(settings.TRANSITION_BATCH_SIZE)
+        if not events:
+            return written
+        try:
+            PatientTransition.objects.bulk_create([_row(PatientTransition, event) for event in events])
+        except Exception:
+            # Keep them for the next flush rather than losing history
+            buffer.append(events)
+            raise
+        written += len(events)
+        if len(events) < settings.TRANSITION_BATCH_SIZE:
+            return written
+
+
+def flush_local():
+    '''
+    Write out the events in this process's memory buffer, e.g. before the
+    database they were recorded in is torn down
+    '''
+    if isinstance(buffer, MemoryBuffer) and len(buffer):
+        flush()
+
+
+@atexit.register
+def flush_at_exit():
+    '''
+    Events in a memory buffer die with the process, so write them out first,
+    over the database connection if it is still open. Opening one at exit
+    could reach a database other than the one they were recorded in (after
+    a test database was torn down, say).
+    '''
+    if not isinstance(buffer, MemoryBuffer) or not len(buffer):
+        return
+    if connection.connection is None:
+        logger.warning(f"Lost {len(buffer)} patient transitions at exit: no open database connection")
+        return
+    try:
+        flush()
+    except Exception:
+        logger.exception(f"Lost {len(buffer)} patient transitions at exit")
+
+
+def _row(model, event):
+    patient_id, study_id, field, old, new, source, timestamp = event
+    at = datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+    return model(
+        patient_id=patient_id, study_id=study_id, field=field, old=old, new=new,
+        source=source, at=at, month=at.year * 100 + at.month,
+    )
+
+
+def funnel(transitions):
+    '''
+    Mean seconds patients took between consecutive statuses, from the status
+    rows of the ``transitions`` queryset, e.g. {"New → Engaged": {...}}
+    '''
+    # Imported here as the models module imports this one
+    from apps.patient.models import Patient
+
+    labels = dict(Patient._meta.get_field("status").choices)
+    rows = transitions.filter(field=STATUS).order_by("patient_id", "at").values_list("patient_id", "new", "at")
+    totals = defaultdict(lambda: [0, 0.0])
+    for _, group in groupby(rows.iterator(), key=lambda row: row[0]):
+        previous = None
+        for _, status, at in group:
+            if previous is not None and previous[0] != status:
+                total = totals[(previous[0], status)]
+                total[0] += 1
+                total[1] += (at - previous[1]).total_seconds()
+            previous = (status, at)
+    return {
+        f"{labels[old]} → {labels[new]}": {"patients": n, "mean_seconds": seconds / n}
+        for (old, new), (n, seconds) in sorted(totals.items())
+    }
@@ -0,0 +1,13 @@
+from django.urls import path
+
+from apps.patient import views
+
+app_name = "patient"
+
+urlpatterns = [
+    path("patients/<uuid:patient_id>/eligibility/", views.patient_eligibility, name="eligibility"),
+    path("studies/<uuid:study_id>/status-counts/", views.study_status_counts, name="study-status-counts"),
+    path("campaigns/<uuid:campaign_id>/progress/", views.campaign_progress, name="campaign-progress"),
+    path("t/open/<str:token>.gif", views.track_open, name="track-open"),
+    path("t/click/<str:token>/", views.track_click, name="track-click"),
+]
@@ -0,0 +1,243 @@
+"""
+Async, read-only endpoints polled by patient-facing clients.
+
+They are served under ASGI (see the api service in docker-compose.yml), so a
+worker holds many concurrent pollers without a thread per request. Every
+database access uses the async ORM, so a burst of polls for the same object
+costs one query. Patient answers go through the two-tier cache (libs.cache),
+which patient writes invalidate; campaign progress changes with every shard,
+so it is only cached for PATIENT_API_CACHE_TIMEOUT seconds.
+
+The open pixel and click redirect linked from campaign emails are served
+here too: they only buffer the event (apps.patient.tracking) and answer,
+leaving the database writes to a batched flush. Under ASGI, tracking_shortcut
+answers them before Django's middleware, which costs far more than the hit.
+Only GETs are recorded: link scanners and prefetchers probe with HEAD.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import asyncio
+import base64
+import logging
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseRedirect, JsonResponse
+from django.urls import reverse
+
+from apps.patient import tracking
+from apps.patient.cache import patient_counts, patients
+from apps.patient.models import Campaign, Patient
+
+# --------------------------------------------------------------
+# 3rd party imports
+# --------------------------------------------------------------
+from asgiref.sync import sync_to_async
+
+STATUS = dict(Patient._meta.get_field("status").choices)
+CANCELLED = dict(Patient._meta.get_field("cancelled").choices)
+
+# A transparent 1x1 GIF
+PIXEL = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+
+logger = logging.getLogger(__name__)
+
+# The running background flush of this process, if any
+_flush = None
+# (event loop, timer) of the pending timed flush of this process, if any
+_timer = None
+
+
+def not_found(message):
+    return JsonResponse({"error": message}, status=404)
+
+
+def read_only(view):
+    '''
+    Async twin of require_GET, which wraps views in a sync function in this
+    Django version and would push every request back onto a thread.
+    '''
+    async def inner(request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return HttpResponseNotAllowed(["GET", "HEAD"])
+        return await view(request, *args, **kwargs)
+    inner.__name__, inner.__doc__ = view.__name__, view.__doc__
+    return inner
+
+
+@read_only
+async def patient_eligibility(request, patient_id):
+    async def load():
+        try:
+            patient = await Patient.objects.only("id", "study_id", "status", "cancelled", "emails_sent").aget(
+                id=patient_id
+            )
+        except Patient.DoesNotExist:
+            return None
+        return {
+            "patient": str(patient.id),
+            "study": str(patient.study_id),
+            # The study's rule may need loading, which is synchronous
+            "eligible": await sync_to_async(patient.in_study)(),
+            "status": STATUS[patient.status],
+            "cancelled": CANCELLED[patient.cancelled],
+        }
+
+    data = await patients.aget_or_set(patient_id, load)
+    if data is None:
+        return not_found("Patient not found")
+    return JsonResponse(data)
+
+
+@read_only
+async def study_status_counts(request, study_id):
+    async def load():
+        rows = Patient.objects.filter(study_id=study_id).values("status", "cancelled").annotate(patients=Count("id"))
+        status, cancelled = dict.fromkeys(STATUS.values(), 0), dict.fromkeys(CANCELLED.values(), 0)
+        total = 0
+        async for row in rows:
+            status[STATUS[row["status"]]] += row["patients"]
+            cancelled[CANCELLED[row["cancelled"]]] += row["patients"]
+            total += row["patients"]
+        return {"study": str(study_id), "patients": total, "status": status, "cancelled": cancelled}
+
+    return JsonResponse(await patient_counts.aget_or_set(f"study:{study_id}", load))
+
+
+@read_only
+async def campaign_progress(request, campaign_id):
+    key = f"api:campaign-progress:{campaign_id}"
+    data = await cache.aget(key)
+    if data is None:
+        try:
+            campaign = await Campaign.objects.aget(id=campaign_id)
+        except Campaign.DoesNotExist:
+            return not_found("Campaign not found")
+        shards = await campaign.shards.aaggregate(
+            total=Count("id"),
+            dispatched=Count("id", filter=Q(dispatched_at__isnull=False)),
+            completed=Count("id", filter=Q(completed_at__isnull=False)),
+        )
+        processed = campaign.sent + campaign.failed + campaign.deferred + campaign.suppressed
+        data = {
+            "campaign": str(campaign.id),
+            "status": campaign.get_status_display(),
+            "window_start": campaign.window_start.isoformat(),
+            "window_end": campaign.window_end.isoformat(),
+            "recipients": campaign.recipients,
+            "sent": campaign.sent,
+            "failed": campaign.failed,
+            "deferred": campaign.deferred,
+            "suppressed": campaign.suppressed,
+            "progress": processed / campaign.recipients if campaign.recipients else 1.0,
+            "shards": shards,
+        }
+        await cache.aset(key, data, settings.PATIENT_API_CACHE_TIMEOUT)
+    return JsonResponse(data)
+
+
+async def _record(method, kind, token):
+    if method != "GET":
+        return
+    patient_id = tracking.patient_for(token)
+    # Forged or mangled tokens still get their pixel or redirect, just no event
+    if patient_id is None:
+        return
+    if await tracking.arecord(kind, patient_id):
+        _flush_soon()
+    elif not settings.TRACKING_BUFFER_URL:
+        _flush_later()
+
+
+def _flush_later():
+    '''
+    Flush this process's buffer within TRACKING_FLUSH_SECONDS even if no
+    further hit arrives; the beat flush cannot reach it
+    '''
+    global _timer
+    loop = asyncio.get_running_loop()
+    if _timer is None or _timer[0] is not loop or _timer[1].cancelled():
+        _timer = (loop, loop.call_later(settings.TRACKING_FLUSH_SECONDS, _flush_due))
+
+
+def _flush_due():
+    global _timer
+    _timer = None
+    _flush_soon()
+
+
+def _flush_soon():
+    '''
+    Flush the tracking buffer on a thread, without holding up the response
+    '''
+    global _flush
+    if _flush is None or _flush.done():
+        _flush = asyncio.get_running_loop().create_task(sync_to_async(tracking.flush, thread_sensitive=False)())
+        _flush.add_done_callback(_flushed)
+
+
+def _flushed(task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Engagement flush failed", exc_info=task.exception())
+    if not settings.TRACKING_BUFFER_URL and len(tracking.buffer):
+        # Another flush held the lease, this one failed, or more hits arrived
+        # meanwhile: try again on the timer rather than wait for the next hit
+        _flush_later()
+
+
+@read_only
+async def track_open(request, token):
+    await _record(request.method, tracking.OPEN, token)
+    response = HttpResponse(PIXEL, content_type="image/gif")
+    response["Cache-Control"] = "no-store, max-age=0"
+    return response
+
+
+@read_only
+async def track_click(request, token):
+    await _record(request.method, tracking.CLICK, token)
+    # Always the configured destination, so the endpoint is no open redirect
+    return HttpResponseRedirect(settings.TRACKING_CLICK_URL)
+
+
+def tracking_shortcut(application):
+    '''
+    Wrap the ASGI ``application`` so tracking hits are answered directly;
+    everything else, and any path it doesn't recognise, goes to Django
+    '''
+    open_prefix, open_suffix = reverse("patient:track-open", args=["-"]).split("-")
+    click_prefix, click_suffix = reverse("patient:track-click", args=["-"]).split("-")
+    pixel_headers = [
+        (b"content-type", b"image/gif"),
+        (b"content-length", str(len(PIXEL)).encode()),
+        (b"cache-control", b"no-store, max-age=0"),
+    ]
+    click_headers = [(b"location", settings.TRACKING_CLICK_URL.encode()), (b"content-length", b"0")]
+
+    def match(path):
+        for kind, prefix, suffix in ((tracking.OPEN, open_prefix, open_suffix), (tracking.CLICK, click_prefix, click_suffix)):
+            if path.startswith(prefix) and path.endswith(suffix):
+                token = path[len(prefix):len(path) - len(suffix)]
+                if token and "/" not in token:
+                    return kind, token
+        return None, None
+
+    async def shortcut(scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            kind, token = match(scope["path"])
+            if kind is not None:
+                await _record(scope["method"], kind, token)
+                if kind == tracking.OPEN:
+                    status, headers, body = 200, pixel_headers, PIXEL
+                else:
+                    status, headers, body = 302, click_headers, b""
+                await send({"type": "http.response.start", "status": status, "headers": headers})
+                await send({"type": "http.response.body", "body": body if scope["method"] == "GET" else b""})
+                return
+        await application(scope, receive, send)
+    return shortcut
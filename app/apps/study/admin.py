@@ -1,9 +1,15 @@
 from django.contrib import admin
 
-from apps.study.models import Study
+from apps.study.models import EligibilityRule, Study
+
+
+class EligibilityRuleInline(admin.StackedInline):
+
+    model = EligibilityRule
 
 
 @admin.register(Study)
 class StudyAdmin(admin.ModelAdmin):
 
     list_display = ("id", "name")
+    inlines = (EligibilityRuleInline,)
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class StudyConfig(AppConfig):
+    name = 'apps.study'
+    label = 'study'
+
+    def ready(self):
+        from apps.study import signals  # noqa: F401
@@ -0,0 +1,12 @@
+from apps.study.models import Study
+from libs.cache import tiered
+
+studies = tiered("study")
+
+
+def study_context(study_id, study=None) -> dict:
+    '''
+    The email context of a study, through the two-tier cache. Pass ``study``
+    when it is already loaded to spare the query on a miss.
+    '''
+    return studies.get_or_set(study_id, lambda: (study or Study.objects.get(id=study_id)).email_context())
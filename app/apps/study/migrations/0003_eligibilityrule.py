@@ -0,0 +1,29 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:56
+
+import apps.study.models
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('study', '0002_alter_study_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EligibilityRule',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('statuses', models.JSONField(default=apps.study.models.default_statuses, help_text='Patient statuses that may be emailed.')),
+                ('excluded_cancellations', models.JSONField(blank=True, default=apps.study.models.default_excluded_cancellations, help_text='Cancellation codes that exclude a patient.')),
+                ('send_cap', models.PositiveIntegerField(blank=True, help_text='Stop emailing a patient once this many emails were sent; empty for no cap.', null=True)),
+                ('study', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='eligibility_rule', to='study.study')),
+            ],
+            options={
+                'verbose_name': 'Eligibility Rule',
+                'verbose_name_plural': 'Eligibility Rules',
+            },
+        ),
+    ]
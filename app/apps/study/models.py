@@ -13,3 +13,45 @@ class Study(models.Model):
 
     def __str__(self):
         return self.name
+
+    def email_context(self) -> dict:
+        #Template context shared by every patient email of the study
+        return {
+            'care_provider_contact': 'XXX',
+            'care_provider_name': 'XXX',
+        }
+
+
+def default_statuses():
+    # New patients only
+    return [0]
+
+
+def default_excluded_cancellations():
+    # Any cancellation
+    return [10, 20, 30, 40]
+
+
+class EligibilityRule(models.Model):
+
+    """
+    Which of a study's patients may be emailed, in patient status and
+    cancellation codes. Studies without a rule use the defaults: new patients
+    who have not cancelled, with no send cap.
+    """
+
+    study = models.OneToOneField(Study, on_delete=models.CASCADE, related_name="eligibility_rule")
+    statuses = models.JSONField(default=default_statuses, help_text="Patient statuses that may be emailed.")
+    excluded_cancellations = models.JSONField(
+        default=default_excluded_cancellations, blank=True, help_text="Cancellation codes that exclude a patient."
+    )
+    send_cap = models.PositiveIntegerField(
+        null=True, blank=True, help_text="Stop emailing a patient once this many emails were sent; empty for no cap."
+    )
+
+    class Meta:
+        verbose_name = "Eligibility Rule"
+        verbose_name_plural = "Eligibility Rules"
+
+    def __str__(self):
+        return f"Eligibility of {self.study}"
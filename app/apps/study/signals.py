@@ -0,0 +1,36 @@
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.patient.cache import invalidate_patients
+from apps.study.cache import studies
+from apps.study.models import EligibilityRule, Study
+
+
+@receiver(post_save, sender=Study)
+@receiver(post_delete, sender=Study)
+def invalidate_study(sender, instance, **kwargs):
+    studies.invalidate(instance.id)
+
+
+@receiver(post_save, sender='care_provider.CareProvider')
+@receiver(post_delete, sender='care_provider.CareProvider')
+def invalidate_care_provider(sender, instance, **kwargs):
+    '''
+    Study email contexts carry care provider details, and nothing records
+    which studies a provider serves, so retire them all
+    '''
+    studies.invalidate_all()
+
+
+@receiver(post_save, sender=EligibilityRule)
+@receiver(post_delete, sender=EligibilityRule)
+def invalidate_eligibility(sender, instance, **kwargs):
+    # Imported here as the patient models import the study app
+    from apps.patient.eligibility import RULES_KEY
+
+    studies.invalidate(RULES_KEY)
+    # Cached answers about patients may depend on the rule
+    invalidate_patients()
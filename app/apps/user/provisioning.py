@@ -0,0 +1,126 @@
+"""
+Bulk creation of auth users (and optionally their Patient rows).
+
+Password modes:
+ - unusable: the user cannot log in with a password (the default; study
+   participants are only ever emailed)
+ - invite: as unusable, plus a signed, time-limited invite token per user
+   that can be exchanged for setting a password
+ - hash: the rows carry a "password" that is hashed. Hashing is the slow part
+   (PBKDF2 is deliberately expensive), so it runs across a process pool.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core import signing
+
+from apps.patient.models import Patient
+from tasks.payloads import chunks
+
+UNUSABLE = "unusable"
+INVITE = "invite"
+HASH = "hash"
+PASSWORD_MODES = (UNUSABLE, INVITE, HASH)
+
+INVITE_SALT = "apps.user.invite"
+
+ProvisionResult = namedtuple("ProvisionResult", ["created", "skipped", "patients", "tokens"])
+
+
+def make_invite_token(username) -> str:
+    return signing.dumps({"u": username}, salt=INVITE_SALT, compress=True)
+
+
+def read_invite_token(token, max_age) -> str:
+    '''
+    Return the username an invite token was issued for. Raises
+    django.core.signing.BadSignature (or SignatureExpired) for bad tokens.
+    '''
+    return signing.loads(token, salt=INVITE_SALT, max_age=max_age)["u"]
+
+
+def _init_hasher():
+    # Needed where worker processes are spawned rather than forked
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+    django.setup()
+
+
+def hash_passwords(passwords, workers=None, chunksize=64) -> list:
+    '''
+    Hash ``passwords`` in parallel, one process per CPU by default
+    '''
+    passwords = list(passwords)
+    if workers == 1 or len(passwords) < 2:
+        return [make_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_hasher) as pool:
+        return list(pool.map(make_password, passwords, chunksize=chunksize))
+
+
+def provision_users(rows, password_mode=UNUSABLE, study=None, batch_size=1000, workers=None) -> ProvisionResult:
+    '''
+    Create a user for every row (a dict with username, email and optionally
+    first_name, last_name and password) whose username does not exist yet,
+    and a Patient in ``study`` for each of them when a study is given.
+
+    Rows are handled in batches: one query to find existing usernames, one
+    bulk insert of users and one of patients (counted before and after) per
+    batch.
+    '''
+    if password_mode not in PASSWORD_MODES:
+        raise ValueError(f"Unknown password mode {password_mode!r}, expected one of {PASSWORD_MODES}")
+
+    created = skipped = patients = 0
+    tokens = {}
+    for batch in chunks(rows, batch_size):
+        existing = set(
+            User.objects.filter(username__in=[row["username"] for row in batch]).values_list("username", flat=True)
+        )
+        new_rows = [row for row in batch if row["username"] not in existing]
+        skipped += len(batch) - len(new_rows)
+        if not new_rows:
+            continue
+
+        if password_mode == HASH:
+            passwords = hash_passwords((row["password"] for row in new_rows), workers=workers)
+        else:
+            passwords = [make_password(None) for _ in new_rows]
+
+        User.objects.bulk_create([
+            User(
+                username=row["username"],
+                email=row.get("email", ""),
+                first_name=row.get("first_name", ""),
+                last_name=row.get("last_name", ""),
+                password=password,
+            )
+            for row, password in zip(new_rows, passwords)
+        ])
+        created += len(new_rows)
+
+        if password_mode == INVITE:
+            tokens.update((row["username"], make_invite_token(row["username"])) for row in new_rows)
+
+        if study is not None:
+            user_ids = list(
+                User.objects.filter(username__in=[row["username"] for row in new_rows]).values_list("id", flat=True)
+            )
+            enrolled = Patient.objects.filter(study=study, user_id__in=user_ids)
+            before = enrolled.count()
+            Patient.objects.bulk_create(
+                [Patient(user_id=user_id, study=study) for user_id in user_ids],
+                ignore_conflicts=True,
+            )
+            # bulk_create returns every object it was given, conflicting or not
+            patients += enrolled.count() - before
+
+    return ProvisionResult(created, skipped, patients, tokens)
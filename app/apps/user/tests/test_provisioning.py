@@ -0,0 +1,61 @@
+from unittest import mock
+
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from apps.patient.models import Patient
+from apps.study.models import Study
+from apps.user.provisioning import HASH, INVITE, hash_passwords, provision_users, read_invite_token
+
+
+def rows(n, **extra):
+    return [{"username": f"user{i}", "email": f"user{i}@umed.io", **extra} for i in range(n)]
+
+
+class ProvisioningTestCase(TestCase):
+
+    """
+    Test suite for bulk user provisioning
+    """
+    def test_unusable_passwords_and_patients(self):
+        study = Study.objects.create(name="Study A")
+        with self.assertNumQueries(7 * 3):
+            # per batch: existing usernames, users, new user ids, patients (counted before and
+            # after, and the inserted ones read back for their transitions)
+            result = provision_users(rows(25), study=study, batch_size=10)
+        self.assertEqual((result.created, result.skipped, result.patients), (25, 0, 25))
+        self.assertFalse(any(user.has_usable_password() for user in User.objects.all()))
+        self.assertEqual(Patient.objects.in_study().count(), 25)
+
+    def test_conflicting_patients_are_not_counted(self):
+        study = Study.objects.create(name="Study A")
+        bulk_create = User.objects.bulk_create
+
+        def create_users(objs, *args, **kwargs):
+            objs = bulk_create(objs, *args, **kwargs)
+            # A concurrent run enrols one of the new users first
+            Patient.objects.create(user=User.objects.get(username="user0"), study=study)
+            return objs
+
+        with mock.patch.object(User.objects, "bulk_create", side_effect=create_users):
+            result = provision_users(rows(3), study=study)
+        self.assertEqual((result.created, result.patients), (3, 2))
+        self.assertEqual(Patient.objects.count(), 3)
+
+    def test_existing_users_are_skipped(self):
+        User.objects.create(username="user0")
+        result = provision_users(rows(3))
+        self.assertEqual((result.created, result.skipped), (2, 1))
+
+    def test_invite_tokens(self):
+        result = provision_users(rows(2), password_mode=INVITE)
+        self.assertEqual(read_invite_token(result.tokens["user1"], max_age=60), "user1")
+
+    def test_hashed_passwords(self):
+        provision_users(rows(3, password="Password8080"), password_mode=HASH, workers=2)
+        self.assertTrue(all(check_password("Password8080", user.password) for user in User.objects.all()))
+
+    def test_hash_passwords_in_parallel(self):
+        hashes = hash_passwords(["a", "b", "c"], workers=2, chunksize=1)
+        self.assertEqual([check_password(p, h) for p, h in zip("abc", hashes)], [True] * 3)
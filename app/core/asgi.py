@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# Imported once get_asgi_application() has set Django up
+from apps.patient.views import tracking_shortcut  # noqa: E402
+
+application = tracking_shortcut(application)
@@ -17,9 +17,21 @@ app.conf.timezone = 'Europe/London'
 
 app.conf.beat_schedule = {
     "bulk_send": {
-        "task": "app.patient.tasks.bulk_send",
+        "task": "apps.patient.tasks.bulk_email",
         "schedule": timedelta(days=1),
     },
+    "pace_campaigns": {
+        "task": "apps.patient.tasks.pace_campaigns",
+        "schedule": timedelta(seconds=int(os.environ.get("CAMPAIGN_PACING_TICK", 60))),
+    },
+    "flush_transitions": {
+        "task": "apps.patient.tasks.flush_transitions",
+        "schedule": timedelta(seconds=int(os.environ.get("TRANSITION_FLUSH_SECONDS", 10))),
+    },
+    "flush_engagement": {
+        "task": "apps.patient.tasks.flush_engagement",
+        "schedule": timedelta(seconds=int(os.environ.get("TRACKING_FLUSH_SECONDS", 5))),
+    },
 }
  
 
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
 import os
 load_dotenv()
@@ -29,6 +30,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.environ.get("SECRET_KEY")
 ALLOWED_HOSTS = os.environ.get("DJANGO_ALLOWED_HOSTS").split(" ")
 DEBUG = int(os.environ.get("DEBUG", default=0))
+TESTING = sys.argv[1:2] == ["test"]
 
 
 # Application definition
@@ -57,17 +59,109 @@ INSTALLED_APPS = [
 # --------------------------------------------------------------
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER", "redis://redis:6379")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_BACKEND", "redis://redis:6379")
-CELERY_ACCEPT_CONTENT = ['application/json']
+CELERY_ACCEPT_CONTENT = ['application/json', 'application/x-msgpack']
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'Europe/London'
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 CELERY_LOGFILE_PATH = os.environ.get('CELERY_LOGFILE_PATH', 'celery.log')
 CELERY_TASKS_LOGGER_NAME = "celery_tasks"
+# Replace a pool process once its RSS exceeds this many KiB after a task (unset: never);
+# memory_report suggests a value from the memory profiles
+CELERY_WORKER_MAX_MEMORY_PER_CHILD = int(os.environ.get("CELERY_WORKER_MAX_MEMORY_PER_CHILD", 0)) or None
 # --------------------------------------------------------------
 # END CELERY SETTINGS
 # --------------------------------------------------------------
 
+# --------------------------------------------------------------
+# MEMORY PROFILING SETTINGS
+# --------------------------------------------------------------
+# Trace the allocations of a sample of worker tasks (tasks.memory): the fraction of
+# tasks traced, limited to these task names (comma separated; empty for all), the
+# allocation sites logged per task and the stack frames kept per allocation
+MEMORY_PROFILE = bool(int(os.environ.get("MEMORY_PROFILE", 0)))
+MEMORY_PROFILE_SAMPLE_RATE = float(os.environ.get("MEMORY_PROFILE_SAMPLE_RATE", 0.01))
+MEMORY_PROFILE_TASKS = [name for name in os.environ.get("MEMORY_PROFILE_TASKS", "").split(",") if name]
+MEMORY_PROFILE_TOP = int(os.environ.get("MEMORY_PROFILE_TOP", 10))
+MEMORY_PROFILE_FRAMES = int(os.environ.get("MEMORY_PROFILE_FRAMES", 1))
+# Headroom memory_report adds above the RSS workers were seen to settle at
+MEMORY_RECYCLE_HEADROOM = float(os.environ.get("MEMORY_RECYCLE_HEADROOM", 0.25))
+# --------------------------------------------------------------
+# END MEMORY PROFILING SETTINGS
+# --------------------------------------------------------------
+
+# --------------------------------------------------------------
+# LOCK SETTINGS
+# --------------------------------------------------------------
+# Redis holding the campaign leases (the broker by default). Without one, as in
+# tests, leases are held in-process and only exclude tasks of the same process;
+# never leave it empty with more than one worker (a warning is logged outside tests).
+LOCK_URL = os.environ.get("LOCK_URL", CELERY_BROKER_URL)
+if TESTING:
+    LOCK_URL = ""
+# Seconds a lease outlives a holder that stops renewing it (renewed every third)
+LOCK_TTL = int(os.environ.get("LOCK_TTL", 60))
+# --------------------------------------------------------------
+# END LOCK SETTINGS
+# --------------------------------------------------------------
+
+# --------------------------------------------------------------
+# CAMPAIGN SETTINGS
+# --------------------------------------------------------------
+# Maximum number of patients handled by one shard task of the daily campaign
+CAMPAIGN_SHARD_SIZE = int(os.environ.get("CAMPAIGN_SHARD_SIZE", 500))
+# Hours over which a campaign's shards are spread (0 sends everything at once), how often
+# the pacer runs (seconds; also sets the beat schedule) and how many shards may run at once
+CAMPAIGN_WINDOW_HOURS = float(os.environ.get("CAMPAIGN_WINDOW_HOURS", 8))
+CAMPAIGN_PACING_TICK = int(os.environ.get("CAMPAIGN_PACING_TICK", 60))
+CAMPAIGN_MAX_IN_FLIGHT = int(os.environ.get("CAMPAIGN_MAX_IN_FLIGHT", 8))
+# Seconds a dispatched shard may go without progress before the pacer assumes its task
+# was lost and dispatches it again
+CAMPAIGN_SHARD_TIMEOUT = int(os.environ.get("CAMPAIGN_SHARD_TIMEOUT", 15 * 60))
+# Recipients per send_email_batch task, and how batches are encoded on the broker.
+# "msgpack" requires the msgpack package; compression can be "zlib", "bzip2" or empty.
+EMAIL_BATCH_SIZE = int(os.environ.get("EMAIL_BATCH_SIZE", 500))
+EMAIL_BATCH_SERIALIZER = os.environ.get("EMAIL_BATCH_SERIALIZER", "json")
+EMAIL_BATCH_COMPRESSION = os.environ.get("EMAIL_BATCH_COMPRESSION", "zlib")
+# Seconds the async API may serve cached campaign progress for
+PATIENT_API_CACHE_TIMEOUT = int(os.environ.get("PATIENT_API_CACHE_TIMEOUT", 5))
+# --------------------------------------------------------------
+# END CAMPAIGN SETTINGS
+# --------------------------------------------------------------
+
+# --------------------------------------------------------------
+# TRACKING SETTINGS
+# --------------------------------------------------------------
+# Origin serving the tracking endpoints (the api service) as linked from emails;
+# empty sends untracked emails. Clicks always redirect to TRACKING_CLICK_URL.
+TRACKING_BASE_URL = os.environ.get("TRACKING_BASE_URL", "http://localhost:8001")
+TRACKING_CLICK_URL = os.environ.get("TRACKING_CLICK_URL", "https://umed.io")
+# Opens and clicks are buffered in each process, or in Redis when this is set, and
+# applied in batches of TRACKING_BATCH_SIZE at least every TRACKING_FLUSH_SECONDS.
+# The flush_engagement beat task only reaches a shared buffer, so set this when
+# the api runs more than one process; otherwise each flushes its own on a timer.
+TRACKING_BUFFER_URL = os.environ.get("TRACKING_BUFFER_URL", "")
+TRACKING_BATCH_SIZE = int(os.environ.get("TRACKING_BATCH_SIZE", 1000))
+TRACKING_FLUSH_SECONDS = int(os.environ.get("TRACKING_FLUSH_SECONDS", 5))
+# What moves a New patient to Engaged: "click", "open" (or a click) or "" for nothing
+TRACKING_ENGAGE_ON = os.environ.get("TRACKING_ENGAGE_ON", "click")
+# --------------------------------------------------------------
+# END TRACKING SETTINGS
+# --------------------------------------------------------------
+
+# --------------------------------------------------------------
+# AUDIT SETTINGS
+# --------------------------------------------------------------
+# Patient status/cancelled changes are buffered in each process, or in Redis when
+# this is set (e.g. redis://redis:6379/2), and written in batches of
+# TRANSITION_BATCH_SIZE at least every TRANSITION_FLUSH_SECONDS
+TRANSITION_BUFFER_URL = os.environ.get("TRANSITION_BUFFER_URL", "")
+TRANSITION_BATCH_SIZE = int(os.environ.get("TRANSITION_BATCH_SIZE", 500))
+TRANSITION_FLUSH_SECONDS = int(os.environ.get("TRANSITION_FLUSH_SECONDS", 10))
+# --------------------------------------------------------------
+# END AUDIT SETTINGS
+# --------------------------------------------------------------
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -108,8 +202,52 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections open between requests and tasks (seconds)
+        'CONN_MAX_AGE': int(os.environ.get("CONN_MAX_AGE", 60)),
+    }
+}
+
+
+# --------------------------------------------------------------
+# CACHE SETTINGS
+# --------------------------------------------------------------
+# Redis is shared with Celery (db 0); the cache uses its own database. Tests, and
+# an empty CACHE_LOCATION, use a per-process memory cache so they need no Redis.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ.get("CACHE_LOCATION", "redis://redis:6379/1"),
     }
 }
+if TESTING or not CACHES['default']['LOCATION']:
+    CACHES['default'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+# Seconds a value lives in the shared tier, how many entries each namespace keeps
+# in its per-process tier and for how long (which bounds how stale another
+# process's invalidation can leave it)
+CACHE_TIMEOUT = int(os.environ.get("CACHE_TIMEOUT", 300))
+CACHE_LOCAL_SIZE = int(os.environ.get("CACHE_LOCAL_SIZE", 1024))
+CACHE_LOCAL_TTL = float(os.environ.get("CACHE_LOCAL_TTL", 5))
+# Seconds one process may hold the lock to load a missing key, and between
+# publishes of its hit/miss counters to the shared cache
+CACHE_LOCK_TIMEOUT = int(os.environ.get("CACHE_LOCK_TIMEOUT", 10))
+CACHE_METRICS_INTERVAL = int(os.environ.get("CACHE_METRICS_INTERVAL", 60))
+# --------------------------------------------------------------
+# END CACHE SETTINGS
+# --------------------------------------------------------------
+
+# --------------------------------------------------------------
+# TEST SETTINGS
+# --------------------------------------------------------------
+# The migrated SQLite test database is cached here and copied for each run (empty
+# disables it; libs.test_runner)
+TEST_RUNNER = "libs.test_runner.TemplateDatabaseRunner"
+TEST_DB_TEMPLATE_DIR = os.environ.get("TEST_DB_TEMPLATE_DIR", str(BASE_DIR / ".test-db"))
+if TESTING:
+    # Test users need a password, not a slow one
+    PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+# --------------------------------------------------------------
+# END TEST SETTINGS
+# --------------------------------------------------------------
 
 
 # Password validation
@@ -164,6 +302,25 @@ else:
 EMAIL_HOST_USER = os.environ.get("EMAIL")
 DISPLAY_NAME = "Pivot Netball Squad"
 EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_PASSWORD")
+# Worker processes keep their email connection open between tasks for up to this long (seconds)
+EMAIL_CONNECTION_MAX_IDLE = int(os.environ.get("EMAIL_CONNECTION_MAX_IDLE", 30))
+# Templates compiled when a worker process starts
+EMAIL_PRELOAD_TEMPLATES = ["tasks/patient_email.html"]
+# Context fields that differ per recipient; emails are rendered once per template and
+# shared context and only these are filled in per message. A template that tests or
+# filters a slot ({% if slot %}, |upper) is rendered in full for every message instead
+EMAIL_RENDER_SLOTS = ["patient_username", "tracking_open_url", "tracking_click_url"]
+# Rendered skeletons kept per worker process, and optionally in a cache shared by all workers
+EMAIL_RENDER_CACHE_SIZE = int(os.environ.get("EMAIL_RENDER_CACHE_SIZE", 256))
+EMAIL_RENDER_CACHE_ALIAS = os.environ.get("EMAIL_RENDER_CACHE_ALIAS", "")
+EMAIL_RENDER_CACHE_TIMEOUT = 60 * 60
+# Transient send failures are retried with exponential backoff (seconds) and full jitter
+EMAIL_RETRY_MAX = int(os.environ.get("EMAIL_RETRY_MAX", 5))
+EMAIL_RETRY_BACKOFF = int(os.environ.get("EMAIL_RETRY_BACKOFF", 60))
+EMAIL_RETRY_BACKOFF_MAX = int(os.environ.get("EMAIL_RETRY_BACKOFF_MAX", 60 * 60))
+# Workers keep a Bloom filter snapshot of the suppression list, rebuilt this often (seconds)
+SUPPRESSION_REFRESH_SECONDS = int(os.environ.get("SUPPRESSION_REFRESH_SECONDS", 300))
+SUPPRESSION_FALSE_POSITIVE_RATE = float(os.environ.get("SUPPRESSION_FALSE_POSITIVE_RATE", 0.001))
 # --------------------------------------------------------------
 # END EMAIL SETTINGS
 # --------------------------------------------------------------
@@ -175,9 +332,35 @@ EMAIL_HOST_PASSWORD = os.environ.get("EMAIL_PASSWORD")
 LOGGING_CONFIG = None
 LOG_LEVEL = os.environ.get('LOG_LEVEL')
 LOG_FILE_PATH = os.environ.get('LOG_FILE_PATH', 'app.log')
+# Log files rotate at LOG_ROTATE_BYTES or every LOG_ROTATE_SECONDS, whichever comes
+# first; rotated segments are compressed ("gzip", "zstd" or empty for none) and the
+# newest LOG_BACKUP_COUNT kept
+LOG_ROTATE_BYTES = int(os.environ.get('LOG_ROTATE_BYTES', 1024 * 1024 * 10))
+LOG_ROTATE_SECONDS = int(os.environ.get('LOG_ROTATE_SECONDS', 60 * 60))
+LOG_COMPRESSION = os.environ.get('LOG_COMPRESSION', 'gzip') or None
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 500))
+# Records each message template may log per LOG_SAMPLE_PERIOD seconds before being
+# sampled (INFO and below) or dropped; WARNING and above are always kept
+LOG_SAMPLE_RATE = int(os.environ.get('LOG_SAMPLE_RATE', 100))
+LOG_SAMPLE_PERIOD = int(os.environ.get('LOG_SAMPLE_PERIOD', 60))
+LOG_SAMPLE_SIZE = int(os.environ.get('LOG_SAMPLE_SIZE', 10))
 logging.config.dictConfig({
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'utils.logger.SamplingFilter',
+            'rate': LOG_SAMPLE_RATE,
+            'period': LOG_SAMPLE_PERIOD,
+            'sample_size': LOG_SAMPLE_SIZE,
+            # Per-logger totals, across all of the logger's messages
+            'logger_rates': {
+                CELERY_TASKS_LOGGER_NAME: int(os.environ.get('LOG_SAMPLE_TASKS_RATE', 1000)),
+                'tasks': int(os.environ.get('LOG_SAMPLE_TASKS_RATE', 1000)),
+                'apps.patient.tasks': int(os.environ.get('LOG_SAMPLE_TASKS_RATE', 1000)),
+            },
+        },
+    },
     'formatters': {
         'console': {
             # see more parameters at https://docs.python.org/3/library/logging.html#logging.LogRecord
@@ -206,21 +389,28 @@ logging.config.dictConfig({
         'console': {
             'class': 'colorlog.StreamHandler' if supports_color() else 'logging.StreamHandler',
             'formatter': 'colorlog' if supports_color() else 'console',
+            'filters': ['sampling'],
         },
 
         'rotating_file': {
-            'class': 'utils.logger.BetterRotatingFileHandler',
+            'class': 'utils.logger.CompressingRotatingFileHandler',
             'formatter': 'json_formatter',
             'filename': LOG_FILE_PATH,
-            'maxBytes': 1024 * 1024 * 10,  # 10 MB
-            'backupCount': 10
+            'maxBytes': LOG_ROTATE_BYTES,
+            'interval': LOG_ROTATE_SECONDS,
+            'compression': LOG_COMPRESSION,
+            'backupCount': LOG_BACKUP_COUNT,
+            'filters': ['sampling'],
         },
         'celery_rotating_file': {
-            'class': 'utils.logger.BetterRotatingFileHandler',
+            'class': 'utils.logger.CompressingRotatingFileHandler',
             'formatter': 'json_formatter',
             'filename': CELERY_LOGFILE_PATH,
-            'maxBytes': 1024 * 1024 * 10,  # 10 MB
-            'backupCount': 10
+            'maxBytes': LOG_ROTATE_BYTES,
+            'interval': LOG_ROTATE_SECONDS,
+            'compression': LOG_COMPRESSION,
+            'backupCount': LOG_BACKUP_COUNT,
+            'filters': ['sampling'],
         },
 
         'django.server': DEFAULT_LOGGING['handlers']['django.server'],
@@ -0,0 +1,167 @@
+"""
+End-to-end email throughput benchmark.
+
+Seeds patients into the current database, runs one of the send paths through
+eagerly executed Celery tasks against a local SMTP sink and measures what it
+costs. Run it through `python manage.py bench_email`, which sets up a
+throw-away test database first.
+
+Modes:
+ - bulk_email: the daily campaign coordinator and its shards, unpaced
+ - batch: dispatch_batches, as used by the admin action
+ - create_email: one create_email task per patient via Patient.objects.send_emails
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime, timezone
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import override_settings
+
+from apps.patient.campaign import dispatch_batches
+from apps.patient.models import Patient
+from apps.patient.tasks import bulk_email
+from apps.study.models import Study
+from core.celery import app
+from libs.smtp_sink import SMTPSink
+from tasks.tasks import connection_pool
+
+MODES = ("bulk_email", "batch", "create_email")
+
+
+class QueryCounter:
+    """
+    A database execute wrapper counting the queries issued
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, pct):
+    '''
+    Nearest-rank percentile of a list of numbers
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, round(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def peak_rss_kb() -> int:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if platform.system() == "Darwin" else rss
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def seed(patients, studies=3):
+    '''
+    Create ``patients`` eligible patients spread over ``studies`` studies
+    '''
+    password = make_password(None)
+    study_objs = Study.objects.bulk_create(
+        [Study(name=f"Benchmark study {i}") for i in range(studies)]
+    )
+    User.objects.bulk_create(
+        [User(username=f"bench{i}", email=f"bench{i}@umed.io", password=password) for i in range(patients)],
+        batch_size=1000,
+    )
+    user_ids = User.objects.filter(username__startswith="bench").order_by("id").values_list("id", flat=True)
+    Patient.objects.bulk_create(
+        [Patient(user_id=user_id, study=study_objs[i % studies]) for i, user_id in enumerate(user_ids)],
+        batch_size=1000,
+    )
+
+
+def run(mode, shard_size=None, batch_size=None):
+    '''
+    Send the campaign email to every eligible patient using ``mode`` and
+    return the measurements
+    '''
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode {mode!r}, expected one of {MODES}")
+
+    eager = app.conf.task_always_eager
+    counter = QueryCounter()
+    rss_before = peak_rss_kb()
+    with SMTPSink() as sink, override_settings(
+        EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+        EMAIL_HOST=sink.host,
+        EMAIL_PORT=sink.port,
+        EMAIL_USE_TLS=False,
+        EMAIL_HOST_USER="benchmark@umed.io",
+        EMAIL_HOST_PASSWORD="",
+    ):
+        app.conf.task_always_eager = True
+        connection_pool.reset()
+        try:
+            with connection.execute_wrapper(counter):
+                start = time.perf_counter()
+                if mode == "bulk_email":
+                    bulk_email.delay(shard_size=shard_size or settings.CAMPAIGN_SHARD_SIZE, window_hours=0, run_key=None)
+                elif mode == "batch":
+                    dispatch_batches(Patient.objects.all(), batch_size)
+                else:
+                    Patient.objects.send_emails(Patient.objects.in_study().select_related("user"))
+                elapsed = time.perf_counter() - start
+        finally:
+            app.conf.task_always_eager = eager
+            connection_pool.reset()
+
+    # Time between consecutive arrivals at the sink: in an eager run this is
+    # the full cost of one message (query share, render, send)
+    arrivals = [start] + sink.arrivals
+    latencies = [(b - a) * 1000 for a, b in zip(arrivals, arrivals[1:])]
+    return {
+        "messages": sink.count,
+        "seconds": elapsed,
+        "messages_per_second": sink.count / elapsed if elapsed else None,
+        "latency_ms_p50": percentile(latencies, 50),
+        "latency_ms_p99": percentile(latencies, 99),
+        "latency_ms_max": max(latencies) if latencies else None,
+        "queries": counter.count,
+        "queries_per_message": counter.count / sink.count if sink.count else None,
+        "bytes_per_message": sink.bytes / sink.count if sink.count else None,
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_rss_growth_kb": peak_rss_kb() - rss_before,
+    }
+
+
+def environment() -> dict:
+    '''
+    What the results were measured on, so runs can be compared across commits
+    '''
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "machine": platform.machine(),
+        "database": connection.vendor,
+    }
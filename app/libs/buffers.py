@@ -0,0 +1,98 @@
+"""
+Append-only event buffers drained in batches.
+
+MemoryBuffer holds events in the current process, so only that process can
+drain it. RedisBuffer keeps them in a Redis list shared by every web and
+worker process, so a periodic task can drain what the others appended.
+Events must be JSON serialisable for RedisBuffer.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+import threading
+import time
+from collections import deque
+
+
+class MemoryBuffer:
+
+    """
+    A thread-safe in-process event buffer
+    """
+    def __init__(self):
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._oldest = None
+
+    def append(self, events):
+        '''
+        Add ``events``; returns the number buffered
+        '''
+        with self._lock:
+            if not self._events:
+                self._oldest = time.monotonic()
+            self._events.extend(events)
+            return len(self._events)
+
+    def drain(self, limit):
+        '''
+        Remove and return up to ``limit`` of the oldest events
+        '''
+        with self._lock:
+            events = [self._events.popleft() for _ in range(min(limit, len(self._events)))]
+            self._oldest = time.monotonic() if self._events else None
+        return events
+
+    def __len__(self):
+        return len(self._events)
+
+    def age(self):
+        '''
+        Seconds since the oldest buffered event was appended
+        '''
+        oldest = self._oldest
+        return 0.0 if oldest is None else time.monotonic() - oldest
+
+
+class RedisBuffer:
+
+    """
+    An event buffer in a Redis list, shared between processes
+    """
+    def __init__(self, url, key):
+        # Imported here so the memory buffer works without redis installed
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.key = key
+
+    def append(self, events):
+        if not events:
+            return len(self)
+        return self.client.rpush(self.key, *(json.dumps(event, separators=(",", ":")) for event in events))
+
+    def drain(self, limit):
+        '''
+        Remove and return up to ``limit`` of the oldest events; the read and
+        trim run in one transaction, so concurrent drains never share events
+        '''
+        pipe = self.client.pipeline(transaction=True)
+        pipe.lrange(self.key, 0, limit - 1)
+        pipe.ltrim(self.key, limit, -1)
+        events, _ = pipe.execute()
+        return [json.loads(event) for event in events]
+
+    def __len__(self):
+        return self.client.llen(self.key)
+
+    def age(self):
+        # Not tracked across processes; the periodic drain bounds it instead
+        return 0.0
+
+
+def make_buffer(url, key):
+    '''
+    A RedisBuffer when ``url`` is set, otherwise a MemoryBuffer
+    '''
+    return RedisBuffer(url, key) if url else MemoryBuffer()
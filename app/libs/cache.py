@@ -0,0 +1,424 @@
+"""
+Two-tier cache for hot lookups.
+
+Each key namespace ("study", "patient", ...) gets a TieredCache: a small
+per-process LRU in front of the shared Django cache (Redis). Reads check the
+local tier, then the shared tier, then call the loader.
+
+Keys are versioned per namespace: invalidate() drops one key from both tiers,
+invalidate_all() bumps the namespace version so every key written before it
+is ignored (used for bulk updates, where the affected keys are unknown).
+Other processes see a bumped version, and drop their local copy of a key
+deleted elsewhere, within CACHE_LOCAL_TTL seconds.
+
+The shared tier is best effort. When Redis cannot be reached, reads fall
+back to the local tier and the loader, and the write that triggered an
+invalidation goes ahead with only the local tier dropped; the shared tier
+then keeps serving the old values for at most CACHE_TIMEOUT seconds.
+
+Concurrent misses for the same key are coalesced: within a process callers
+wait on one loader, and across processes the first to take a short lock in
+the shared cache loads while the others poll for its result.
+
+Hit and miss counters are kept per namespace and per process, and added to
+counters in the shared cache every CACHE_METRICS_INTERVAL seconds so the
+cache_stats command can report them for the whole deployment.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+try:
+    from redis.exceptions import RedisError
+except ImportError:
+    # Without redis installed no cache backend raises it
+    RedisError = ()
+
+MISSING = object()
+
+# Namespace version used while the shared tier cannot be reached
+OFFLINE = "offline"
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ("local_hits", "shared_hits", "misses", "coalesced", "lock_timeouts", "invalidations", "evictions")
+
+# Seconds between polls of the shared cache while another process loads a key
+POLL_INTERVAL = 0.05
+
+namespaces = {}
+
+
+class TieredCache:
+
+    """
+    Per-process LRU in front of the shared cache for one key namespace
+    """
+    def __init__(self, namespace, timeout=None, local_size=None, local_ttl=None, alias="default"):
+        self.namespace = namespace
+        self.timeout = settings.CACHE_TIMEOUT if timeout is None else timeout
+        self.local_size = settings.CACHE_LOCAL_SIZE if local_size is None else local_size
+        self.local_ttl = settings.CACHE_LOCAL_TTL if local_ttl is None else local_ttl
+        self.alias = alias
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._afutures = {}
+        self._version = None
+        self._version_checked = 0.0
+        self._counters = dict.fromkeys(COUNTERS, 0)
+        self._published = dict.fromkeys(COUNTERS, 0)
+        self._published_at = time.monotonic()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    # --------------------------------------------------------------
+    # Versions and keys
+    # --------------------------------------------------------------
+    def _version_key(self):
+        return f"{self.namespace}:version"
+
+    def version(self):
+        '''
+        The namespace version, re-read from the shared cache at most every
+        local_ttl seconds
+        '''
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= self.local_ttl:
+            try:
+                self.shared.add(self._version_key(), 1, None)
+                self._version = self.shared.get(self._version_key(), 1)
+            except RedisError:
+                self._unreachable("read the version")
+                self._version = OFFLINE
+            self._version_checked = now
+        return self._version
+
+    def _shared_key(self, key, version):
+        return f"{self.namespace}:{version}:{key}"
+
+    def _unreachable(self, action):
+        logger.warning(f"Cache {self.namespace}: could not {action} in the shared tier", exc_info=True)
+
+    # --------------------------------------------------------------
+    # Local tier
+    # --------------------------------------------------------------
+    def _local_get(self, key, version):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return MISSING
+            expires, entry_version, value = entry
+            if entry_version != version or expires < time.monotonic():
+                del self._local[key]
+                return MISSING
+            self._local.move_to_end(key)
+            self._counters["local_hits"] += 1
+            return value
+
+    def _local_set(self, key, version, value):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_ttl, version, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+                self._counters["evictions"] += 1
+
+    # --------------------------------------------------------------
+    # Reads
+    # --------------------------------------------------------------
+    def _flight(self, key):
+        with self._lock:
+            return self._flights.setdefault(key, threading.Lock())
+
+    def get_or_set(self, key, loader):
+        '''
+        The cached value for ``key``, calling ``loader()`` on a miss. None is
+        a valid, cached value.
+        '''
+        key = str(key)
+        version = self.version()
+        value = self._local_get(key, version)
+        if value is not MISSING:
+            self.publish()
+            return value
+
+        flight = self._flight(key)
+        with flight:
+            value = self._local_get(key, version)
+            if value is not MISSING:
+                # Another thread loaded it while this one waited
+                self._count("coalesced")
+                return value
+            value = self._shared_get(key, version)
+            if value is MISSING:
+                value = self._load(key, version, loader)
+            self._local_set(key, version, value)
+        with self._lock:
+            if self._flights.get(key) is flight and not flight.locked():
+                del self._flights[key]
+        self.publish()
+        return value
+
+    def _shared_get(self, key, version):
+        if version is OFFLINE:
+            return MISSING
+        try:
+            wrapped = self.shared.get(self._shared_key(key, version))
+        except RedisError:
+            self._unreachable(f"read {key}")
+            return MISSING
+        if wrapped is None:
+            return MISSING
+        self._count("shared_hits")
+        return wrapped[0]
+
+    def _load(self, key, version, loader):
+        if version is OFFLINE:
+            self._count("misses")
+            return loader()
+        shared_key = self._shared_key(key, version)
+        lock_key, token = f"{shared_key}:lock", uuid.uuid4().hex
+        try:
+            if not self.shared.add(lock_key, token, settings.CACHE_LOCK_TIMEOUT):
+                deadline = time.monotonic() + settings.CACHE_LOCK_TIMEOUT
+                while time.monotonic() < deadline:
+                    time.sleep(POLL_INTERVAL)
+                    wrapped = self.shared.get(shared_key)
+                    if wrapped is not None:
+                        self._count("coalesced")
+                        return wrapped[0]
+                # The loading process died or is stuck; load regardless
+                self._count("lock_timeouts")
+        except RedisError:
+            self._unreachable(f"lock {key}")
+        self._count("misses")
+        try:
+            value = loader()
+            # Values are wrapped so that a cached None is told apart from a miss
+            self.shared.set(shared_key, (value,), self.timeout)
+        except RedisError:
+            self._unreachable(f"store {key}")
+        finally:
+            try:
+                if self.shared.get(lock_key) == token:
+                    self.shared.delete(lock_key)
+            except RedisError:
+                # The lock expires on its own
+                pass
+        return value
+
+    async def aget_or_set(self, key, loader):
+        '''
+        Async get_or_set for ASGI views; ``loader`` is a coroutine function
+        '''
+        key = str(key)
+        version = await self.aversion()
+        value = self._local_get(key, version)
+        if value is not MISSING:
+            self.publish()
+            return value
+
+        future = self._afutures.get(key)
+        if future is not None:
+            self._count("coalesced")
+            return await asyncio.shield(future)
+        future = self._afutures[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await self._aload(key, version, loader)
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Mark it retrieved so an unawaited failure is not reported again
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            self._local_set(key, version, value)
+        finally:
+            del self._afutures[key]
+        self.publish()
+        return value
+
+    async def aversion(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= self.local_ttl:
+            try:
+                await self.shared.aadd(self._version_key(), 1, None)
+                self._version = await self.shared.aget(self._version_key(), 1)
+            except RedisError:
+                self._unreachable("read the version")
+                self._version = OFFLINE
+            self._version_checked = now
+        return self._version
+
+    async def _aload(self, key, version, loader):
+        if version is OFFLINE:
+            self._count("misses")
+            return await loader()
+        shared_key = self._shared_key(key, version)
+        lock_key, token = f"{shared_key}:lock", uuid.uuid4().hex
+        try:
+            wrapped = await self.shared.aget(shared_key)
+            if wrapped is not None:
+                self._count("shared_hits")
+                return wrapped[0]
+            if not await self.shared.aadd(lock_key, token, settings.CACHE_LOCK_TIMEOUT):
+                deadline = time.monotonic() + settings.CACHE_LOCK_TIMEOUT
+                while time.monotonic() < deadline:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    wrapped = await self.shared.aget(shared_key)
+                    if wrapped is not None:
+                        self._count("coalesced")
+                        return wrapped[0]
+                self._count("lock_timeouts")
+        except RedisError:
+            self._unreachable(f"lock {key}")
+        self._count("misses")
+        try:
+            value = await loader()
+            await self.shared.aset(shared_key, (value,), self.timeout)
+        except RedisError:
+            self._unreachable(f"store {key}")
+        finally:
+            try:
+                if await self.shared.aget(lock_key) == token:
+                    await self.shared.adelete(lock_key)
+            except RedisError:
+                pass
+        return value
+
+    # --------------------------------------------------------------
+    # Invalidation
+    # --------------------------------------------------------------
+    def invalidate(self, key):
+        '''
+        Drop ``key`` from both tiers, now and again when the current
+        transaction commits (a reader may re-cache the old row in between)
+        '''
+        key = str(key)
+        self._invalidate(key)
+        if connection.in_atomic_block:
+            transaction.on_commit(lambda: self._invalidate(key))
+
+    def _invalidate(self, key):
+        with self._lock:
+            self._local.pop(key, None)
+            self._counters["invalidations"] += 1
+        try:
+            self.shared.delete(self._shared_key(key, self.version()))
+        except RedisError:
+            self._unreachable(f"invalidate {key}")
+
+    def invalidate_all(self):
+        '''
+        Retire every key of the namespace by bumping its version
+        '''
+        self._invalidate_all()
+        if connection.in_atomic_block:
+            transaction.on_commit(self._invalidate_all)
+
+    def _invalidate_all(self):
+        try:
+            version = self._bump_version()
+        except RedisError:
+            self._unreachable("invalidate the namespace")
+            # Re-read the version on the next lookup
+            version = None
+        with self._lock:
+            self._local.clear()
+            self._counters["invalidations"] += 1
+            self._version, self._version_checked = version, time.monotonic()
+
+    def _bump_version(self):
+        self.shared.add(self._version_key(), 1, None)
+        try:
+            return self.shared.incr(self._version_key())
+        except ValueError:
+            # Evicted between add() and incr()
+            self.shared.set(self._version_key(), 2, None)
+            return 2
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+            self._version = None
+
+    # --------------------------------------------------------------
+    # Metrics
+    # --------------------------------------------------------------
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["local_size"] = len(self._local)
+        return with_hit_rate(counters)
+
+    def publish(self, force=False):
+        '''
+        Add the counters accumulated since the last publish to the shared
+        counters, at most every CACHE_METRICS_INTERVAL seconds
+        '''
+        now = time.monotonic()
+        if not force and now - self._published_at < settings.CACHE_METRICS_INTERVAL:
+            return
+        with self._lock:
+            counters = dict(self._counters)
+            deltas = {counter: counters[counter] - self._published[counter] for counter in COUNTERS}
+            self._published, self._published_at = counters, now
+        try:
+            for counter, delta in deltas.items():
+                if delta:
+                    key = f"cache-stats:{self.namespace}:{counter}"
+                    self.shared.add(key, 0, None)
+                    self.shared.incr(key, delta)
+        except RedisError:
+            # Metrics only; these counts are not published
+            self._unreachable("publish metrics")
+
+    def shared_stats(self):
+        keys = {f"cache-stats:{self.namespace}:{counter}": counter for counter in COUNTERS}
+        values = self.shared.get_many(list(keys))
+        return with_hit_rate({counter: values.get(key, 0) for key, counter in keys.items()})
+
+
+def with_hit_rate(counters):
+    hits = counters["local_hits"] + counters["shared_hits"] + counters["coalesced"]
+    lookups = hits + counters["misses"]
+    counters["hit_rate"] = hits / lookups if lookups else 0.0
+    return counters
+
+
+def tiered(namespace, **kwargs):
+    '''
+    The TieredCache for ``namespace``, created on first use
+    '''
+    if namespace not in namespaces:
+        namespaces[namespace] = TieredCache(namespace, **kwargs)
+    return namespaces[namespace]
+
+
+def stats():
+    return {namespace: cache.stats() for namespace, cache in namespaces.items()}
+
+
+def publish():
+    for cache in namespaces.values():
+        cache.publish(force=True)
@@ -1,10 +1,13 @@
-from factory import lazy_attribute, SubFactory
-from factory.django import DjangoModelFactory
+from types import SimpleNamespace
+
+from factory import lazy_attribute, Sequence, SubFactory, Transformer
+from factory.django import DjangoModelFactory, Password
 from faker import Faker
 
 from apps.care_provider.models import CareProvider
 from apps.patient.models import Patient
 from apps.study.models import Study
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 
 Faker.seed(0)
@@ -30,9 +33,10 @@ class UserFactory(DjangoModelFactory):
 
     first_name = lazy_attribute(lambda u: fake.first_name())
     last_name = lazy_attribute(lambda u: fake.last_name())
-    username = lazy_attribute(lambda u: f"{fake.user_name()}{fake.pyint()}")
-    email = lazy_attribute(lambda u: f"{fake.pyint()}{fake.email()}")
-    password = "password0101"
+    # Sequenced, so large batches never collide
+    username = Sequence(lambda n: f"{fake.user_name()}{n}")
+    email = Sequence(lambda n: f"{n}{fake.email()}")
+    password = Password("password0101")
 
 
 class StudyFactory(DjangoModelFactory):
@@ -51,4 +55,29 @@ class PatientFactory(DjangoModelFactory):
         model = Patient
 
     user = SubFactory(UserFactory)
-    study = SubFactory(Study)
+    study = SubFactory(StudyFactory)
+
+
+def build_dataset(patients=1000, studies=10, care_providers=2, password="password0101", batch_size=1000, **patient_fields):
+    '''
+    Insert a dataset of ``patients`` patients (with their users) spread evenly
+    across ``studies`` studies, plus ``care_providers`` care providers, with
+    bulk_create and one password hash shared by every user. Returns the
+    created objects as .care_providers, .studies, .users and .patients.
+
+    ``patient_fields`` are set on every patient (e.g. status=10).
+    '''
+    care_providers = CareProvider.objects.bulk_create(CareProviderFactory.build_batch(care_providers))
+    studies = Study.objects.bulk_create(StudyFactory.build_batch(studies))
+    # Hashed once here rather than once per user by the factory
+    users = User.objects.bulk_create(
+        UserFactory.build_batch(patients, password=Transformer.Force(make_password(password))), batch_size=batch_size
+    )
+    patients = Patient.objects.bulk_create(
+        [
+            Patient(user=user, study=studies[i % len(studies)], **patient_fields)
+            for i, user in enumerate(users)
+        ],
+        batch_size=batch_size,
+    )
+    return SimpleNamespace(care_providers=care_providers, studies=studies, users=users, patients=patients)
@@ -0,0 +1,315 @@
+"""
+Lease locks with fencing tokens, held in Redis.
+
+A LeaseLock is a key that expires after ``ttl`` seconds unless its holder
+renews it; a heartbeat thread renews it every ttl / 3 seconds while the
+holder runs, so a crashed or partitioned holder loses it within ``ttl``.
+
+Each acquisition also takes the next value of a per-lock counter, the
+fencing token. A holder that stalled past its lease (GC pause, lost network)
+may still believe it holds the lock, so writes it makes must carry the token
+and the database must refuse any token older than one it has already seen;
+see claim_shard() and record_shard_result() in apps.patient.campaign.
+
+Acquire, renew and release are Lua scripts, so each is atomic in Redis.
+SCRIPTS maps each script to a Python equivalent, which the in-process
+LocalStore runs instead. Without LOCK_URL (tests, the offline benchmark, a
+single development process) leases are held in a LocalStore, which excludes
+nothing outside its process; using one outside tests logs a warning.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return false
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], ARGV[1] .. ':' .. token, 'px', ARGV[2])
+return token
+"""
+
+RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _acquire(client, keys, args):
+    if client.exists(keys[0]):
+        return None
+    token = client.incr(keys[1])
+    client.set(keys[0], f"{args[0]}:{token}", px=int(args[1]))
+    return token
+
+
+def _renew(client, keys, args):
+    if client.get(keys[0]) == str(args[0]).encode():
+        return int(client.pexpire(keys[0], int(args[1])))
+    return 0
+
+
+def _release(client, keys, args):
+    if client.get(keys[0]) == str(args[0]).encode():
+        return client.delete(keys[0])
+    return 0
+
+
+SCRIPTS = {ACQUIRE: _acquire, RENEW: _renew, RELEASE: _release}
+
+_client = None
+
+
+class LockHeld(Exception):
+    """
+    Another process holds the lease
+    """
+
+
+class LeaseLost(Exception):
+    """
+    The lease expired or was taken over while its holder was still working
+    """
+
+
+class LocalStore:
+    """
+    An in-process stand-in for the few Redis commands the lease locks use,
+    with expiry driven by ``clock`` so tests can move time forward. Scripts
+    run their Python equivalent from SCRIPTS, atomically.
+    """
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def _alive(self, name):
+        expires = self._expires.get(name)
+        if expires is not None and expires <= self.clock():
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+        return name in self._data
+
+    def get(self, name):
+        with self._lock:
+            return self._data[name] if self._alive(name) else None
+
+    def set(self, name, value, px=None, nx=False):
+        with self._lock:
+            if nx and self._alive(name):
+                return None
+            self._data[name] = str(value).encode()
+            self._expires.pop(name, None)
+            if px is not None:
+                self._expires[name] = self.clock() + px / 1000
+            return True
+
+    def exists(self, name):
+        with self._lock:
+            return int(self._alive(name))
+
+    def delete(self, name):
+        with self._lock:
+            existed = self._alive(name)
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+            return int(existed)
+
+    def incr(self, name):
+        with self._lock:
+            value = int(self._data[name]) + 1 if self._alive(name) else 1
+            self._data[name] = str(value).encode()
+            return value
+
+    def pexpire(self, name, milliseconds):
+        with self._lock:
+            if not self._alive(name):
+                return False
+            self._expires[name] = self.clock() + milliseconds / 1000
+            return True
+
+    def pttl(self, name):
+        with self._lock:
+            if not self._alive(name):
+                return -2
+            expires = self._expires.get(name)
+            return -1 if expires is None else int((expires - self.clock()) * 1000)
+
+    def register_script(self, script):
+        function = SCRIPTS[script]
+
+        def run(keys=(), args=()):
+            with self._lock:
+                return function(self, list(keys), list(args))
+        return run
+
+
+def get_client():
+    '''
+    The Redis client for LOCK_URL, or a process-local LocalStore without one
+    '''
+    global _client
+    if _client is None:
+        if settings.LOCK_URL:
+            # Imported here so LocalStore works without redis installed
+            import redis
+
+            _client = redis.Redis.from_url(settings.LOCK_URL)
+        else:
+            if not settings.TESTING:
+                logger.warning("LOCK_URL is not set: leases are held in this process and exclude no other worker")
+            _client = LocalStore()
+    return _client
+
+
+@receiver(setting_changed)
+def reset_client(setting, **kwargs):
+    # override_settings(LOCK_URL=...) takes effect for the next lease
+    global _client
+    if setting == "LOCK_URL":
+        _client = None
+
+
+def is_held(name, client=None) -> bool:
+    '''
+    Whether anyone holds the lease ``name`` right now
+    '''
+    client = client or get_client()
+    return bool(client.exists(f"lease:{name}"))
+
+
+class LeaseLock:
+
+    """
+    A renewable, expiring lock on ``name``, with a fencing token per
+    acquisition:
+
+        with LeaseLock("campaign-coordinator") as lease:
+            ...
+            lease.check()  # raises LeaseLost once it is gone
+    """
+    def __init__(self, name, ttl=None, client=None):
+        self.name = name
+        self.key = f"lease:{name}"
+        self.fence_key = f"lease:{name}:fence"
+        self.ttl = settings.LOCK_TTL if ttl is None else ttl
+        self.client = client or get_client()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+        self.token = None
+        self.lost = threading.Event()
+        self._expires = 0.0
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self._scripts = {script: self.client.register_script(script) for script in SCRIPTS}
+
+    @property
+    def value(self):
+        return f"{self.owner}:{self.token}"
+
+    @property
+    def held(self):
+        return self.token is not None and not self.lost.is_set()
+
+    def acquire(self, heartbeat=True) -> bool:
+        '''
+        Take the lease if it is free; returns whether it was taken. The
+        fencing token is in ``token`` afterwards.
+        '''
+        ttl_ms = int(self.ttl * 1000)
+        token = self._scripts[ACQUIRE](keys=[self.key, self.fence_key], args=[self.owner, ttl_ms])
+        if token is None:
+            return False
+        self.token = int(token)
+        self._expires = time.monotonic() + self.ttl
+        self.lost.clear()
+        if heartbeat:
+            self._stop.clear()
+            self._heartbeat = threading.Thread(target=self._beat, name=f"lease-{self.name}", daemon=True)
+            self._heartbeat.start()
+        return True
+
+    def renew(self) -> bool:
+        '''
+        Extend the lease by ``ttl``; False once it has been lost
+        '''
+        if self.token is None or self.lost.is_set():
+            return False
+        deadline = time.monotonic() + self.ttl
+        if not self._scripts[RENEW](keys=[self.key], args=[self.value, int(self.ttl * 1000)]):
+            self.lost.set()
+            return False
+        self._expires = deadline
+        return True
+
+    def release(self):
+        '''
+        Stop the heartbeat and free the lease, unless it has passed to
+        another holder meanwhile
+        '''
+        self._stop.set()
+        if self._heartbeat is not None and self._heartbeat is not threading.current_thread():
+            self._heartbeat.join()
+        self._heartbeat = None
+        if self.token is not None:
+            try:
+                self._scripts[RELEASE](keys=[self.key], args=[self.value])
+            except Exception:
+                # It expires on its own
+                logger.warning(f"Could not release lease {self.name}", exc_info=True)
+        self.token = None
+
+    def check(self):
+        '''
+        Raise LeaseLost unless the lease is still held; call between units
+        of work the lease protects
+        '''
+        if self.lost.is_set() or time.monotonic() >= self._expires:
+            self.lost.set()
+            raise LeaseLost(f"Lease {self.name} (token {self.token}) lost")
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                if not self.renew():
+                    logger.warning(f"Lease {self.name} (token {self.token}) was taken over")
+                    return
+            except Exception:
+                # Keep trying until the lease would have expired anyway
+                logger.warning(f"Could not renew lease {self.name}", exc_info=True)
+                if time.monotonic() >= self._expires:
+                    self.lost.set()
+                    return
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockHeld(f"Lease {self.name} is held elsewhere")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
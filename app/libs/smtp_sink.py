@@ -0,0 +1,89 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import socketserver
+import threading
+import time
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib (and so Django's smtp backend) to
+    deliver messages: EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP and QUIT.
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost SMTP sink")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.wfile.write(b"250-localhost\r\n250 8BITMIME\r\n")
+            elif command in (b"HELO", b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self.reply("250 OK")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data == b".\r\n":
+                        break
+                    size += len(data)
+                self.server.sink.received(size)
+                self.reply("250 OK: queued")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SMTPSink:
+    """
+    A local SMTP server that accepts and discards every message, recording
+    when each one arrived. Use it as a context manager:
+
+        with SMTPSink() as sink:
+            ...send to 127.0.0.1:sink.port...
+        sink.count, sink.arrivals
+    """
+    def __init__(self, host="127.0.0.1", port=0):
+        self._server = _Server((host, port), _SMTPHandler)
+        self._server.sink = self
+        self._lock = threading.Lock()
+        self._thread = None
+        self.host, self.port = self._server.server_address
+        self.arrivals = []
+        self.bytes = 0
+
+    def received(self, size):
+        with self._lock:
+            self.arrivals.append(time.perf_counter())
+            self.bytes += size
+
+    @property
+    def count(self):
+        return len(self.arrivals)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,131 @@
+"""
+Test runner that builds the SQLite test database once and copies it.
+
+Running every migration is the slowest part of starting the suite. The first
+run saves the migrated database as a template in TEST_DB_TEMPLATE_DIR; later
+runs copy that template into the in-memory test database with SQLite's backup
+API, which takes milliseconds. Templates are keyed by a hash of every migration
+file and the Django version, so changing either builds a new one.
+
+The template holds no data: tests build theirs with libs.factories, in
+setUpTestData, rather than loading the YAML fixtures.
+
+Other database engines, --keepdb and --parallel fall back to Django's usual
+setup.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import hashlib
+import os
+import sqlite3
+import time
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+import django
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+
+
+def template_key() -> str:
+    '''
+    A hash of everything that shapes the migrated test database
+    '''
+    digest = hashlib.sha256(django.get_version().encode())
+    paths = []
+    for app_config in apps.get_app_configs():
+        migrations = os.path.join(app_config.path, "migrations")
+        if os.path.isdir(migrations):
+            paths.extend(
+                os.path.join(migrations, name) for name in os.listdir(migrations) if name.endswith(".py")
+            )
+    for path in sorted(paths):
+        digest.update(path.encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class TemplateDatabaseRunner(DiscoverRunner):
+
+    """
+    DiscoverRunner that restores the test database from a cached template
+    """
+    def template_path(self, alias):
+        return os.path.join(settings.TEST_DB_TEMPLATE_DIR, f"{alias}-{template_key()}.sqlite3")
+
+    def usable(self):
+        return (
+            settings.TEST_DB_TEMPLATE_DIR
+            and not self.keepdb
+            and self.parallel <= 1
+            and all(connections[alias].vendor == "sqlite" for alias in connections)
+        )
+
+    def setup_databases(self, aliases=None, serialized_aliases=None, **kwargs):
+        if not self.usable():
+            return super().setup_databases(aliases=aliases, serialized_aliases=serialized_aliases, **kwargs)
+
+        aliases = list(connections if aliases is None else aliases)
+        templates = {alias: self.template_path(alias) for alias in aliases}
+        if all(os.path.exists(path) for path in templates.values()):
+            serialized = aliases if serialized_aliases is None else serialized_aliases
+            return [
+                (connections[alias], self._restore(alias, path, alias in serialized), True)
+                for alias, path in templates.items()
+            ]
+
+        old_config = super().setup_databases(aliases=aliases, serialized_aliases=serialized_aliases, **kwargs)
+        for alias, path in templates.items():
+            self._save(alias, path)
+        return old_config
+
+    def _save(self, alias, path):
+        connection = connections[alias]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{os.getpid()}"
+        connection.ensure_connection()
+        target = sqlite3.connect(partial)
+        try:
+            connection.connection.backup(target)
+        finally:
+            target.close()
+        # Another run may be saving the same template; either copy is complete
+        os.replace(partial, path)
+        if self.verbosity >= 1:
+            self.log(f"Saved test database template {path}")
+
+    def _restore(self, alias, path, serialize):
+        '''
+        Create the test database for ``alias`` as create_test_db() does, but
+        from the template instead of migrations; returns the old database name
+        '''
+        start = time.perf_counter()
+        connection = connections[alias]
+        creation = connection.creation
+        old_name = connection.settings_dict["NAME"]
+        test_name = creation._get_test_db_name()
+        creation._create_test_db(self.verbosity, autoclobber=not self.interactive)
+        connection.close()
+        settings.DATABASES[alias]["NAME"] = test_name
+        connection.settings_dict["NAME"] = test_name
+
+        connection.ensure_connection()
+        source = sqlite3.connect(path)
+        try:
+            source.backup(connection.connection)
+        finally:
+            source.close()
+        if serialize:
+            # For TransactionTestCase.serialized_rollback, as create_test_db() would
+            connection._test_serialized_contents = creation.serialize_db_to_string()
+        if self.verbosity >= 1:
+            self.log(
+                f"Restored test database for alias '{alias}' from {os.path.basename(path)} "
+                f"in {time.perf_counter() - start:.3f}s"
+            )
+        return old_name
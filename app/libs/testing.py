@@ -0,0 +1,72 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import os
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+
+
+# Wall-time budgets are multiplied by this, for slow CI machines
+TIME_FACTOR = float(os.environ.get("PERF_TIME_FACTOR", 1))
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalise_sql(sql) -> str:
+    '''
+    Replace literals with ? so the same query issued for different rows
+    compares equal
+    '''
+    return _LITERALS.sub("?", sql)
+
+
+def describe_queries(queries, limit) -> str:
+    '''
+    A readable report of the queries issued against a budget: repeated
+    statements first (the usual sign of a per-row query), then the full list
+    '''
+    statements = [query["sql"] for query in queries]
+    repeated = [(count, sql) for sql, count in Counter(map(normalise_sql, statements)).most_common() if count > 1]
+
+    lines = [f"{len(statements)} queries issued, budget is {limit} (+{len(statements) - limit})"]
+    if repeated:
+        lines.append("Repeated statements:")
+        lines.extend(f"  {count}x {sql}" for count, sql in repeated)
+    lines.append("All statements:")
+    lines.extend(
+        f"{'+' if i > limit else ' '} {i}. {sql}" for i, sql in enumerate(statements, start=1)
+    )
+    return "\n".join(lines)
+
+
+class PerformanceTestMixin:
+    """
+    Assertions that keep hot paths from regressing silently. Use with a
+    django.test.TestCase:
+
+        with self.assertMaxQueries(5), self.assertMaxDuration(0.5):
+            ...
+    """
+    @contextmanager
+    def assertMaxQueries(self, limit, using="default"):
+        with CaptureQueriesContext(connections[using]) as context:
+            yield context
+        if len(context.captured_queries) > limit:
+            self.fail(describe_queries(context.captured_queries, limit))
+
+    @contextmanager
+    def assertMaxDuration(self, seconds):
+        budget = seconds * TIME_FACTOR
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        if elapsed > budget:
+            self.fail(f"Took {elapsed:.3f}s, budget is {budget:.3f}s (PERF_TIME_FACTOR={TIME_FACTOR})")
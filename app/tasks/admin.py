@@ -0,0 +1,18 @@
+from django.contrib import admin
+
+from tasks.models import DeadLetter, Suppression
+
+
+@admin.register(DeadLetter)
+class DeadLetterAdmin(admin.ModelAdmin):
+
+    list_display = ("id", "email", "reason", "smtp_code", "attempts", "created")
+    list_filter = ("reason", "smtp_code")
+
+
+@admin.register(Suppression)
+class SuppressionAdmin(admin.ModelAdmin):
+
+    list_display = ("id", "email", "reason", "created")
+    list_filter = ("reason",)
+    search_fields = ("email",)
@@ -0,0 +1,118 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import email.errors
+import random
+import smtplib
+import socket
+from collections import namedtuple
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.mail import BadHeaderError
+
+from tasks.models import DeadLetter, Suppression
+from tasks.signals import email_dead_lettered
+from tasks.suppression import index
+
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+SYSTEMIC = "systemic"
+
+# kind: TRANSIENT, PERMANENT or SYSTEMIC
+# code: the SMTP reply code, if any
+# suppress: the failure is caused by the recipient address, so stop mailing it
+Failure = namedtuple("Failure", ["kind", "code", "suppress"])
+
+# 5xx replies to DATA that mean "this mailbox", not "this server"
+MAILBOX_CODES = {550, 551, 552, 553}
+
+# Failures of our own set-up (credentials, sender, greeting) rather than of a
+# recipient: every message would fail the same way until it is fixed
+SYSTEMIC_ERRORS = (
+    smtplib.SMTPAuthenticationError,
+    smtplib.SMTPSenderRefused,
+    smtplib.SMTPHeloError,
+    smtplib.SMTPConnectError,
+)
+
+
+class SystemicFailure(Exception):
+    """
+    Raised from a bulk send on a SYSTEMIC failure, so the whole batch is
+    retried or failed rather than each recipient dead-lettered
+    """
+
+
+def classify(exc) -> Failure:
+    '''
+    Decide whether a send failure is worth retrying.
+
+    4xx replies, dropped connections and timeouts are transient. Rejected
+    credentials, sender or greeting are systemic, whatever the code. Other
+    5xx replies are permanent; they only suppress the address when the server
+    rejected the recipient. A message the email package cannot build is
+    permanent but says nothing about the address. Anything unrecognised is
+    treated as transient so it is retried a bounded number of times.
+    '''
+    if isinstance(exc, SYSTEMIC_ERRORS):
+        return Failure(SYSTEMIC, exc.smtp_code, False)
+
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        code = max(codes) if codes else None
+        if code and code >= 500:
+            return Failure(PERMANENT, code, True)
+        return Failure(TRANSIENT, code, False)
+
+    if isinstance(exc, smtplib.SMTPResponseException):
+        code = exc.smtp_code
+        if 500 <= code < 600:
+            suppress = isinstance(exc, smtplib.SMTPDataError) and code in MAILBOX_CODES
+            return Failure(PERMANENT, code, suppress)
+        return Failure(TRANSIENT, code, False)
+
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, socket.timeout, ConnectionError, TimeoutError)):
+        return Failure(TRANSIENT, None, False)
+
+    if isinstance(exc, (BadHeaderError, email.errors.MessageError)) or _invalid_address(exc):
+        return Failure(PERMANENT, None, False)
+
+    return Failure(TRANSIENT, None, False)
+
+
+def _invalid_address(exc) -> bool:
+    # sanitize_address() reports addresses it cannot parse as a plain ValueError
+    return isinstance(exc, ValueError) and str(exc).startswith("Invalid address")
+
+
+def backoff(retries) -> float:
+    '''
+    Seconds to wait before retry number ``retries + 1``: exponential in the
+    number of attempts so far, capped, with full jitter so retries from a
+    burst of failures do not all land on the provider at the same moment.
+    '''
+    ceiling = min(settings.EMAIL_RETRY_BACKOFF_MAX, settings.EMAIL_RETRY_BACKOFF * 2 ** retries)
+    return random.uniform(0, ceiling)
+
+
+def dead_letter(email, failure, exc, payload, attempts=1) -> DeadLetter:
+    '''
+    Record an email that will not be retried and tell listeners about it
+    '''
+    letter = DeadLetter.objects.create(
+        email=email,
+        reason="permanent" if failure.kind == PERMANENT else "exhausted",
+        smtp_code=failure.code,
+        error=repr(exc),
+        attempts=attempts,
+        payload=payload,
+    )
+    if failure.suppress:
+        Suppression.objects.suppress(email, "bounced")
+        index.add(email)
+    email_dead_lettered.send(sender=DeadLetter, email=email, suppress=failure.suppress)
+    return letter
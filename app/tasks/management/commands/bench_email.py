@@ -0,0 +1,65 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+import os
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from apps.patient import tracking, transitions
+from libs import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed patients into a throw-away test database and measure end-to-end "
+        "email throughput against a local SMTP sink. Results are appended to a "
+        "JSON file so runs can be compared across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--patients", type=int, default=1000)
+        parser.add_argument("--studies", type=int, default=3)
+        parser.add_argument("--mode", choices=benchmark.MODES, action="append", help="Send path(s) to measure; defaults to all.")
+        parser.add_argument("--shard-size", type=int)
+        parser.add_argument("--batch-size", type=int)
+        parser.add_argument("--output", default="bench_results.json", help="JSON file the run is appended to.")
+
+    # Runnable offline: caches and leases live in this process rather than in Redis
+    @override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}, LOCK_URL="")
+    def handle(self, *args, **options):
+        modes = options["mode"] or benchmark.MODES
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            benchmark.seed(options["patients"], options["studies"])
+            run = {
+                **benchmark.environment(),
+                "params": {k: options[k] for k in ("patients", "studies", "shard_size", "batch_size")},
+                "results": {},
+            }
+            for mode in modes:
+                result = benchmark.run(mode, options["shard_size"], options["batch_size"])
+                run["results"][mode] = result
+                self.stdout.write(
+                    f"{mode:<13} {result['messages']:>7} msgs {result['messages_per_second']:>9.1f} msg/s "
+                    f"p50 {result['latency_ms_p50']:.2f} ms p99 {result['latency_ms_p99']:.2f} ms "
+                    f"{result['queries_per_message']:.3f} queries/msg peak RSS {result['peak_rss_kb'] / 1024:.0f} MiB"
+                )
+        finally:
+            # Events buffered by the run belong to the throw-away database
+            transitions.flush_local()
+            tracking.flush_local()
+            teardown_databases(old_config, verbosity=0)
+
+        runs = []
+        if os.path.exists(options["output"]):
+            with open(options["output"]) as f:
+                runs = json.load(f)
+        runs.append(run)
+        with open(options["output"], "w") as f:
+            json.dump(runs, f, indent=2)
+        self.stdout.write(f"Results appended to {options['output']}")
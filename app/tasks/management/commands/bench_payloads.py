@@ -0,0 +1,111 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+import time
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.core.management.base import BaseCommand
+
+# --------------------------------------------------------------
+# 3rd party imports
+# --------------------------------------------------------------
+from kombu import compression, serialization
+
+from tasks.payloads import iter_batch, make_batch
+
+
+CONTEXT = {
+    'care_provider_contact': 'Dr Smith',
+    'care_provider_name': "Smith's Surgery",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the broker message size and encode/decode cost of per-recipient "
+        "create_email payloads with batched send_email_batch payloads."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=10000)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--repeat", type=int, default=5, help="Take the best of this many runs.")
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        n, size = options["recipients"], options["batch_size"]
+        recipients = [(f"patient.{i}@umed.io", f"patient{i}") for i in range(n)]
+
+        legacy = [
+            {"email": email, "cc": [], "context": {"patient_username": username, **CONTEXT}}
+            for email, username in recipients
+        ]
+        batches = [make_batch(recipients[i:i + size], CONTEXT) for i in range(0, n, size)]
+
+        formats = [("per-recipient", legacy, "json", None)]
+        for serializer in ("json", "msgpack"):
+            for method in (None, "zlib"):
+                formats.append(("batch", batches, serializer, method))
+
+        results = []
+        for name, bodies, serializer, method in formats:
+            try:
+                result = self.measure(bodies, serializer, method, options["repeat"])
+            except Exception as exc:  # msgpack is optional
+                self.stderr.write(f"Skipping {name} {serializer}: {exc}")
+                continue
+            results.append({
+                "format": name,
+                "serializer": serializer,
+                "compression": method or "-",
+                "messages": len(bodies),
+                "bytes_per_recipient": result["bytes"] / n,
+                "encode_us_per_recipient": result["encode"] / n * 1e6,
+                "decode_us_per_recipient": result["decode"] / n * 1e6,
+            })
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'format':<14}{'serializer':<11}{'compression':<12}{'messages':>9}{'B/rcpt':>9}{'enc us':>9}{'dec us':>9}")
+        for r in results:
+            self.stdout.write(
+                f"{r['format']:<14}{r['serializer']:<11}{r['compression']:<12}{r['messages']:>9}"
+                f"{r['bytes_per_recipient']:>9.1f}{r['encode_us_per_recipient']:>9.2f}{r['decode_us_per_recipient']:>9.2f}"
+            )
+
+    def measure(self, bodies, serializer, method, repeat):
+        '''
+        Encode and decode every body the way kombu does for a published
+        message, returning total bytes and the best encode/decode times
+        '''
+        best_encode = best_decode = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            encoded = []
+            for body in bodies:
+                content_type, encoding, data = serialization.dumps(body, serializer)
+                if method:
+                    data, _ = compression.compress(data, method)
+                encoded.append((content_type, encoding, data))
+            best_encode = min(best_encode, time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for content_type, encoding, data in encoded:
+                if method:
+                    data = compression.decompress(data, compression.get_encoder(method)[1])
+                body = serialization.loads(data, content_type, encoding, force=True)
+                if "r" in body:
+                    for _ in iter_batch(body):
+                        pass
+            best_decode = min(best_decode, time.perf_counter() - start)
+
+        return {
+            "bytes": sum(len(data) for _, _, data in encoded),
+            "encode": best_encode,
+            "decode": best_decode,
+        }
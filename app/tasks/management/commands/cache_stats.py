@@ -0,0 +1,35 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.core.management.base import BaseCommand
+
+from libs.cache import COUNTERS, namespaces
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the two-tier cache hit/miss counters of every key namespace, "
+        "summed over all the processes that have published them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        stats = {namespace: cache.shared_stats() for namespace, cache in sorted(namespaces.items())}
+        if options["json"]:
+            self.stdout.write(json.dumps(stats, indent=2))
+            return
+        columns = COUNTERS + ("hit_rate",)
+        self.stdout.write(f"{'namespace':<16}" + "".join(f"{column:>15}" for column in columns))
+        for namespace, counters in stats.items():
+            row = "".join(
+                f"{counters[column]:>15.1%}" if column == "hit_rate" else f"{counters[column]:>15}"
+                for column in columns
+            )
+            self.stdout.write(f"{namespace:<16}{row}")
@@ -0,0 +1,27 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+from datetime import datetime
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils.logger import find_segments
+
+
+class Command(BaseCommand):
+    help = "List the rotated log segments holding records between two UTC times, from the segment index."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", default=settings.LOG_FILE_PATH, help="The log file (default LOG_FILE_PATH).")
+        parser.add_argument("--from", dest="start", type=datetime.fromisoformat, help="UTC, e.g. 2024-01-01T12:00")
+        parser.add_argument("--to", dest="end", type=datetime.fromisoformat, help="UTC, e.g. 2024-01-01T13:00")
+
+    def handle(self, *args, **options):
+        for path in find_segments(options["file"], options["start"], options["end"]):
+            self.stdout.write(path)
+        # The live file holds everything after the newest segment
+        self.stdout.write(options["file"])
@@ -0,0 +1,118 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from libs.benchmark import percentile
+from utils.logger import find_segments, open_segment
+
+
+def read_profiles(paths):
+    '''
+    The memory profiles logged by tasks.memory in the JSON log files ``paths``
+    '''
+    for path in paths:
+        with open_segment(path) as f:
+            for line in f:
+                if '"memory"' not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                # coreLogger nests extras under "data"
+                profile = record.get("memory") or record.get("data", {}).get("memory")
+                if isinstance(profile, dict):
+                    yield profile
+
+
+def summarise(profiles, top=10, headroom=None):
+    '''
+    Per-task memory figures and a recycling threshold: the RSS sampled
+    tasks left their process at (95th percentile) plus ``headroom``
+    '''
+    headroom = settings.MEMORY_RECYCLE_HEADROOM if headroom is None else headroom
+    by_task = defaultdict(list)
+    for profile in profiles:
+        by_task[profile["task"]].append(profile)
+
+    tasks, rss = {}, []
+    for name, samples in sorted(by_task.items()):
+        retained = [p["retained_kb"] for p in samples]
+        allocators = defaultdict(lambda: {"size_kb": 0.0, "samples": 0})
+        for profile in samples:
+            for site in profile.get("top", []):
+                allocator = allocators[site["where"]]
+                allocator["size_kb"] += site["size_kb"]
+                allocator["samples"] += 1
+        tasks[name] = {
+            "samples": len(samples),
+            "retained_kb_mean": round(sum(retained) / len(retained), 1),
+            "retained_kb_max": max(retained),
+            "peak_kb_max": max(p["peak_kb"] for p in samples),
+            "rss_kb_growth_mean": round(sum(p["rss_kb_growth"] for p in samples) / len(samples), 1),
+            # Sites retaining memory in many samples point at a leak or an unbounded cache
+            "top": [
+                {"where": where, "size_kb": round(a["size_kb"], 1), "samples": a["samples"]}
+                for where, a in sorted(allocators.items(), key=lambda item: -item[1]["size_kb"])[:top]
+            ],
+        }
+        rss.extend(p["rss_kb_after"] for p in samples)
+
+    p95 = percentile(rss, 95)
+    return {
+        "profiles": len(rss),
+        "tasks": tasks,
+        "rss_kb_p50": percentile(rss, 50),
+        "rss_kb_p95": p95,
+        "suggested_max_memory_per_child_kb": int(p95 * (1 + headroom)) if p95 else None,
+        "current_max_memory_per_child_kb": settings.CELERY_WORKER_MAX_MEMORY_PER_CHILD,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarise the worker memory profiles (MEMORY_PROFILE) in the Celery log and suggest "
+        "CELERY_WORKER_MAX_MEMORY_PER_CHILD."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--file", default=settings.CELERY_LOGFILE_PATH, help="The Celery log file.")
+        parser.add_argument("--from", dest="start", type=datetime.fromisoformat, help="UTC, e.g. 2024-01-01T12:00")
+        parser.add_argument("--to", dest="end", type=datetime.fromisoformat, help="UTC, e.g. 2024-01-01T13:00")
+        parser.add_argument("--top", type=int, default=10, help="Allocation sites listed per task.")
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        paths = find_segments(options["file"], options["start"], options["end"])
+        if os.path.exists(options["file"]):
+            paths.append(options["file"])
+        report = summarise(read_profiles(paths), options["top"])
+        if not report["profiles"]:
+            raise CommandError("No memory profiles found; run the workers with MEMORY_PROFILE=1.")
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name, task in report["tasks"].items():
+            self.stdout.write(
+                f"{name}: {task['samples']} samples, retained {task['retained_kb_mean']} KiB mean / "
+                f"{task['retained_kb_max']} KiB max, peak {task['peak_kb_max']} KiB, "
+                f"RSS +{task['rss_kb_growth_mean']} KiB mean"
+            )
+            for site in task["top"]:
+                self.stdout.write(f"    {site['size_kb']:>10} KiB  {site['samples']:>4}x  {site['where']}")
+        self.stdout.write(f"Worker RSS after tasks: p50 {report['rss_kb_p50']} KiB, p95 {report['rss_kb_p95']} KiB")
+        self.stdout.write(
+            f"Suggested CELERY_WORKER_MAX_MEMORY_PER_CHILD={report['suggested_max_memory_per_child_kb']} "
+            f"(currently {report['current_max_memory_per_child_kb']})"
+        )
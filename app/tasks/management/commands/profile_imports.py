@@ -0,0 +1,71 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import json
+import os
+import re
+import subprocess
+import sys
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# "import time:       self [us] |  cumulative | imported package"
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+DEFAULT_MODULES = ["apps.patient.models", "apps.patient.tasks", "tasks.tasks"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Start a fresh interpreter with -X importtime, set up Django, import the "
+        "given modules and report where the start-up time goes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES, help="Modules to import after django.setup().")
+        parser.add_argument("--top", type=int, default=25, help="Number of modules to list.")
+        parser.add_argument("--sort", choices=("cumulative", "self"), default="cumulative")
+        parser.add_argument("--json", dest="json_path", help="Also write the full profile to this file.")
+
+    def handle(self, *args, **options):
+        code = "import django; django.setup(); " + "; ".join(f"import {module}" for module in options["modules"])
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "core.settings")}
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if proc.returncode:
+            raise CommandError(proc.stderr.strip().splitlines()[-1])
+
+        profile = self.parse(proc.stderr)
+        total = sum(row["self_us"] for row in profile)
+        rows = sorted(profile, key=lambda row: row[f"{options['sort']}_us"], reverse=True)[:options["top"]]
+
+        self.stdout.write(f"{len(profile)} modules imported in {total / 1000:.1f} ms")
+        self.stdout.write(f"{'cumulative ms':>14}{'self ms':>10}  module")
+        for row in rows:
+            self.stdout.write(f"{row['cumulative_us'] / 1000:>14.1f}{row['self_us'] / 1000:>10.1f}  {row['module']}")
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as f:
+                json.dump({"modules": options["modules"], "total_us": total, "profile": profile}, f, indent=2)
+
+    @staticmethod
+    def parse(output):
+        profile = []
+        for line in output.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, module = match.groups()
+                profile.append({
+                    "module": module,
+                    "self_us": int(self_us),
+                    "cumulative_us": int(cumulative_us),
+                    "depth": len(indent) // 2,
+                })
+        return profile
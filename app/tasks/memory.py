@@ -0,0 +1,161 @@
+"""
+Memory profiling for Celery workers (opt-in, MEMORY_PROFILE).
+
+A sampled task (MEMORY_PROFILE_SAMPLE_RATE of the tasks named in
+MEMORY_PROFILE_TASKS, or of all tasks) runs with tracemalloc tracing: it is
+started in task_prerun and stopped in task_postrun, so only sampled tasks pay
+for it. What tracemalloc still holds when the task ends was allocated by the
+task and outlived it - the memory a worker keeps growing by - and its largest
+allocation sites are logged, together with the task's peak traced memory and
+the process RSS before and after, as one JSON record on the Celery log:
+
+    {"message": "Memory profile: tasks.tasks.create_email", "memory": {...}}
+
+The memory_report command folds those records into per-task figures and a
+suggested CELERY_WORKER_MAX_MEMORY_PER_CHILD, which Celery uses to replace a
+pool process once its RSS exceeds it after a task.
+
+Tasks are profiled one at a time per process; a sampled task that starts
+while another is traced (thread pools) is skipped.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import logging
+import os
+import platform
+import random
+import resource
+import threading
+import time
+import tracemalloc
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+
+
+# --------------------------------------------------------------
+# 3rd party imports
+# --------------------------------------------------------------
+from celery.signals import task_postrun, task_prerun
+
+logger = logging.getLogger(settings.CELERY_TASKS_LOGGER_NAME)
+
+# Frames belonging to tracing itself, left out of the allocator lists
+IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+try:
+    _PAGE_KB = os.sysconf("SC_PAGE_SIZE") // 1024
+except (AttributeError, ValueError, OSError):
+    _PAGE_KB = 4
+
+
+def rss_kb() -> int:
+    '''
+    The current resident set size of this process in KiB; the peak where
+    /proc is unavailable
+    '''
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_KB
+    except (OSError, IndexError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        return rss // 1024 if platform.system() == "Darwin" else rss
+
+
+def top_allocators(snapshot, limit, key_type="lineno") -> list:
+    '''
+    The ``limit`` largest allocation sites of a snapshot, largest first
+    '''
+    statistics = snapshot.filter_traces(IGNORED).statistics(key_type)
+    return [
+        {
+            "where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+        for stat in statistics[:limit]
+    ]
+
+
+class MemoryProfiler:
+
+    """
+    Traces sampled tasks of this process, one at a time
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current = None
+
+    def wanted(self, task_name) -> bool:
+        if not settings.MEMORY_PROFILE:
+            return False
+        if settings.MEMORY_PROFILE_TASKS and task_name not in settings.MEMORY_PROFILE_TASKS:
+            return False
+        return random.random() < settings.MEMORY_PROFILE_SAMPLE_RATE
+
+    def start(self, task_id, task_name) -> bool:
+        '''
+        Start tracing ``task_id``; False if it is not sampled, or another
+        task (or something else) is being traced
+        '''
+        if not self.wanted(task_name):
+            return False
+        with self._lock:
+            if self._current is not None or tracemalloc.is_tracing():
+                return False
+            self._current = (task_id, rss_kb(), time.perf_counter())
+        tracemalloc.start(settings.MEMORY_PROFILE_FRAMES)
+        return True
+
+    def stop(self, task_id, task_name, state=None):
+        '''
+        Stop tracing ``task_id`` and log what it left allocated; returns the
+        logged figures, or None if the task was not traced
+        '''
+        with self._lock:
+            if self._current is None or self._current[0] != task_id:
+                return None
+            _, rss_before, started = self._current
+            self._current = None
+        snapshot = tracemalloc.take_snapshot()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rss_after = rss_kb()
+        profile = {
+            "task": task_name,
+            "task_id": task_id,
+            "state": state,
+            "pid": os.getpid(),
+            "seconds": round(time.perf_counter() - started, 3),
+            "rss_kb_before": rss_before,
+            "rss_kb_after": rss_after,
+            "rss_kb_growth": rss_after - rss_before,
+            "retained_kb": round(retained / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+            "top": top_allocators(snapshot, settings.MEMORY_PROFILE_TOP),
+        }
+        logger.info(f"Memory profile: {task_name}", extra={"memory": profile})
+        return profile
+
+
+profiler = MemoryProfiler()
+
+
+@task_prerun.connect
+def start_memory_profile(task_id=None, task=None, **kwargs):
+    profiler.start(task_id, task.name)
+
+
+@task_postrun.connect
+def stop_memory_profile(task_id=None, task=None, state=None, **kwargs):
+    profiler.stop(task_id, task.name, state)
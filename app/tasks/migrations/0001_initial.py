@@ -0,0 +1,31 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeadLetter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(db_index=True, help_text='The recipient of the failed email.', max_length=254)),
+                ('reason', models.CharField(choices=[('permanent', 'Permanent failure'), ('exhausted', 'Retries exhausted')], max_length=20)),
+                ('smtp_code', models.IntegerField(blank=True, help_text='SMTP reply code, when the server sent one.', null=True)),
+                ('error', models.TextField(help_text='The exception raised by the final attempt.')),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('payload', models.JSONField(default=dict, help_text='Task kwargs, kept so the email can be replayed.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Dead Letter',
+                'verbose_name_plural': 'Dead Letters',
+            },
+        ),
+    ]
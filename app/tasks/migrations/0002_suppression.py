@@ -0,0 +1,26 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(help_text='Lower-cased recipient address.', max_length=254, unique=True)),
+                ('reason', models.CharField(choices=[('opted_out', 'Opted out'), ('bounced', 'Hard bounce'), ('manual', 'Manual')], max_length=20)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Suppression',
+                'verbose_name_plural': 'Suppressions',
+            },
+        ),
+    ]
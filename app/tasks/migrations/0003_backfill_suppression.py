@@ -0,0 +1,31 @@
+# Generated by Django 4.1.4 on 2026-10-19 16:29
+
+from django.db import migrations
+
+
+def backfill(apps, schema_editor):
+    # Opted-out (30) and not contactable (40) patients become global suppressions
+    Patient = apps.get_model('patient', 'Patient')
+    Suppression = apps.get_model('tasks', 'Suppression')
+    reasons = {30: 'opted_out', 40: 'bounced'}
+    rows = Patient.objects.filter(cancelled__in=reasons).values_list('user__email', 'cancelled')
+    suppressions = {}
+    for email, cancelled in rows.iterator():
+        if email:
+            suppressions.setdefault(email.strip().lower(), reasons[cancelled])
+    Suppression.objects.bulk_create(
+        [Suppression(email=email, reason=reason) for email, reason in suppressions.items()],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tasks', '0002_suppression'),
+        ('patient', '0002_alter_patient_options_alter_patient_cancelled_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+from django.db import models
+
+
+class DeadLetter(models.Model):
+
+    """
+    An email that could not be delivered and will not be retried.
+    """
+
+    email = models.EmailField(db_index=True, help_text="The recipient of the failed email.")
+    reason = models.CharField(max_length=20, choices=(
+        ("permanent", "Permanent failure"),
+        ("exhausted", "Retries exhausted"),
+    ))
+    smtp_code = models.IntegerField(null=True, blank=True, help_text="SMTP reply code, when the server sent one.")
+    error = models.TextField(help_text="The exception raised by the final attempt.")
+    attempts = models.PositiveIntegerField(default=1)
+    payload = models.JSONField(default=dict, help_text="Task kwargs, kept so the email can be replayed.")
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Dead Letter"
+        verbose_name_plural = "Dead Letters"
+
+    def __str__(self):
+        return f"{self.email} ({self.reason})"
+
+
+class SuppressionManager(models.Manager):
+    """
+    A Manager for Suppression objects
+    """
+    def suppress(self, email, reason):
+        suppression, _ = self.get_or_create(email=email.strip().lower(), defaults={"reason": reason})
+        return suppression
+
+
+class Suppression(models.Model):
+
+    """
+    An address that must never be emailed, whatever the study.
+    """
+
+    email = models.EmailField(unique=True, help_text="Lower-cased recipient address.")
+    reason = models.CharField(max_length=20, choices=(
+        ("opted_out", "Opted out"),
+        ("bounced", "Hard bounce"),
+        ("manual", "Manual"),
+    ))
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = SuppressionManager()
+
+    class Meta:
+        verbose_name = "Suppression"
+        verbose_name_plural = "Suppressions"
+
+    def __str__(self):
+        return self.email
@@ -0,0 +1,73 @@
+"""
+Compact payloads for sending one email template to many recipients.
+
+A per-recipient create_email message repeats the template name, subject and
+every shared context field for each recipient. A batch carries them once in
+a header and then only the per-recipient values:
+
+{
+  "v": 1,
+  "h": {"template": "tasks/patient_email.html", "subject": "", "context": {"care_provider_name": "..."}},
+  "k": ["patient_username"],
+  "r": [["user.one@umed.io", "UserOne"], ["user.two@umed.io", "UserTwo"]]
+}
+
+"k" names the per-recipient context fields, in the order they follow the email
+address in each row of "r".
+"""
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+
+VERSION = 1
+
+
+def make_batch(recipients, context=None, subject="", template="tasks/patient_email.html", keys=("patient_username",)):
+    '''
+    Build a batch payload from (email, *values) rows, where values are the
+    per-recipient context fields named by ``keys``
+    '''
+    return {
+        "v": VERSION,
+        "h": {"template": template, "subject": subject, "context": context or {}},
+        "k": list(keys),
+        "r": [list(row) for row in recipients],
+    }
+
+
+def iter_batch(batch):
+    '''
+    Yield (email, context) for every recipient of a batch
+    '''
+    if batch.get("v") != VERSION:
+        raise ValueError(f"Unsupported email batch version: {batch.get('v')}")
+
+    shared, keys = batch["h"]["context"], batch["k"]
+    for email, *values in batch["r"]:
+        yield email, {**shared, **dict(zip(keys, values))}
+
+
+def chunks(rows, size):
+    '''
+    Split an iterable of recipient rows into lists of at most ``size`` rows
+    '''
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def send_options() -> dict:
+    '''
+    apply_async options for batch tasks: batches are large enough for the
+    serializer and compression to matter, unlike single-recipient tasks
+    '''
+    options = {"serializer": settings.EMAIL_BATCH_SERIALIZER}
+    if settings.EMAIL_BATCH_COMPRESSION:
+        options["compression"] = settings.EMAIL_BATCH_COMPRESSION
+    return options
@@ -0,0 +1,209 @@
+"""
+Render cache for campaign emails.
+
+Most messages of a campaign differ only in a few per-recipient values (the
+"slots", EMAIL_RENDER_SLOTS). Rather than rendering and stripping the whole
+template for each message, the template is rendered once per distinct shared
+context with a placeholder in place of each slot, and the recipient's escaped
+values are substituted into that skeleton.
+
+Skeletons are keyed by a hash of the template source and the shared context,
+kept in a per-process LRU and, when EMAIL_RENDER_CACHE_ALIAS names a cache
+(e.g. Redis), shared between workers.
+
+A skeleton is only used where a slot is printed as it is ({{ slot }}), with
+autoescaping on. A template (or one it includes or extends) that tests a
+slot in a tag, such as {% if slot %}, or passes it through a filter or tag
+is always rendered in full: the placeholder would stand in for the value
+there (it is always truthy, and |upper would change it). So is one that
+turns autoescaping off, in an {% autoescape %} block or for its whole
+engine, as substituted values are always escaped, and one whose
+placeholders do not survive rendering intact. The output is always
+identical to a full render.
+"""
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+from django.core.cache import caches
+from django.template.base import Lexer, TokenType
+from django.template.loader import get_template
+from django.utils.html import conditional_escape, strip_tags
+
+PLACEHOLDER = "@@umed-slot:{}@@"
+
+# Cached value for templates whose slots cannot be substituted
+UNSPLITTABLE = "unsplittable"
+
+
+class RenderCache:
+    def __init__(self, maxsize=None, alias=None):
+        self.maxsize = maxsize
+        self.alias = alias
+        self._local = OrderedDict()
+        self._sources = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self.skeleton_seconds = 0.0
+
+    @property
+    def shared(self):
+        alias = settings.EMAIL_RENDER_CACHE_ALIAS if self.alias is None else self.alias
+        return caches[alias] if alias else None
+
+    def render(self, template, context, slots=()) -> tuple:
+        '''
+        Return (html, text) for ``template`` rendered with ``context``,
+        exactly as render_to_string followed by strip_tags would
+        '''
+        slots = tuple(slot for slot in slots if slot in context)
+        key = self._key(template, context, slots)
+        skeleton, tier = self._get(key)
+        if skeleton is None:
+            self.misses += 1
+            start = time.perf_counter()
+            skeleton = self._render_skeleton(template, context, slots)
+            self.skeleton_seconds += time.perf_counter() - start
+            self._set(key, skeleton)
+        elif skeleton == UNSPLITTABLE:
+            self.fallbacks += 1
+        elif tier == "local":
+            self.hits += 1
+        else:
+            self.shared_hits += 1
+
+        if skeleton == UNSPLITTABLE:
+            return self._render(template, context)
+
+        html, text = skeleton
+        for slot in slots:
+            value = str(conditional_escape(context[slot]))
+            html = html.replace(PLACEHOLDER.format(slot), value)
+            text = text.replace(PLACEHOLDER.format(slot), value)
+        return html, text
+
+    def _render(self, template, context):
+        html = get_template(template).render(context)
+        return html, strip_tags(html)
+
+    def _render_skeleton(self, template, context, slots):
+        if slots and uses_slots(template, slots):
+            return UNSPLITTABLE
+        html, text = self._render(template, {**context, **{slot: PLACEHOLDER.format(slot) for slot in slots}})
+        if any(PLACEHOLDER.format(slot) not in html for slot in slots):
+            return UNSPLITTABLE
+        return html, text
+
+    def _key(self, template, context, slots):
+        if template not in self._sources:
+            source = get_template(template).template.source
+            self._sources[template] = hashlib.sha256(source.encode()).hexdigest()
+        shared_context = {k: v for k, v in context.items() if k not in slots}
+        digest = hashlib.sha256(
+            json.dumps([self._sources[template], shared_context, slots], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        return f"email-render:{digest}"
+
+    def _get(self, key):
+        '''
+        Return (skeleton, "local" | "shared"), or (None, None) on a miss
+        '''
+        with self._lock:
+            if key in self._local:
+                self._local.move_to_end(key)
+                return self._local[key], "local"
+
+        shared = self.shared
+        value = shared.get(key) if shared is not None else None
+        if value is None:
+            return None, None
+        value = value if value == UNSPLITTABLE else tuple(value)
+        self._set(key, value, shared=False)
+        return value, "shared"
+
+    def _set(self, key, value, shared=True):
+        maxsize = self.maxsize or settings.EMAIL_RENDER_CACHE_SIZE
+        with self._lock:
+            self._local[key] = value
+            self._local.move_to_end(key)
+            while len(self._local) > maxsize:
+                self._local.popitem(last=False)
+        if shared and self.shared is not None:
+            self.shared.set(key, value, settings.EMAIL_RENDER_CACHE_TIMEOUT)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+            self._sources.clear()
+
+    def stats(self) -> dict:
+        # Each hit saves roughly one full render, the cost of building a skeleton
+        average = self.skeleton_seconds / self.misses if self.misses else 0.0
+        return {
+            "render_hits": self.hits + self.shared_hits,
+            "render_shared_hits": self.shared_hits,
+            "render_misses": self.misses,
+            "render_fallbacks": self.fallbacks,
+            "render_saved_seconds": (self.hits + self.shared_hits) * average,
+        }
+
+    def stats_since(self, before) -> dict:
+        '''
+        The counters accumulated since an earlier stats() call
+        '''
+        after = self.stats()
+        return {key: after[key] - before[key] for key in after}
+
+
+def uses_slots(template, slots, _seen=None) -> bool:
+    '''
+    Whether ``template``, or a template it includes or extends, does anything
+    with a slot other than print it unchanged and escaped. Errs on the side
+    of True, e.g. for a slot name inside a string, an include of a variable
+    or any {% autoescape %} block.
+    '''
+    seen = set() if _seen is None else _seen
+    seen.add(template)
+    compiled = get_template(template).template
+    if not compiled.engine.autoescape:
+        return True
+    # A slot name not part of another name or lookup (user.patient_username)
+    mention = re.compile(r"(?<![\w.])(?:{})(?!\w)".format("|".join(map(re.escape, slots))))
+    for token in Lexer(compiled.source).tokenize():
+        if token.token_type == TokenType.VAR:
+            if mention.search(token.contents) and token.contents.strip() not in slots:
+                return True
+        elif token.token_type == TokenType.BLOCK:
+            bits = token.split_contents()
+            if bits[0] == "autoescape":
+                return True
+            if bits[0] in ("include", "extends") and len(bits) > 1:
+                name = bits[1]
+                if name[:1] not in "\"'":
+                    return True
+                if name[1:-1] not in seen and uses_slots(name[1:-1], slots, seen):
+                    return True
+            if mention.search(token.contents):
+                return True
+    return False
+
+
+def hit_rate(stats) -> float:
+    lookups = stats["render_hits"] + stats["render_misses"] + stats["render_fallbacks"]
+    return stats["render_hits"] / lookups if lookups else 0.0
+
+
+render_cache = RenderCache()
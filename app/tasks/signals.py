@@ -0,0 +1,10 @@
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.dispatch import Signal
+
+
+# Sent when an email is moved to the dead-letter table.
+# Receivers get ``email`` and ``suppress`` (True when the failure was caused by
+# the address itself, so nothing else should be sent to it).
+email_dead_lettered = Signal()
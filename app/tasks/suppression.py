@@ -0,0 +1,129 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import hashlib
+import math
+import threading
+import time
+
+# --------------------------------------------------------------
+# Django imports
+# --------------------------------------------------------------
+from django.conf import settings
+
+from tasks.models import Suppression
+
+
+class BloomFilter:
+    """
+    A fixed-size Bloom filter over strings.
+
+    Membership tests never miss an added item but may report items that were
+    never added, with a probability that grows as the filter fills up.
+    """
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Kirsch-Mitzenmacher double hashing: k positions from one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+
+class SuppressionIndex:
+    """
+    A per-process snapshot of the Suppression table.
+
+    The snapshot is a Bloom filter that is rebuilt every
+    SUPPRESSION_REFRESH_SECONDS. A recipient that is not in the filter is
+    certainly not suppressed, so the common case costs no query at all. The
+    (few) recipients of a batch that hit the filter are confirmed with a single
+    query, so a false positive never stops a legitimate email.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._loaded_at = 0.0
+        self.checked = 0
+        self.confirmed = 0
+        self.false_positives = 0
+
+    def load(self):
+        emails = Suppression.objects.values_list("email", flat=True)
+        bloom = BloomFilter(
+            capacity=max(1024, 2 * emails.count()),
+            error_rate=settings.SUPPRESSION_FALSE_POSITIVE_RATE,
+        )
+        for email in emails.iterator():
+            bloom.add(email)
+        with self._lock:
+            self._bloom = bloom
+            self._loaded_at = time.monotonic()
+        return bloom
+
+    def _snapshot(self):
+        if self._bloom is None or time.monotonic() - self._loaded_at > settings.SUPPRESSION_REFRESH_SECONDS:
+            return self.load()
+        return self._bloom
+
+    def add(self, email):
+        # Make a suppression made by this process visible before the next refresh
+        if self._bloom is not None:
+            self._bloom.add(email.strip().lower())
+
+    def suppressed(self, emails) -> set:
+        '''
+        Return the subset of ``emails`` that must not be sent to
+        '''
+        bloom = self._snapshot()
+        emails = list(emails)
+        self.checked += len(emails)
+        candidates = {email.strip().lower(): email for email in emails if email.strip().lower() in bloom}
+        if not candidates:
+            return set()
+
+        confirmed = set(Suppression.objects.filter(email__in=candidates).values_list("email", flat=True))
+        self.confirmed += len(confirmed)
+        self.false_positives += len(candidates) - len(confirmed)
+        return {candidates[email] for email in confirmed}
+
+    def is_suppressed(self, email) -> bool:
+        return bool(self.suppressed([email]))
+
+    def stats(self) -> dict:
+        bloom = self._snapshot()
+        negatives = self.checked - self.confirmed
+        return {
+            "entries": bloom.count,
+            "bits": bloom.num_bits,
+            "hashes": bloom.num_hashes,
+            "bytes": bloom.nbytes,
+            "estimated_false_positive_rate": bloom.false_positive_rate,
+            "observed_false_positive_rate": self.false_positives / negatives if negatives else 0.0,
+            "age_seconds": time.monotonic() - self._loaded_at,
+        }
+
+
+index = SuppressionIndex()
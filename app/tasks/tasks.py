@@ -1,10 +1,15 @@
+# --------------------------------------------------------------
+# Python imports
+# --------------------------------------------------------------
+import time
+
 # --------------------------------------------------------------
 # Django imports
 # --------------------------------------------------------------
 from django.conf import settings
+from django.db import connection as db_connection
 from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
+from django.template.loader import get_template
 from django.core.mail import get_connection 
 
 
@@ -12,10 +17,113 @@ from django.core.mail import get_connection
 # 3rd party imports
 # --------------------------------------------------------------
 from celery import shared_task
+from celery.signals import worker_process_init, worker_process_shutdown
 from celery.utils.log import get_task_logger
+
+from tasks import memory  # noqa: F401  (connects the memory profiler to the task signals)
+from tasks.failures import PERMANENT, SYSTEMIC, TRANSIENT, SystemicFailure, backoff, classify, dead_letter
+from tasks.payloads import iter_batch
+from tasks.rendering import render_cache
+from tasks.suppression import index as suppression_index
  
 logger = get_task_logger(__name__)
 
+DEFAULT_TEMPLATE = "tasks/patient_email.html"
+
+
+def open_connection():
+    '''
+    Return a new (unopened) email connection using the configured host
+    settings. Tasks should use connection_pool instead.
+    '''
+    return get_connection(
+        host= settings.EMAIL_HOST,
+        port= settings.EMAIL_PORT,
+        username=settings.EMAIL_HOST_USER,
+        password=settings.EMAIL_HOST_PASSWORD,
+        use_tls=settings.EMAIL_USE_TLS,
+    )
+
+
+class ConnectionPool:
+    """
+    Keeps one open email connection per worker process so consecutive tasks
+    do not pay for a new SMTP handshake (and TLS negotiation) each time.
+
+    A connection left idle for more than EMAIL_CONNECTION_MAX_IDLE seconds is
+    replaced, as servers drop idle clients.
+    """
+    def __init__(self):
+        self._connection = None
+        self._last_used = 0.0
+
+    def get(self):
+        idle = time.monotonic() - self._last_used
+        if self._connection is not None and idle > settings.EMAIL_CONNECTION_MAX_IDLE:
+            self.reset()
+        if self._connection is None:
+            self._connection = open_connection()
+        if getattr(self._connection, "connection", True) is None:
+            # smtp backend: never opened, or closed after a failure
+            self._connection.open()
+        self._last_used = time.monotonic()
+        return self._connection
+
+    def reset(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+
+
+connection_pool = ConnectionPool()
+
+
+@worker_process_init.connect
+def warm_worker_process(**kwargs):
+    '''
+    Do the one-off work of a worker process up front, before it is handed its
+    first task: compile the email templates (kept by the cached template
+    loader), load the suppression index and open the database and email
+    connections.
+    '''
+    for template in settings.EMAIL_PRELOAD_TEMPLATES:
+        get_template(template)
+    suppression_index.load()
+    db_connection.ensure_connection()
+    try:
+        connection_pool.get()
+    except Exception:
+        # The first task will try again and handle the failure properly
+        logger.warning("Worker warm-up: could not open the email connection", exc_info=True)
+        connection_pool.reset()
+
+
+@worker_process_shutdown.connect
+def close_worker_connections(**kwargs):
+    connection_pool.reset()
+
+
+def build_email(email, context, subject="", template=DEFAULT_TEMPLATE, cc_email=None, connection=None):
+    '''
+    Render a template and wrap it in a multipart (text + html) message
+    '''
+    # Rendered once per template and shared context; only the per-recipient slots are filled in here
+    html_content, text_content = render_cache.render(template, context, settings.EMAIL_RENDER_SLOTS)
+
+    msg = EmailMultiAlternatives(
+        subject,
+        text_content,
+        f'{settings.DISPLAY_NAME} <{settings.EMAIL_HOST_USER}>',
+        [email],
+        cc=cc_email or [],
+        connection=connection)
+    msg.attach_alternative(html_content, "text/html")
+    return msg
+
+
 @shared_task(bind=True)
 def create_email(self,**kwargs):
     '''
@@ -24,27 +132,110 @@ def create_email(self,**kwargs):
     context = kwargs.get("context", {})
     subject = kwargs.get("subject", "")
     email = kwargs.get("email")
-    template = kwargs.get("template", "tasks/patient_email.html")
+    template = kwargs.get("template", DEFAULT_TEMPLATE)
     cc_email = kwargs.get("cc_email", [])
- 
-    html_content = render_to_string(template, context ) # render with dynamic value
-    text_content = strip_tags(html_content) # Strip the html tag. So people can see the pure text at least.
-
-    with get_connection(
-            host= settings.EMAIL_HOST,
-            port= settings.EMAIL_PORT,
-            username=settings.EMAIL_HOST_USER,
-            password=settings.EMAIL_HOST_PASSWORD,
-            use_tls=settings.EMAIL_USE_TLS,
-        ) as connection:
-            msg = EmailMultiAlternatives(
-                subject,
-                text_content,
-                f'{settings.DISPLAY_NAME} <{settings.EMAIL_HOST_USER}>',
-                [email],
-                cc=[cc_email],
-                connection=connection)
-            msg.attach_alternative(html_content, "text/html")
-            msg.send()
+
+    try:
+        msg = build_email(email, context, subject, template, cc_email, connection_pool.get())
+        msg.send()
+    except Exception as exc:
+        connection_pool.reset()
+        failure = classify(exc)
+        if failure.kind != PERMANENT and self.request.retries < settings.EMAIL_RETRY_MAX:
+            # Hand the slot back to the worker and come back later
+            countdown = backoff(self.request.retries)
+            logger.warning(f"Task: Send email to [{email}]: {failure.kind} failure, retrying in {countdown:.0f}s")
+            raise self.retry(exc=exc, countdown=countdown, max_retries=settings.EMAIL_RETRY_MAX)
+        if failure.kind == SYSTEMIC:
+            # Our set-up is at fault, not the recipient: fail the task rather than dead-letter them
+            logger.error(f"Task: Send email to [{email}]: {failure.kind} failure, giving up: {exc!r}")
+            raise
+
+        logger.error(f"Task: Send email to [{email}]: {failure.kind} failure, dead-lettered")
+        dead_letter(email, failure, exc, kwargs, attempts=self.request.retries + 1)
+        return f"Task: Send email to [{email}]: Failed"
     return f"Task: Send email to [{email}]: Success"
- 
+
+
+def deliver(email, context, subject="", template=DEFAULT_TEMPLATE):
+    '''
+    Send one email over the worker's pooled connection, as part of a bulk send.
+
+    Returns "sent", "deferred" (a transient failure, handed to create_email to
+    retry on its own so the caller is not held up) or "failed" (dead-lettered).
+    Raises SystemicFailure when no message could be sent until the set-up is
+    fixed, for the caller to retry or fail what is left of the batch.
+    '''
+    try:
+        build_email(email, context, subject, template, connection=connection_pool.get()).send()
+        return "sent"
+    except Exception as exc:
+        payload = {"email": email, "context": context, "subject": subject, "template": template}
+        failure = classify(exc)
+        if failure.kind == SYSTEMIC:
+            raise SystemicFailure(repr(exc)) from exc
+        if failure.kind == TRANSIENT:
+            if failure.code is None:
+                # Dropped or timed out, so the session is unusable; the next
+                # send opens a new pooled one. After a 4xx reply it is still fine.
+                connection_pool.reset()
+            create_email.apply_async(kwargs=payload, countdown=backoff(0))
+            return "deferred"
+        logger.error(f"Task: Send email to [{email}]: {failure.kind} failure, dead-lettered")
+        dead_letter(email, failure, exc, payload)
+        return "failed"
+
+
+@shared_task(bind=True)
+def send_email_batch(self, batch, counts=None):
+    '''
+    Send one template to every recipient of a batch payload (see tasks.payloads)
+    over a single connection. ``counts`` carries the outcomes so far into a
+    retry of the rest of the batch.
+    '''
+    recipients = list(iter_batch(batch))
+    subject, template = batch["h"]["subject"], batch["h"]["template"]
+    blocked = suppression_index.suppressed(email for email, _ in recipients)
+
+    counts = {"sent": 0, "failed": 0, "deferred": 0, "suppressed": 0, **(counts or {})}
+    render_stats = render_cache.stats()
+    try:
+        # Opened up front: deliver() reuses it
+        connection_pool.get()
+    except Exception as exc:
+        connection_pool.reset()
+        failure = classify(exc)
+        if failure.kind != PERMANENT and self.request.retries < settings.EMAIL_RETRY_MAX:
+            # Nothing has been sent yet, so the whole batch can be retried later
+            countdown = backoff(self.request.retries)
+            logger.warning(f"Task: Send email batch: could not connect ({failure.kind}), retrying in {countdown:.0f}s")
+            raise self.retry(exc=exc, countdown=countdown, max_retries=settings.EMAIL_RETRY_MAX)
+        if failure.kind == SYSTEMIC:
+            logger.error(f"Task: Send email batch: systemic failure, giving up on {len(recipients)} recipients: {exc!r}")
+            raise
+        logger.error(f"Task: Send email batch: could not connect, dead-lettering {len(recipients) - len(blocked)} recipients")
+        counts["suppressed"] += len(blocked)
+        for email, context in recipients:
+            if email not in blocked:
+                payload = {"email": email, "context": context, "subject": subject, "template": template}
+                dead_letter(email, failure, exc, payload, attempts=self.request.retries + 1)
+                counts["failed"] += 1
+        return {**counts, **render_cache.stats_since(render_stats)}
+
+    for position, (email, context) in enumerate(recipients):
+        if email in blocked:
+            counts["suppressed"] += 1
+            continue
+        try:
+            counts[deliver(email, context, subject, template)] += 1
+        except SystemicFailure as exc:
+            connection_pool.reset()
+            if self.request.retries >= settings.EMAIL_RETRY_MAX:
+                logger.error(f"Task: Send email batch: systemic failure, giving up on {len(recipients) - position} recipients: {exc}")
+                raise
+            # Only the recipients not yet sent to
+            rest = {**batch, "r": batch["r"][position:]}
+            countdown = backoff(self.request.retries)
+            logger.warning(f"Task: Send email batch: systemic failure, retrying {len(rest['r'])} recipients in {countdown:.0f}s")
+            raise self.retry(args=(rest,), kwargs={"counts": counts}, exc=exc, countdown=countdown, max_retries=settings.EMAIL_RETRY_MAX)
+    return {**counts, **render_cache.stats_since(render_stats)}
@@ -0,0 +1,23 @@
+from django.test import TestCase
+
+from libs import benchmark
+
+
+class BenchmarkTestCase(TestCase):
+
+    """
+    Test suite for the email throughput benchmark harness
+    """
+    def test_run(self):
+        benchmark.seed(patients=12, studies=2)
+        for mode in benchmark.MODES:
+            result = benchmark.run(mode, shard_size=5, batch_size=5)
+            self.assertEqual(result["messages"], 12, mode)
+            self.assertGreater(result["messages_per_second"], 0)
+            self.assertLessEqual(result["latency_ms_p50"], result["latency_ms_p99"])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 99), 99)
+        self.assertIsNone(benchmark.percentile([], 50))
@@ -0,0 +1,39 @@
+from unittest import mock
+
+from django.contrib.auth.hashers import check_password
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from apps.patient.models import Patient
+from libs.factories import PatientFactory, build_dataset
+from libs.test_runner import template_key
+
+
+class BootstrapTestCase(TestCase):
+
+    """
+    Test suite for the test data bootstrap
+    """
+    def test_patient_factory(self):
+        patients = PatientFactory.create_batch(3)
+        self.assertEqual(len({patient.user.username for patient in patients}), 3)
+        self.assertTrue(patients[0].user.check_password("password0101"))
+
+    def test_build_dataset(self):
+        # Two bulk inserts for the small tables, two per batch for users and patients
+        with self.assertNumQueries(2 + 2 * 3):
+            dataset = build_dataset(patients=250, studies=4, batch_size=100, status=10)
+        self.assertEqual(Patient.objects.filter(status=10).count(), 250)
+        self.assertEqual(
+            sorted(Patient.objects.values_list("study_id", flat=True).distinct()),
+            sorted(study.id for study in dataset.studies),
+        )
+        hashes = set(User.objects.values_list("password", flat=True))
+        self.assertEqual(len(hashes), 1)
+        self.assertTrue(check_password("password0101", hashes.pop()))
+
+    def test_template_key(self):
+        self.assertEqual(template_key(), template_key())
+        key = template_key()
+        with mock.patch("django.get_version", return_value="0.0"):
+            self.assertNotEqual(template_key(), key)
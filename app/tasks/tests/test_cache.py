@@ -0,0 +1,195 @@
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from asgiref.sync import async_to_sync
+from django.test import SimpleTestCase, TestCase, override_settings
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from apps.care_provider.models import CareProvider
+from apps.patient.cache import patient_counts
+from apps.patient.models import Patient
+from apps.study.cache import studies, study_context
+from apps.study.models import Study
+from libs.cache import TieredCache, namespaces
+
+
+class TieredCacheTestCase(SimpleTestCase):
+
+    """
+    Test suite for the two-tier cache
+    """
+    def setUp(self):
+        cache.clear()
+        self.cache = TieredCache("test", timeout=60, local_size=2, local_ttl=60)
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.loads
+
+    def test_tiers(self):
+        self.assertEqual(self.cache.get_or_set("a", self.load), 1)
+        self.assertEqual(self.cache.get_or_set("a", self.load), 1)
+        self.cache.clear_local()
+        self.assertEqual(self.cache.get_or_set("a", self.load), 1)
+        stats = self.cache.stats()
+        self.assertEqual((stats["misses"], stats["local_hits"], stats["shared_hits"]), (1, 1, 1))
+
+    def test_none_is_cached(self):
+        self.cache.get_or_set("a", lambda: self.load() and None)
+        self.assertIsNone(self.cache.get_or_set("a", self.load))
+        self.assertEqual(self.loads, 1)
+
+    def test_lru_eviction(self):
+        for key in "abc":
+            self.cache.get_or_set(key, self.load)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+        self.assertEqual(self.cache.stats()["local_size"], 2)
+
+    def test_invalidate(self):
+        self.cache.get_or_set("a", self.load)
+        self.cache.get_or_set("b", self.load)
+        self.cache.invalidate("a")
+        self.assertEqual(self.cache.get_or_set("a", self.load), 3)
+        self.assertEqual(self.cache.get_or_set("b", self.load), 2)
+
+    def test_invalidate_all_reaches_other_processes(self):
+        '''
+        A version bump retires keys in both tiers, in this process at once
+        and in others once their local tier expires
+        '''
+        other = TieredCache("test", timeout=60, local_ttl=0)
+        self.cache.get_or_set("a", self.load)
+        self.assertEqual(other.get_or_set("a", self.load), 1)
+        self.cache.invalidate_all()
+        self.assertEqual(self.cache.get_or_set("a", self.load), 2)
+        self.assertEqual(other.get_or_set("a", self.load), 2)
+
+    def test_single_flight(self):
+        '''
+        Concurrent misses for one key run the loader once
+        '''
+        def slow_load():
+            time.sleep(0.1)
+            return self.load()
+
+        threads = [threading.Thread(target=self.cache.get_or_set, args=("a", slow_load)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(self.cache.stats()["coalesced"], 7)
+
+    def test_waits_for_other_process(self):
+        '''
+        A key another process is loading is awaited, not loaded again
+        '''
+        other = TieredCache("test", timeout=60)
+        shared_key = other._shared_key("a", other.version())
+        cache.add(f"{shared_key}:lock", "other", 10)
+        threading.Timer(0.1, cache.set, args=(shared_key, ("theirs",), 60)).start()
+        self.assertEqual(self.cache.get_or_set("a", self.load), "theirs")
+        self.assertEqual(self.loads, 0)
+
+    def test_publish(self):
+        self.cache.get_or_set("a", self.load)
+        self.cache.get_or_set("a", self.load)
+        self.cache.publish(force=True)
+        self.cache.publish(force=True)
+        stats = self.cache.shared_stats()
+        self.assertEqual((stats["misses"], stats["local_hits"]), (1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+
+    def test_invalidation_survives_shared_tier_outage(self):
+        self.cache.get_or_set("a", self.load)
+        down = RedisConnectionError("Redis is down")
+        with mock.patch.object(cache, "delete", side_effect=down), \
+                mock.patch.object(cache, "incr", side_effect=down), \
+                self.assertLogs("libs.cache", "WARNING"):
+            self.cache.invalidate("a")
+            self.cache.invalidate_all()
+        self.assertEqual(self.cache.stats()["local_size"], 0)
+
+@override_settings(CACHES={"default": {
+    "BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://127.0.0.1:1/0",
+}})
+class SharedTierOutageTestCase(TestCase):
+
+    """
+    Lookups keep working, uncached across processes, while Redis is down
+    """
+    def setUp(self):
+        for tiered in namespaces.values():
+            tiered.clear_local()
+            self.addCleanup(tiered.clear_local)
+        self.cache = TieredCache("test", timeout=60, local_size=2, local_ttl=60)
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.loads
+
+    async def aload(self):
+        return self.load()
+
+    def test_reads_fall_back_to_the_loader(self):
+        with self.assertLogs("libs.cache", "WARNING"):
+            self.assertEqual(self.cache.get_or_set("a", self.load), 1)
+            # Still cached in this process
+            self.assertEqual(self.cache.get_or_set("a", self.load), 1)
+            self.assertEqual(async_to_sync(self.cache.aget_or_set)("b", self.aload), 2)
+            self.cache.publish(force=True)
+        self.assertEqual(self.loads, 2)
+
+    def test_eligibility_without_the_shared_tier(self):
+        with self.assertLogs("libs.cache", "WARNING"):
+            study = Study.objects.create(name="Study A")
+            user = User.objects.create(username="user0", email="user0@umed.io")
+            Patient.objects.create(user=user, study=study)
+            self.assertEqual(Patient.objects.in_study().count(), 1)
+            self.assertEqual(study_context(study.id), study.email_context())
+
+
+class ModelInvalidationTestCase(TestCase):
+
+    """
+    Saves, deletes and bulk updates retire the cached lookups
+    """
+    def setUp(self):
+        cache.clear()
+        self.study = Study.objects.create(name="Study A")
+
+    def test_study_save(self):
+        study_context(self.study.id)
+        with self.assertNumQueries(0):
+            study_context(self.study.id)
+        self.study.save()
+        with self.assertNumQueries(1):
+            study_context(self.study.id)
+
+    def test_care_provider_save(self):
+        study_context(self.study.id)
+        CareProvider.objects.create(name="Surgery", ods="A1", contact="Dr Smith")
+        with self.assertNumQueries(1):
+            study_context(self.study.id)
+        self.assertGreater(studies.stats()["invalidations"], 0)
+
+    def test_patient_bulk_update(self):
+        user = User.objects.create(username="user0", email="user0@umed.io")
+        Patient.objects.create(user=user, study=self.study)
+        count = lambda: patient_counts.get_or_set("eligible", Patient.objects.in_study().count)
+        self.assertEqual(count(), 1)
+        Patient.objects.update(cancelled=30)
+        self.assertEqual(count(), 0)
+        Patient.objects.get().delete()
+        Patient.objects.create(user=user, study=self.study)
+        self.assertEqual(count(), 1)
+        # Counting sends leaves the cached lookups alone
+        Patient.objects.update(emails_sent=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(count(), 1)
@@ -0,0 +1,142 @@
+import smtplib
+import socket
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail import BadHeaderError
+from django.test import TestCase, override_settings
+
+from apps.patient.models import Patient
+from apps.study.models import Study
+from core.celery import app
+from tasks.failures import PERMANENT, SYSTEMIC, TRANSIENT, backoff, classify
+from tasks.models import DeadLetter
+from tasks.payloads import make_batch
+from tasks.tasks import ConnectionPool, connection_pool, create_email, open_connection, send_email_batch
+
+SEND = "django.core.mail.backends.locmem.EmailBackend.send_messages"
+
+
+class ClassifyTestCase(TestCase):
+
+    """
+    Test suite for send failure classification and backoff
+    """
+    def test_classify(self):
+        refused = smtplib.SMTPRecipientsRefused({"a@umed.io": (550, b"No such user")})
+        self.assertEqual(classify(refused), (PERMANENT, 550, True))
+        greylisted = smtplib.SMTPRecipientsRefused({"a@umed.io": (451, b"Try later")})
+        self.assertEqual(classify(greylisted).kind, TRANSIENT)
+        self.assertEqual(classify(smtplib.SMTPAuthenticationError(535, b"Bad creds")), (SYSTEMIC, 535, False))
+        self.assertEqual(classify(smtplib.SMTPSenderRefused(550, b"Not ours", "x@umed.io")), (SYSTEMIC, 550, False))
+        self.assertEqual(classify(smtplib.SMTPDataError(552, b"Mailbox full")), (PERMANENT, 552, True))
+        self.assertEqual(classify(smtplib.SMTPServerDisconnected()).kind, TRANSIENT)
+        self.assertEqual(classify(socket.timeout()).kind, TRANSIENT)
+
+    def test_classify_unbuildable_message(self):
+        self.assertEqual(classify(ValueError('Invalid address "a@@"')), (PERMANENT, None, False))
+        self.assertEqual(classify(BadHeaderError("Header values can't contain newlines")), (PERMANENT, None, False))
+        # Not the email package's: retried, and never suppresses the address
+        self.assertEqual(classify(ValueError("bad context")), (TRANSIENT, None, False))
+
+    @override_settings(EMAIL_RETRY_BACKOFF=10, EMAIL_RETRY_BACKOFF_MAX=100)
+    def test_backoff(self):
+        for retries in range(10):
+            self.assertTrue(0 <= backoff(retries) <= min(100, 10 * 2 ** retries))
+
+
+class CreateEmailFailureTestCase(TestCase):
+
+    """
+    Test suite for create_email retries and dead-lettering
+    """
+    def setUp(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        user = User.objects.create(username="bounce", email="bounce@umed.io")
+        self.patients = [
+            Patient.objects.create(user=user, study=Study.objects.create(name=name)) for name in ("A", "B")
+        ]
+
+    def test_permanent_failure_is_dead_lettered_and_suppressed(self):
+        refused = smtplib.SMTPRecipientsRefused({"bounce@umed.io": (550, b"No such user")})
+        with mock.patch(SEND, side_effect=refused) as send:
+            create_email.delay(email="bounce@umed.io", context={})
+        self.assertEqual(send.call_count, 1)
+        letter = DeadLetter.objects.get()
+        self.assertEqual((letter.reason, letter.smtp_code), ("permanent", 550))
+        self.assertFalse(Patient.objects.in_study().exists())
+
+    @override_settings(EMAIL_RETRY_MAX=3)
+    def test_transient_failure_is_retried_then_dead_lettered(self):
+        with mock.patch(SEND, side_effect=socket.timeout()) as send:
+            create_email.delay(email="bounce@umed.io", context={})
+        self.assertEqual(send.call_count, 4)
+        letter = DeadLetter.objects.get()
+        self.assertEqual((letter.reason, letter.attempts), ("exhausted", 4))
+        # A timeout says nothing about the address
+        self.assertEqual(Patient.objects.in_study().count(), 2)
+
+    @override_settings(EMAIL_RETRY_MAX=2)
+    def test_systemic_failure_is_retried_then_fails(self):
+        refused = smtplib.SMTPAuthenticationError(535, b"Bad creds")
+        # Celery's own failure log can't format eager tracebacks
+        with mock.patch(SEND, side_effect=refused) as send, mock.patch("celery.app.trace.logger"):
+            result = create_email.delay(email="bounce@umed.io", context={})
+        self.assertEqual(send.call_count, 3)
+        self.assertTrue(result.failed())
+        self.assertFalse(DeadLetter.objects.exists())
+        self.assertEqual(Patient.objects.in_study().count(), 2)
+
+    @override_settings(EMAIL_RETRY_MAX=2)
+    def test_systemic_failure_retries_rest_of_batch(self):
+        sent = []
+
+        def send_messages(messages):
+            if messages[0].to[0] == "b@umed.io" and len(sent) < 2:
+                sent.append(None)
+                raise smtplib.SMTPSenderRefused(550, b"Not ours", "x@umed.io")
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        batch = make_batch([("a@umed.io", "a"), ("b@umed.io", "b"), ("c@umed.io", "c")])
+        with mock.patch(SEND, side_effect=send_messages):
+            result = send_email_batch.delay(batch)
+        # a went out once; b and c only on the retry after the failures cleared
+        self.assertEqual([m.to[0] for m in mail.outbox], ["a@umed.io", "b@umed.io", "c@umed.io"])
+        self.assertEqual(result.get()["sent"], 3)
+        self.assertFalse(DeadLetter.objects.exists())
+
+    @override_settings(EMAIL_RETRY_MAX=2)
+    def test_batch_connection_failure_is_retried_then_dead_lettered(self):
+        batch = make_batch([("a@umed.io", "a"), ("b@umed.io", "b")])
+        with mock.patch.object(ConnectionPool, "get", side_effect=socket.timeout()) as get:
+            result = send_email_batch.delay(batch)
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(result.get()["failed"], 2)
+        self.assertEqual(
+            sorted(DeadLetter.objects.values_list("email", "reason", "attempts")),
+            [("a@umed.io", "exhausted", 3), ("b@umed.io", "exhausted", 3)],
+        )
+
+    def test_dropped_connection_is_reopened_once_for_the_rest_of_the_batch(self):
+        failed = []
+
+        def send_messages(messages):
+            if messages[0].to[0] == "b@umed.io" and not failed:
+                failed.append(None)
+                raise smtplib.SMTPServerDisconnected()
+            mail.outbox.extend(messages)
+            return len(messages)
+
+        connection_pool.reset()
+        self.addCleanup(connection_pool.reset)
+        batch = make_batch([(f"{name}@umed.io", name) for name in "abcd"])
+        with mock.patch(SEND, side_effect=send_messages), \
+                mock.patch("tasks.tasks.open_connection", side_effect=open_connection) as opened:
+            result = send_email_batch.delay(batch)
+        self.assertEqual((result.get()["sent"], result.get()["deferred"]), (3, 1))
+        # The first connection, and one replacing it after the drop
+        self.assertEqual(opened.call_count, 2)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), [f"{name}@umed.io" for name in "abcd"])
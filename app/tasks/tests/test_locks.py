@@ -0,0 +1,96 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from libs.locks import LeaseLock, LeaseLost, LocalStore, LockHeld
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class LeaseLockTestCase(SimpleTestCase):
+
+    """
+    Test suite for the Redis lease locks, against the in-process fake
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.redis = LocalStore(clock=self.clock)
+
+    def lease(self, name="run", ttl=10):
+        return LeaseLock(name, ttl=ttl, client=self.redis)
+
+    def test_exclusive(self):
+        first, second = self.lease(), self.lease()
+        self.assertTrue(first.acquire(heartbeat=False))
+        self.assertFalse(second.acquire(heartbeat=False))
+        first.release()
+        self.assertTrue(second.acquire(heartbeat=False))
+        # Other names are independent
+        self.assertTrue(self.lease("other").acquire(heartbeat=False))
+
+    def test_fencing_tokens_increase(self):
+        tokens = []
+        for _ in range(3):
+            lease = self.lease()
+            self.assertTrue(lease.acquire(heartbeat=False))
+            tokens.append(lease.token)
+            lease.release()
+        self.assertEqual(tokens, sorted(set(tokens)))
+
+    def test_expired_lease_is_taken_over(self):
+        stale = self.lease()
+        stale.acquire(heartbeat=False)
+        self.clock.now += 11
+        fresh = self.lease()
+        self.assertTrue(fresh.acquire(heartbeat=False))
+        self.assertGreater(fresh.token, stale.token)
+
+        # The stale holder can neither renew nor release the new lease
+        self.assertFalse(stale.renew())
+        self.assertTrue(stale.lost.is_set())
+        stale.release()
+        self.assertFalse(self.lease().acquire(heartbeat=False))
+
+    def test_renew_extends(self):
+        lease = self.lease()
+        lease.acquire(heartbeat=False)
+        self.clock.now += 8
+        self.assertTrue(lease.renew())
+        self.clock.now += 8
+        self.assertFalse(self.lease().acquire(heartbeat=False))
+
+    def test_check(self):
+        lease = self.lease()
+        lease.acquire(heartbeat=False)
+        lease.check()
+        lease.lost.set()
+        with self.assertRaises(LeaseLost):
+            lease.check()
+
+    def test_context_manager(self):
+        with self.lease() as lease:
+            self.assertTrue(lease.held)
+            with self.assertRaises(LockHeld):
+                with self.lease():
+                    pass
+        self.assertFalse(lease.held)
+        self.assertIsNone(self.redis.get(lease.key))
+
+    def test_heartbeat(self):
+        '''
+        The heartbeat renews the lease while its holder works
+        '''
+        renewed = threading.Event()
+        lease = LeaseLock("run", ttl=0.3, client=LocalStore())
+        renew = lease.renew
+        lease.renew = lambda: renewed.set() or renew()
+        with lease:
+            self.assertTrue(renewed.wait(1))
+            lease.check()
@@ -0,0 +1,203 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from utils.logger import CompressingRotatingFileHandler, SamplingFilter, find_segments, read_index
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class SamplingFilterTestCase(SimpleTestCase):
+
+    """
+    Test suite for the log sampling filter
+    """
+    def setUp(self):
+        self.clock = 1000.0
+        patcher = mock.patch("utils.logger.time.monotonic", lambda: self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.logger = logging.getLogger("test.sampling")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.handler = ListHandler()
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def use(self, **kwargs):
+        self.filter = SamplingFilter(**{"period": 60, **kwargs})
+        self.handler.addFilter(self.filter)
+
+    def messages(self):
+        return [record.getMessage() for record in self.handler.records]
+
+    def test_template(self):
+        record = logging.LogRecord("x", logging.INFO, "", 0, "Task: Send email to [a@b.io] in 12.5s", None, None)
+        self.assertEqual(SamplingFilter.template(record), "Task: Send email to # in #s")
+        record = logging.LogRecord("x", logging.INFO, "", 0, "Sent %d emails", (12,), None)
+        self.assertEqual(SamplingFilter.template(record), "Sent %d emails")
+
+    def test_rate_limit_per_template(self):
+        self.use(rate=3, sample_size=0)
+        for i in range(10):
+            self.logger.info(f"Sent email to patient{i}@umed.io")
+            self.logger.info("Other message")
+        self.assertEqual(len(self.handler.records), 6)
+
+    def test_warnings_always_kept(self):
+        self.use(rate=1, sample_size=0)
+        for i in range(10):
+            self.logger.warning(f"Retrying email {i}")
+        self.assertEqual(len(self.handler.records), 10)
+
+    def test_logger_rate(self):
+        self.use(rate=100, sample_size=0, logger_rates={"test": 4})
+        for i in range(10):
+            self.logger.info(f"Message {i} of kind {'ab'[i % 2]}")
+        self.assertEqual(len(self.handler.records), 4)
+
+    def test_logger_rate_is_shared_by_children(self):
+        self.use(rate=100, sample_size=0, logger_rates={"test": 4})
+        child = logging.getLogger("test.sampling.child")
+        for i in range(10):
+            self.logger.info(f"Message {i}")
+            child.info(f"Child message {i}")
+        self.assertEqual(len(self.handler.records), 4)
+
+    def test_reservoir_sampling(self):
+        '''
+        Past the limit INFO is sampled, keeping about k(1 + ln(n/k)) records
+        '''
+        self.use(rate=0, sample_size=10)
+        for i in range(10000):
+            self.logger.info(f"Sent email {i}")
+        self.assertTrue(10 < len(self.handler.records) < 200)
+        # Everything up to the reservoir size is kept
+        self.assertEqual(self.messages()[:10], [f"Sent email {i}" for i in range(10)])
+
+    def test_sample_level(self):
+        '''
+        Records above sample_level are dropped past the limit, not sampled
+        '''
+        self.use(rate=1, sample_size=10, sample_level="DEBUG", keep_level="ERROR")
+        for i in range(5):
+            self.logger.info(f"Detail {i}")
+        self.assertEqual(len(self.handler.records), 1)
+
+    def test_sampled_below_sample_level(self):
+        self.use(rate=1, sample_size=10, sample_level="INFO")
+        for i in range(5):
+            self.logger.debug(f"Detail {i}")
+        self.assertEqual(len(self.handler.records), 5)
+
+    def test_summary(self):
+        self.use(rate=2, sample_size=0)
+        for i in range(5):
+            self.logger.info(f"Sent email {i}")
+        self.clock += 61
+        self.logger.info("Next window")
+        self.assertEqual(
+            self.messages(), ["Sent email 0", "Sent email 1", "Suppressed 3 similar messages in 61s: Sent email #", "Next window"]
+        )
+
+    def test_shared_between_handlers(self):
+        '''
+        A record gets one decision, whichever handlers share the filter
+        '''
+        self.use(rate=2, sample_size=0)
+        other = ListHandler()
+        other.addFilter(self.filter)
+        self.logger.addHandler(other)
+        self.addCleanup(self.logger.removeHandler, other)
+        for i in range(5):
+            self.logger.info(f"Sent email {i}")
+        self.assertEqual(len(self.handler.records), 2)
+        self.assertEqual(len(other.records), 2)
+
+
+class CompressingRotatingFileHandlerTestCase(SimpleTestCase):
+
+    """
+    Test suite for the size/time rotating, compressing log handler
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "app.log")
+
+    def handler(self, **kwargs):
+        handler = CompressingRotatingFileHandler(self.path, **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    def emit(self, handler, message, created):
+        record = logging.LogRecord("test", logging.INFO, "", 0, message, None, None)
+        record.created = created
+        handler.handle(record)
+
+    def test_rotates_by_size_and_compresses(self):
+        handler = self.handler(maxBytes=100, backupCount=10)
+        for i in range(10):
+            self.emit(handler, "x" * 40, 1700000000 + i)
+        handler.close()
+        index = read_index(self.path + ".index.json")
+        self.assertEqual(len(index), 4)
+        self.assertEqual(sum(entry["records"] for entry in index), 8)
+        for entry in index:
+            self.assertTrue(entry["file"].endswith(".gz"))
+            with gzip.open(os.path.join(self.directory, entry["file"]), "rt") as f:
+                self.assertEqual(len(f.read().splitlines()), entry["records"])
+        self.assertEqual(index[0]["start"], "2023-11-14T22:13:20.000000")
+
+    def test_rotates_by_time(self):
+        handler = self.handler(interval=60, compression=None)
+        handler.rollover_at = 1700000060
+        self.emit(handler, "first", 1700000000)
+        self.emit(handler, "second", 1700000030)
+        self.emit(handler, "third", 1700000061)
+        index = read_index(self.path + ".index.json")
+        self.assertEqual([entry["records"] for entry in index], [2])
+        self.assertEqual(index[0]["end"], "2023-11-14T22:13:50.000000")
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "third\n")
+
+    def test_keeps_backup_count(self):
+        handler = self.handler(maxBytes=10, backupCount=2)
+        # Hold up compression so segments are pruned while still queued: they are
+        # skipped, not an error
+        handler.handleError = mock.Mock()
+        released, compress = threading.Event(), handler._compress
+        handler._compress = lambda segment: released.wait(5) and compress(segment)
+        for i in range(6):
+            self.emit(handler, "x" * 20, 1700000000 + i * 100)
+        released.set()
+        handler.close()
+        handler.handleError.assert_not_called()
+        index = read_index(self.path + ".index.json")
+        self.assertEqual(len(index), 2)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)), sorted(["app.log", "app.log.index.json"] + [e["file"] for e in index])
+        )
+
+    def test_find_segments(self):
+        handler = self.handler(maxBytes=10, compression=None)
+        for i in range(4):
+            self.emit(handler, "x" * 20, 1700000000 + i * 3600)
+        segments = find_segments(self.path, datetime(2023, 11, 14, 23, 30), datetime(2023, 11, 15, 0, 30))
+        self.assertEqual([os.path.basename(path) for path in segments], ["app.log.20231115T001320"])
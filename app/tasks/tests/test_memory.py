@@ -0,0 +1,97 @@
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from core.celery import app
+from tasks.memory import MemoryProfiler
+from tasks.tasks import create_email
+
+# Allocations a leaky task leaves behind
+RETAINED = []
+
+
+def leak():
+    RETAINED.append([object() for _ in range(20000)])
+
+
+@override_settings(MEMORY_PROFILE=True, MEMORY_PROFILE_SAMPLE_RATE=1.0, MEMORY_PROFILE_TASKS=[])
+class MemoryProfilerTestCase(SimpleTestCase):
+
+    """
+    Test suite for the worker memory profiler
+    """
+    def setUp(self):
+        self.addCleanup(RETAINED.clear)
+        self.profiler = MemoryProfiler()
+
+    def test_retained_allocations(self):
+        self.assertTrue(self.profiler.start("t1", "leaky"))
+        # One task at a time
+        self.assertFalse(self.profiler.start("t2", "leaky"))
+        leak()
+        with self.assertLogs(settings.CELERY_TASKS_LOGGER_NAME, "INFO") as logs:
+            profile = self.profiler.stop("t1", "leaky", "SUCCESS")
+        self.assertGreater(profile["retained_kb"], 100)
+        self.assertGreaterEqual(profile["peak_kb"], profile["retained_kb"])
+        self.assertIn(os.path.basename(__file__), profile["top"][0]["where"])
+        self.assertEqual(logs.records[0].memory, profile)
+        self.assertIsNone(self.profiler.stop("t2", "leaky"))
+
+    def test_sampling(self):
+        with override_settings(MEMORY_PROFILE=False):
+            self.assertFalse(self.profiler.start("t1", "leaky"))
+        with override_settings(MEMORY_PROFILE_TASKS=["other"]):
+            self.assertFalse(self.profiler.start("t1", "leaky"))
+        with override_settings(MEMORY_PROFILE_SAMPLE_RATE=0.0):
+            self.assertFalse(self.profiler.start("t1", "leaky"))
+
+    def test_task_signals(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        with self.assertLogs(settings.CELERY_TASKS_LOGGER_NAME, "INFO") as logs:
+            create_email.delay(email="user0@umed.io", cc=[], context={"patient_username": "user0"})
+        profiles = [record.memory for record in logs.records if hasattr(record, "memory")]
+        self.assertEqual([profile["task"] for profile in profiles], [create_email.name])
+
+
+class MemoryReportTestCase(SimpleTestCase):
+
+    """
+    Test suite for the memory_report command
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def profile(self, task, retained, rss):
+        return {
+            "task": task, "retained_kb": retained, "peak_kb": retained * 2, "rss_kb_before": rss - 10,
+            "rss_kb_after": rss, "rss_kb_growth": 10, "top": [{"where": "leak.py:1", "size_kb": retained, "count": 1}],
+        }
+
+    def test_report(self):
+        path = os.path.join(self.directory, "celery.log")
+        lines = [json.dumps({"message": "Memory profile", "memory": self.profile("a", 100, rss)}) for rss in range(1000, 1100)]
+        # Older records in a compressed segment; the index points at it
+        with gzip.open(path + ".20240101T000000.gz", "wt") as f:
+            f.write("\n".join(lines[:50]) + "\n")
+        with open(path + ".index.json", "w") as f:
+            json.dump([{"file": "celery.log.20240101T000000.gz", "start": None, "end": None}], f)
+        with open(path, "w") as f:
+            f.write("\n".join(lines[50:] + [json.dumps({"message": "unrelated"})]) + "\n")
+
+        out = io.StringIO()
+        with override_settings(MEMORY_RECYCLE_HEADROOM=0.5):
+            call_command("memory_report", file=path, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report["profiles"], 100)
+        self.assertEqual(report["tasks"]["a"]["top"], [{"where": "leak.py:1", "size_kb": 10000, "samples": 100}])
+        self.assertEqual(report["rss_kb_p95"], 1094)
+        self.assertEqual(report["suggested_max_memory_per_child_kb"], 1641)
@@ -0,0 +1,54 @@
+from django.contrib.auth.models import User
+from django.core import mail
+from django.test import TestCase
+
+from apps.patient.campaign import dispatch_batches
+from apps.patient.models import Patient
+from apps.study.models import Study
+from core.celery import app
+from tasks.models import Suppression
+from tasks.payloads import iter_batch, make_batch
+from tasks.suppression import index as suppression_index
+
+
+class PayloadTestCase(TestCase):
+
+    """
+    Test suite for batched email payloads
+    """
+    def test_round_trip(self):
+        batch = make_batch([("a@umed.io", "a"), ("b@umed.io", "b")], {"care_provider_name": "P"})
+        self.assertEqual(list(iter_batch(batch)), [
+            ("a@umed.io", {"care_provider_name": "P", "patient_username": "a"}),
+            ("b@umed.io", {"care_provider_name": "P", "patient_username": "b"}),
+        ])
+
+    def test_unknown_version(self):
+        with self.assertRaises(ValueError):
+            list(iter_batch({"v": 99}))
+
+    def test_dispatch_batches(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        studies = [Study.objects.create(name=name) for name in ("A", "B")]
+        for i in range(5):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@umed.io")
+            Patient.objects.create(user=user, study=studies[i % 2], cancelled=30 if i == 4 else 0)
+
+        self.assertEqual(dispatch_batches(Patient.objects.all(), batch_size=1), 4)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), [f"user{i}@umed.io" for i in range(4)])
+        self.assertTrue(any("Dear user0," in message.body for message in mail.outbox))
+
+    def test_dispatch_batches_skips_suppressed(self):
+        app.conf.task_always_eager = True
+        self.addCleanup(setattr, app.conf, "task_always_eager", False)
+        study = Study.objects.create(name="A")
+        for i in range(2):
+            user = User.objects.create(username=f"user{i}", email=f"user{i}@umed.io")
+            Patient.objects.create(user=user, study=study)
+        Suppression.objects.suppress("user1@umed.io", "bounced")
+        suppression_index.load()
+
+        self.assertEqual(dispatch_batches(Patient.objects.all(), batch_size=1), 1)
+        self.assertEqual([m.to[0] for m in mail.outbox], ["user0@umed.io"])
+        self.assertEqual(dict(Patient.objects.values_list("user__username", "emails_sent")), {"user0": 1, "user1": 0})
@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.test import TestCase, override_settings
+from django.utils.html import strip_tags
+
+from tasks.rendering import RenderCache, hit_rate, uses_slots
+
+CONTEXT = {"care_provider_contact": "Dr Smith & Co", "care_provider_name": "Smith's Surgery"}
+
+TEMPLATES = [{
+    "BACKEND": "django.template.backends.django.DjangoTemplates",
+    "OPTIONS": {"loaders": [("django.template.loaders.locmem.Loader", {
+        "plain.html": "<p>Dear {{ patient_username }}</p><p>{{ care_provider_name }}</p>",
+        "filtered.html": "<p>Dear {{ patient_username|upper }}</p>",
+        "conditional.html": "<p>Dear {% if patient_username %}{{ patient_username }}{% else %}patient{% endif %}</p>",
+        "including.html": "<p>{{ care_provider_name }}</p>{% include 'conditional.html' %}",
+        "unescaped.html": "{% autoescape off %}<p>Dear {{ patient_username }}</p>{% endautoescape %}",
+    })]},
+}]
+
+
+class RenderCacheTestCase(TestCase):
+
+    """
+    Test suite for the email render cache
+    """
+    def test_matches_full_render(self):
+        cache = RenderCache(maxsize=8, alias="")
+        for username in ("UserOne", "<b>bold</b>", "O'Brien & \"Sons\"", "@@umed-slot:x@@"):
+            context = {**CONTEXT, "patient_username": username}
+            html = render_to_string("tasks/patient_email.html", context)
+            self.assertEqual(
+                cache.render("tasks/patient_email.html", context, ["patient_username"]),
+                (html, strip_tags(html)),
+            )
+        stats = cache.stats()
+        self.assertEqual((stats["render_hits"], stats["render_misses"]), (3, 1))
+        self.assertEqual(hit_rate(stats), 0.75)
+
+    def test_shared_context_is_part_of_the_key(self):
+        cache = RenderCache(maxsize=8, alias="")
+        first = cache.render("tasks/patient_email.html", {**CONTEXT, "patient_username": "a"}, ["patient_username"])
+        other = {**CONTEXT, "care_provider_name": "Patel's Surgery", "patient_username": "a"}
+        second = cache.render("tasks/patient_email.html", other, ["patient_username"])
+        self.assertNotEqual(first, second)
+        self.assertEqual(cache.stats()["render_misses"], 2)
+
+    def test_lru_eviction(self):
+        cache = RenderCache(maxsize=1, alias="")
+        for name in ("A", "B", "A"):
+            cache.render("tasks/patient_email.html", {**CONTEXT, "care_provider_name": name}, [])
+        self.assertEqual(cache.stats()["render_misses"], 3)
+
+    @override_settings(TEMPLATES=TEMPLATES)
+    def test_transformed_slots_fall_back_to_full_render(self):
+        cache = RenderCache(maxsize=8, alias="")
+        for username in ("alice", "bob"):
+            html, _ = cache.render("filtered.html", {"patient_username": username}, ["patient_username"])
+            self.assertEqual(html, f"<p>Dear {username.upper()}</p>")
+        self.assertEqual(cache.stats()["render_fallbacks"], 1)
+
+    @override_settings(TEMPLATES=TEMPLATES)
+    def test_tested_slots_fall_back_to_full_render(self):
+        cache = RenderCache(maxsize=8, alias="")
+        for template in ("conditional.html", "including.html"):
+            for username in ("alice", ""):
+                context = {**CONTEXT, "patient_username": username}
+                html = render_to_string(template, context)
+                self.assertEqual(cache.render(template, context, ["patient_username"]), (html, strip_tags(html)))
+        self.assertIn("Dear patient", html)
+        self.assertEqual(cache.stats()["render_fallbacks"], 2)
+
+    @override_settings(TEMPLATES=TEMPLATES)
+    def test_unescaped_slots_fall_back_to_full_render(self):
+        cache = RenderCache(maxsize=8, alias="")
+        for username in ("<b>O'Brien & Sons</b>", "alice"):
+            html, _ = cache.render("unescaped.html", {"patient_username": username}, ["patient_username"])
+            self.assertEqual(html, f"<p>Dear {username}</p>")
+        self.assertEqual(cache.stats()["render_fallbacks"], 1)
+
+    @override_settings(TEMPLATES=[{**TEMPLATES[0], "OPTIONS": {**TEMPLATES[0]["OPTIONS"], "autoescape": False}}])
+    def test_unescaping_engine_falls_back_to_full_render(self):
+        self.assertTrue(uses_slots("plain.html", ["patient_username"]))
+
+    @override_settings(TEMPLATES=TEMPLATES)
+    def test_uses_slots(self):
+        self.assertFalse(uses_slots("plain.html", ["patient_username"]))
+        self.assertTrue(uses_slots("filtered.html", ["patient_username"]))
+        self.assertTrue(uses_slots("including.html", ["patient_username"]))
+        self.assertFalse(uses_slots("including.html", ["care_provider_name"]))
+
+    def test_campaign_template_is_splittable(self):
+        self.assertFalse(uses_slots("tasks/patient_email.html", settings.EMAIL_RENDER_SLOTS))
+
+    @override_settings(
+        TEMPLATES=TEMPLATES,
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    )
+    def test_shared_tier(self):
+        context = {**CONTEXT, "patient_username": "a"}
+        RenderCache(maxsize=8, alias="default").render("plain.html", context, ["patient_username"])
+        worker = RenderCache(maxsize=8, alias="default")
+        html, _ = worker.render("plain.html", {**context, "patient_username": "b"}, ["patient_username"])
+        self.assertEqual(html, "<p>Dear b</p><p>Smith&#x27;s Surgery</p>")
+        self.assertEqual(worker.stats()["render_shared_hits"], 1)
@@ -0,0 +1,64 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from apps.patient.models import Patient
+from apps.study.models import Study
+from tasks.models import Suppression
+from tasks.suppression import BloomFilter, SuppressionIndex
+
+
+class BloomFilterTestCase(TestCase):
+
+    """
+    Test suite for the Bloom filter behind the suppression index
+    """
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        emails = [f"user{i}@umed.io" for i in range(1000)]
+        for email in emails:
+            bloom.add(email)
+        self.assertTrue(all(email in bloom for email in emails))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add(f"user{i}@umed.io")
+        false_positives = sum(f"other{i}@umed.io" in bloom for i in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertAlmostEqual(bloom.false_positive_rate, 0.01, delta=0.005)
+
+
+class SuppressionIndexTestCase(TestCase):
+
+    """
+    Test suite for the suppression index
+    """
+    def test_suppressed(self):
+        Suppression.objects.suppress("Bounced@umed.io", "bounced")
+        index = SuppressionIndex()
+        emails = ["bounced@UMED.io", "fine@umed.io"]
+        with self.assertNumQueries(3):
+            # load (count + iterate), then one query to confirm the candidate
+            self.assertEqual(index.suppressed(emails), {"bounced@UMED.io"})
+        with self.assertNumQueries(0):
+            self.assertEqual(index.suppressed(["fine@umed.io"] * 100), set())
+        self.assertEqual(index.stats()["entries"], 1)
+
+    def test_opt_out_is_global(self):
+        user = User.objects.create(username="user", email="user@umed.io")
+        patient = Patient.objects.create(user=user, study=Study.objects.create(name="A"))
+        patient.cancelled = 30
+        patient.save()
+        self.assertTrue(SuppressionIndex().is_suppressed("user@umed.io"))
+
+    def test_opt_out_suppresses_on_change_only(self):
+        user = User.objects.create(username="user", email="user@umed.io")
+        Patient.objects.create(user=user, study=Study.objects.create(name="A"), cancelled=30)
+        self.assertTrue(Suppression.objects.filter(email="user@umed.io").exists())
+        patient = Patient.objects.get()
+        patient.status = 10
+        # Still opted out: no suppression write and no user lookup
+        with self.assertNumQueries(1):
+            patient.save(update_fields=["status"])
+        with self.assertNumQueries(1):
+            patient.save()
@@ -3,11 +3,17 @@
 # --------------------------------------------------------------
 import copy
 import errno
+import gzip
+import json
 import logging
 import os
+import queue
+import random
 import re
+import shutil
 import threading
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 from logging.handlers import RotatingFileHandler
 from uuid import uuid4
 
@@ -98,6 +104,210 @@ class BetterRotatingFileHandler(RotatingFileHandler):
                 raise
 
 
+class CompressingRotatingFileHandler(BetterRotatingFileHandler):
+    """
+    Rotates when the file reaches ``maxBytes`` or has been open for
+    ``interval`` seconds (0 disables either trigger).
+
+    A rotated file becomes a segment named after the UTC time of its first
+    record (app.log.20240101T120000), which a background thread compresses
+    (``compression`` "gzip", "zstd" when the zstandard package is installed,
+    or None), so the logging thread only ever renames. The newest
+    ``backupCount`` segments are kept.
+
+    ``<filename>.index.json`` lists every segment with the time range and
+    count of its records; find_segments() reads it to pick the files that
+    cover an incident without opening the others.
+    """
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None, delay=False,
+                 interval=0, compression='gzip', errors=None):
+        super(CompressingRotatingFileHandler, self).__init__(
+            filename, mode, maxBytes, backupCount, encoding, delay, errors
+        )
+        if compression == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                compression = 'gzip'
+        self.interval = interval
+        self.compression = compression
+        self.index_path = self.baseFilename + '.index.json'
+        self._index_lock = threading.Lock()
+        self._queue = None
+        self._compressor = None
+        self._reset_segment(time.time())
+
+    def _reset_segment(self, now):
+        self.rollover_at = now + self.interval if self.interval else None
+        self.first = self.last = None
+        self.records = 0
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and record.created >= self.rollover_at and self.records:
+            return 1
+        return super(CompressingRotatingFileHandler, self).shouldRollover(record)
+
+    def emit(self, record):
+        super(CompressingRotatingFileHandler, self).emit(record)
+        if self.first is None:
+            self.first = record.created
+        self.last = record.created
+        self.records += 1
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            started = self.first if self.first is not None else os.path.getmtime(self.baseFilename)
+            segment = self._segment_name(started)
+            os.rename(self.baseFilename, segment)
+            self._update_index(lambda segments: segments.append({
+                'file': os.path.basename(segment),
+                'start': _isoformat(self.first),
+                'end': _isoformat(self.last),
+                'records': self.records,
+            }))
+            if self.compression:
+                self._compress_later(segment)
+            else:
+                self._prune()
+        self._reset_segment(time.time())
+        if not self.delay:
+            self.stream = self._open()
+
+    def _segment_name(self, started):
+        stamp = datetime.fromtimestamp(started, tz=timezone.utc).strftime('%Y%m%dT%H%M%S')
+        segment, n = f'{self.baseFilename}.{stamp}', 1
+        while any(os.path.exists(segment + suffix) for suffix in ('', '.gz', '.zst')):
+            segment, n = f'{self.baseFilename}.{stamp}-{n}', n + 1
+        return segment
+
+    # --------------------------------------------------------------
+    # Background compression
+    # --------------------------------------------------------------
+    def _compress_later(self, segment):
+        if self._compressor is None:
+            self._queue = queue.Queue()
+            self._compressor = threading.Thread(target=self._compress_loop, name='log-compressor', daemon=True)
+            self._compressor.start()
+        self._queue.put(segment)
+
+    def _compress_loop(self):
+        while True:
+            segment = self._queue.get()
+            try:
+                if segment is None:
+                    return
+                if not os.path.exists(segment):
+                    # Pruned while it waited; pruning runs on this thread, so it stays gone
+                    continue
+                compressed = self._compress(segment)
+
+                def rename(segments):
+                    for entry in segments:
+                        if entry['file'] == os.path.basename(segment):
+                            entry['file'] = os.path.basename(compressed)
+
+                self._update_index(rename)
+                self._prune()
+            except Exception:
+                self.handleError(logging.LogRecord(self.name, logging.ERROR, __file__, 0, 'Could not compress %s', (segment,), None))
+            finally:
+                self._queue.task_done()
+
+    def _compress(self, segment):
+        if self.compression == 'zstd':
+            import zstandard
+
+            target, opener = segment + '.zst', lambda path: zstandard.open(path, 'wb')
+        else:
+            target, opener = segment + '.gz', lambda path: gzip.open(path, 'wb')
+        with open(segment, 'rb') as source, opener(target + '.tmp') as destination:
+            shutil.copyfileobj(source, destination, 1024 * 1024)
+        os.replace(target + '.tmp', target)
+        os.remove(segment)
+        return target
+
+    def _prune(self):
+        if not self.backupCount:
+            return
+        directory = os.path.dirname(self.baseFilename)
+
+        def prune(segments):
+            for entry in segments[:-self.backupCount]:
+                try:
+                    os.remove(os.path.join(directory, entry['file']))
+                except FileNotFoundError:
+                    pass
+            del segments[:-self.backupCount]
+
+        self._update_index(prune)
+
+    # --------------------------------------------------------------
+    # Index
+    # --------------------------------------------------------------
+    def _update_index(self, change):
+        with self._index_lock:
+            segments = read_index(self.index_path)
+            change(segments)
+            with open(self.index_path + '.tmp', 'w') as f:
+                json.dump(segments, f, separators=(',', ':'))
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+    def close(self):
+        # Let queued segments finish compressing before the process exits
+        if self._compressor is not None:
+            self._queue.put(None)
+            self._compressor.join(timeout=30)
+            self._compressor = None
+        super(CompressingRotatingFileHandler, self).close()
+
+
+def _isoformat(created):
+    if created is None:
+        return None
+    return datetime.fromtimestamp(created, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+
+def read_index(index_path):
+    try:
+        with open(index_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def find_segments(filename, start=None, end=None):
+    '''
+    Paths of the rotated segments of the log ``filename`` holding records
+    between ``start`` and ``end`` (naive UTC datetimes), oldest first.
+    Records newer than the last segment are in ``filename`` itself.
+    '''
+    filename = os.path.abspath(filename)
+    directory = os.path.dirname(filename)
+    start = start and start.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    end = end and end.strftime('%Y-%m-%dT%H:%M:%S.%f')
+    return [
+        os.path.join(directory, entry['file'])
+        for entry in read_index(filename + '.index.json')
+        if not (end and entry['start'] and entry['start'] > end)
+        and not (start and entry['end'] and entry['end'] < start)
+    ]
+
+
+def open_segment(path):
+    '''
+    Open a log file or rotated segment, compressed or not, for reading text
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    if path.endswith('.zst'):
+        import zstandard
+        return zstandard.open(path, 'rt')
+    return open(path)
+
+
 class coreJsonFormatter(jsonlogger.JsonFormatter):
     def add_fields(self, log_record, record, message_dict):
         super(coreJsonFormatter, self).add_fields(log_record, record, message_dict)
@@ -190,6 +400,129 @@ class SensitiveDataObfuscatorFilter(logging.Filter):
         return data
 
 
+class SamplingFilter(logging.Filter):
+    """
+    Caps log volume per logger and per message template.
+
+    Within each ``period`` (seconds) a message template (the message with
+    numbers, ids, addresses and [bracketed] values masked) may log ``rate``
+    records, and the loggers matching a ``logger_rates`` prefix (the logger
+    and its children) may log that many records in total between them. Past a limit, records at or below ``sample_level``
+    are reservoir sampled (Algorithm R, each record passing as it enters a
+    reservoir of ``sample_size``), so a flood still leaves a few examples and
+    grows only logarithmically; other records are dropped. Records at
+    ``keep_level`` and above always pass.
+
+    Once a template's period is over, one record "Suppressed N similar
+    messages ..." is logged in place of what was dropped.
+
+    Configure it in the dictConfig 'filters' block with '()':
+    'utils.logger.SamplingFilter' and any of the keyword arguments below.
+    """
+    _masks = re.compile(
+        r'\[[^\]]*\]'
+        r'|\b[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}\b'
+        r'|[\w.+-]+@[\w-]+(?:\.[\w-]+)+'
+        r'|\d+(?:\.\d+)?',
+        re.IGNORECASE
+    )
+
+    def __init__(self, rate=100, period=60, logger_rates=None, sample_size=10, sample_level='INFO',
+                 keep_level='WARNING', max_templates=10000, name=''):
+        super(SamplingFilter, self).__init__(name)
+        self.rate = rate
+        self.period = period
+        self.logger_rates = sorted((logger_rates or {}).items(), key=lambda item: -len(item[0]))
+        self.sample_size = sample_size
+        self.sample_level = logging._checkLevel(sample_level)
+        self.keep_level = logging._checkLevel(keep_level)
+        self.max_templates = max_templates
+        self._templates = {}
+        self._loggers = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + period
+
+    def filter(self, record):
+        if record.levelno >= self.keep_level:
+            return True
+        # One decision per record, however many handlers share this filter
+        if hasattr(record, '_sampled'):
+            return record._sampled
+
+        now = time.monotonic()
+        with self._lock:
+            summaries = self._sweep(now) if now >= self._next_sweep else []
+            record._sampled = self._admit(record, now)
+        for summary in summaries:
+            logging.getLogger(summary.name).handle(summary)
+        return record._sampled
+
+    def _admit(self, record, now):
+        key = (record.name, self.template(record))
+        state = self._templates.get(key)
+        if state is None:
+            if len(self._templates) >= self.max_templates:
+                # Too many distinct messages: count the rest together
+                key = (record.name, '*')
+                state = self._templates.get(key)
+            if state is None:
+                state = self._templates[key] = [now, 0, 0, record.pathname, record.lineno]
+        state[1] += 1
+        allowed = state[1] <= self.rate
+
+        prefix, logger_limit = self._logger_rate(record.name)
+        if logger_limit is not None:
+            # One budget per configured prefix, shared by its child loggers
+            window = self._loggers.get(prefix)
+            if window is None or now - window[0] >= self.period:
+                window = self._loggers[prefix] = [now, 0]
+            window[1] += 1
+            allowed = allowed and window[1] <= logger_limit
+
+        if not allowed and record.levelno <= self.sample_level:
+            # The record's position among those over the limit
+            over = state[1] - self.rate if state[1] > self.rate else window[1] - logger_limit
+            allowed = over <= self.sample_size or random.random() < self.sample_size / over
+        if not allowed:
+            state[2] += 1
+        return allowed
+
+    def _logger_rate(self, name):
+        # The longest matching prefix and its rate
+        for prefix, rate in self.logger_rates:
+            if name == prefix or name.startswith(prefix + '.'):
+                return prefix, rate
+        return None, None
+
+    def _sweep(self, now):
+        '''
+        Close every template window that is over; returns the summary records
+        '''
+        self._next_sweep = now + self.period
+        summaries = []
+        for key, (start, _, suppressed, pathname, lineno) in list(self._templates.items()):
+            if now - start < self.period:
+                continue
+            del self._templates[key]
+            if suppressed:
+                summary = logging.LogRecord(
+                    key[0], logging.INFO, pathname, lineno,
+                    'Suppressed %d similar messages in %ds: %s', (suppressed, now - start, key[1]), None,
+                )
+                summary._sampled = True
+                summaries.append(summary)
+        for prefix, (start, _) in list(self._loggers.items()):
+            if now - start >= self.period:
+                del self._loggers[prefix]
+        return summaries
+
+    @classmethod
+    def template(cls, record):
+        if record.args:
+            return str(record.msg)
+        return cls._masks.sub('#', str(record.msg))
+
+
 class RequestIdGenerator:
     @staticmethod
     def get() -> str: